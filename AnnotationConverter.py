@@ -1,12 +1,21 @@
 #!/usr/bin/python # Expects Python 3
+import hashlib
 import json
 import os
-import requests
-from slugify import slugify
-import pickle
 from PIL import Image
 from io import BytesIO
-from lxml import etree
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import iiif_cache
+import iiif_http
+import iiif_stream
+import jpeg_header
+import conversion_state
+import voc_xml
+import canvas_index
+import annotation_store
 
 # Given links to one or more IIIF annotation "activity streamw" (basically lists of annotations 
 # in manifest-like format):
@@ -23,6 +32,7 @@ from lxml import etree
 # label_map.pbtxt -- a mapping of label numbers to names (can be linked data URIs) and display_names
 # annotations/trainval.txt -- a list of the downloaded/resized image filenames *without extensions*
 # annotaions/xmls/*.xml -- one XML file per annotated image, in PASCAL VOC annotation format
+# annotations/annotations.jsonl -- the same image sizes and boxes for every image, one JSON line per image
 
 projectName = 'edo_illustrations'
 
@@ -32,18 +42,32 @@ annotationURLs = ["https://marinus.library.ucla.edu/viewer/annotation/"]
 #allowedManifests = None
 allowedManifests = ['https://marinus.library.ucla.edu/iiif/kabuki/manifest.json', 'https://marinus.library.ucla.edu/iiif/gokan/manifest.json']
 
-# Keys: manifest URL. Values: dictionary of key: canvas ID, value: image data from manifest
-maniMappings = {}
+# Image URL, full dimensions and imageID of every canvas in the source
+# manifests, kept on disk between runs (see canvas_index.py)
+canvasIndexPath = os.path.join(os.getcwd(), 'canvas_index.sqlite')
+# Manifests that have been checked for changes during this run
+loadedManifests = set()
 # Keys: imageID. Values: resized width and height
 trainingImages = {}
 
 # Keys: imageID. Values: array of dictionaries of annotations with tags and bounding boxes
-imageAnnotations = {}
+# (held in columnar form, see annotation_store.py)
+imageAnnotations = annotation_store.AnnotationStore()
 
 allTags = set()
 
 cacheEnabled = True
 cachePath = os.path.join(os.getcwd(), 'cache/')
+# Maximum size of the cached response bodies, in bytes. The least recently
+# used responses are evicted beyond this. None means no limit.
+cacheMaxBytes = None
+# Check cached manifests, info.json and annotation lists with the server
+# (a cheap conditional request) instead of trusting the cached copy
+revalidateDocuments = True
+
+# Parse the annotation lists incrementally, one annotation at a time, rather
+# than loading each whole list into memory
+streamAnnotations = True
 
 # Where the resized JPEG images are stored
 imagesFolder = os.path.join(os.getcwd(), 'images/')
@@ -51,7 +75,43 @@ imagesFolder = os.path.join(os.getcwd(), 'images/')
 annotationsFolder = os.path.join(os.getcwd(), 'annotations/')
 xmlsFolder = os.path.join(annotationsFolder, 'xmls/')
 
+# Output formats. writeVOCXML writes one PASCAL VOC XML file per image (read
+# by create_tf_record.py); writeTFRecords writes the train/val TFRecord files
+# directly from the annotations in memory, skipping the XML round trip.
+# writeAnnotationIndex writes every image's size and boxes to one JSON Lines
+# file, which create_tf_record.py reads instead of the XML files when it's
+# there (so turning it off removes an index left by an earlier run).
+writeVOCXML = True
+writeTFRecords = False
+recordsFolder = os.getcwd()
+writeAnnotationIndex = True
+annotationIndexPath = os.path.join(annotationsFolder, 'annotations.jsonl')
+
+# The XML annotation files are written by a pool of xmlWorkers processes
+# (None means one per CPU), xmlChunkSize files at a time
+xmlWorkers = None
+xmlChunkSize = 500
+
+# Keep a journal of the images and XML files already produced, so that a
+# re-run only regenerates the XML files for images whose annotations changed,
+# and a run that was interrupted picks up where it left off
+resumeConversion = True
+statePath = os.path.join(annotationsFolder, 'conversion_state.json')
+
 clipImages = False
+# How the clipped regions are produced: 'server' requests each region from
+# the IIIF server at full resolution, 'local' fetches one derivative of the
+# canvas (clipDerivativeSize pixels on its longest side, or full size if None)
+# and crops all of its regions here, and 'auto' chooses per canvas
+clipMode = 'auto'
+clipDerivativeSize = 2000
+# Cost model for clipMode = 'auto', in rough units of server time: each
+# region request makes the server decode part of the full-sized image, the
+# derivative costs about one full decode, and a local crop is nearly free.
+# Local cropping wins once a canvas has enough regions.
+serverRegionCost = 1.0
+derivativeCost = 2.5
+localCropCost = 0.05
 outputFolder = os.path.join(os.getcwd(), 'output/')
 if (clipImages):
   try:
@@ -67,6 +127,21 @@ if (clipImages):
 # locally (without re-fetching the images from their IIIF servers)
 harvestAll = False
 
+# Save JPEGs from the image server exactly as they were sent, reading their
+# dimensions from the JPEG header, rather than decoding and re-encoding them.
+# Anything that isn't a JPEG is still converted with PIL.
+passThroughJPEGs = True
+
+# Resized images are fetched from the IIIF server(s) by a pool of worker
+# threads once all of the annotations have been read. perHostLimit caps the
+# number of simultaneous requests sent to any single image server.
+downloadWorkers = 8
+perHostLimit = 4
+
+# Keys: imageID. Values: resized image URL, for images to be harvested
+# (see harvestAll above) that aren't also training images
+harvestImages = {}
+
 try:
   if (not os.path.exists(imagesFolder)):
     os.makedirs(imagesFolder)
@@ -85,49 +160,216 @@ except:
   import sys
   sys.exit()
 
-try:
-  if (not os.path.exists(cachePath)):
-    os.makedirs(cachePath)
-except:
-  print("Unable to create cache folder, will download everything")
-  cacheEnaled = False
-
-def getURL(link, useCache=cacheEnabled):
-  fileSlug = slugify(link)
-  filePath = os.path.join(cachePath, fileSlug)
-  if (useCache and os.path.isfile(filePath)):
-    data = pickle.load(open(filePath, 'rb'))
-    print("fetched from cache: " + link)
-  else:
-    print("fetching " + link)
-    data = requests.get(link)
-    if (useCache):
-      pickle.dump(data, open(filePath, 'wb'))
-  return data
+canvasIndex = canvas_index.CanvasIndex(canvasIndexPath)
+
+state = None
+if (resumeConversion):
+  state = conversion_state.ConversionState(statePath)
 
+cache = None
+if (cacheEnabled):
+  try:
+    cache = iiif_cache.DiskCache(cachePath, cacheMaxBytes)
+    # Bring in any responses pickled by older versions of this script
+    if (cache.hasPickleCache()):
+      cache.importPickleCache()
+  except:
+    print("Unable to create cache folder, will download everything")
+    cacheEnabled = False
+
+# Set revalidate=True for documents that may have changed on the server
+# since they were cached (manifests, info.json, annotation lists)
+def getURL(link, useCache=cacheEnabled, revalidate=False):
+  if (useCache):
+    return iiif_http.fetchURL(link, cache, revalidate)
+  return iiif_http.fetchURL(link)
+
+# Returns a binary file object for a (potentially huge) document
+def openURL(link, useCache=cacheEnabled, revalidate=False):
+  if (useCache):
+    return iiif_http.openURL(link, cache, revalidate)
+  return iiif_http.openURL(link)
+
+# Yields (canvasID, imageURL, width, height, imageID) for each image in a manifest
 def processManifest(maniData):
-  theseMappings = {} 
   for sequence in maniData['sequences']:
     for canvas in sequence['canvases']:
       canvasID = canvas['@id']
       for image in canvas['images']:
         fullURL = image['resource']['@id']
         imageID = canvasID.split('/')[-1].replace('.json','').replace('.tif','').replace('.png','').replace('.jpg','') + ".jpg"
+        yield (canvasID, fullURL, image['resource']['width'], image['resource']['height'], imageID)
+
+# Make sure the canvas index is up to date for a manifest, only parsing the
+# manifest if it has changed since it was indexed
+def loadManifest(srcManifest):
+  manifestResponse = getURL(srcManifest, revalidate=revalidateDocuments)
+  digest = getattr(manifestResponse, 'digest', None)
+  if (digest is None):
+    digest = hashlib.sha256(manifestResponse.content).hexdigest()
+
+  if (canvasIndex.manifestDigest(srcManifest) != digest):
+    print("indexing canvases of manifest " + srcManifest)
+    canvasIndex.updateManifest(srcManifest, digest, processManifest(manifestResponse.json()))
+  manifestResponse.close()
+
+  # These are downloaded along with the training images, after all of
+  # the annotations have been read
+  if (harvestAll):
+    for canvasID, fullURL, fullWidth, fullHeight, imageID in canvasIndex.canvases(srcManifest):
+      if (imageID not in harvestImages):
+        outputPath = os.path.join(imagesFolder, imageID)
+        if (not os.path.isfile(outputPath)):
+          harvestImages[imageID] = fullURL.replace('full/full','full/!1000,1000')
+
+# One semaphore per image server, shared by all of the download threads
+hostLimits = {}
+hostLimitsLock = threading.Lock()
+
+def hostSemaphore(link):
+  host = urlparse(link).netloc
+  with hostLimitsLock:
+    if (host not in hostLimits):
+      hostLimits[host] = threading.BoundedSemaphore(perHostLimit)
+    return hostLimits[host]
+
+# Save image data from the server as a JPEG, returning its width and height
+def saveJPEG(imageData, outputPath):
+  imageSize = None
+  if (passThroughJPEGs):
+    imageSize = jpeg_header.jpegSize(imageData)
+  if (imageSize is not None):
+    with open(outputPath, 'wb') as outputFile:
+      outputFile.write(imageData)
+    return imageSize
+
+  im = Image.open(BytesIO(imageData))
+  with open(outputPath, 'wb') as outputFile:
+    im.save(outputFile, 'jpeg')
+  return im.size
+
+# Returns the saved image's width and height
+def fetchImage(imageID, resizedURL, verb="saving"):
+  with hostSemaphore(resizedURL):
+    imageResponse = getURL(resizedURL)
+
+  outputPath = os.path.join(imagesFolder, imageID)
+  print(verb + " cropped image " + imageID)
+  return saveJPEG(imageResponse.content, outputPath)
+
+# Fetch and save a batch of images concurrently. Keys of imageURLs are
+# imageIDs, values are the resized image URLs. Returns a dictionary of
+# imageID: (resized width, resized height) in the same order as imageURLs.
+# Images that the conversion journal says were already saved are skipped.
+def fetchImages(imageURLs, verb="saving"):
+  imageSizes = {}
+  with ThreadPoolExecutor(max_workers=downloadWorkers) as pool:
+    futures = {}
+    for imageID in imageURLs:
+      if (state is not None):
+        outputPath = os.path.join(imagesFolder, imageID)
+        imageSizes[imageID] = state.savedImageSize(imageID, imageURLs[imageID], outputPath)
+        if (imageSizes[imageID] is not None):
+          continue
+      futures[imageID] = pool.submit(fetchImage, imageID, imageURLs[imageID], verb)
+    for imageID in futures:
+      imageSizes[imageID] = futures[imageID].result()
+      if (state is not None):
+        state.recordImage(imageID, imageURLs[imageID], imageSizes[imageID])
+  if (state is not None):
+    state.save()
+  return imageSizes
+
+# Write a text file only if its contents would change
+def writeIfChanged(filePath, text):
+  if (os.path.isfile(filePath)):
+    with open(filePath, 'r') as oldFile:
+      if (oldFile.read() == text):
+        return
+  with open(filePath, 'w') as newFile:
+    newFile.write(text)
+
+def useLocalCropping(regionCount):
+  if (clipMode == 'auto'):
+    return (derivativeCost + regionCount * localCropCost) < (regionCount * serverRegionCost)
+  return (clipMode == 'local')
+
+def croppedImagePath(imageID, region):
+  croppedImageID = imageID + '.' + region['xywhString'] + '_' + reduceTags(region['tags']) + '.jpg'
+  return os.path.join(outputFolder, croppedImageID)
+
+# Save the full-resolution contents of each region, as cut out by the server
+def clipRegionsOnServer(imageID, regions):
+  for region in regions:
+    # This is how to format a request for the full-res contents of the bbox
+    croppedURL = region['fullURL'].replace('full/full', region['xywhString'] + '/full')
+    # NOTE: The version below resizes the cropped image to 1000 pixels on its
+    # longest side; it does not seem to be possible to resize the entire image 
+    # first and THEN crop it (?) using IIIF
+    #croppedURL = resizedURL.replace('full/!1000,1000', xywhString + '/!1000,1000')
+    with hostSemaphore(croppedURL):
+      croppedResponse = getURL(croppedURL)
+    if (not croppedResponse.ok):
+      print("unable to fetch region " + region['xywhString'] + " of " + imageID + " (status " + str(croppedResponse.status_code) + ")")
+      continue
   
-        # If it's in trainingImages, it has already been downloaded
-        if (harvestAll and (imageID not in trainingImages)):
-          outputPath = os.path.join(imagesFolder, imageID)
-          if (not os.path.isfile(outputPath)):
-            resizedURL = fullURL.replace('full/full','full/!1000,1000')
-            imageResponse = getURL(resizedURL)
-            im = Image.open(BytesIO(imageResponse.content))
-    
-            with open(outputPath, 'w') as outputFile:
-              print("harvesting cropped image " + imageID)
-              im.save(outputFile, 'jpeg')
-
-        theseMappings[canvasID] = image
-  return theseMappings
+    croppedPath = croppedImagePath(imageID, region)
+    print("saving cropped image " + os.path.basename(croppedPath))
+    saveJPEG(croppedResponse.content, croppedPath)
+
+# Fetch one derivative of the canvas and cut all of the regions out of it
+def clipRegionsLocally(imageID, regions):
+  fullURL = regions[0]['fullURL']
+  if (clipDerivativeSize is None):
+    derivativeURL = fullURL
+  else:
+    derivativeURL = fullURL.replace('full/full', 'full/!' + str(clipDerivativeSize) + ',' + str(clipDerivativeSize))
+  with hostSemaphore(derivativeURL):
+    derivativeResponse = getURL(derivativeURL)
+  # Let the server cut out the regions if the derivative can't be had
+  if (not derivativeResponse.ok):
+    print("unable to fetch derivative of " + imageID + " (status " + str(derivativeResponse.status_code) + "), cropping on the server")
+    clipRegionsOnServer(imageID, regions)
+    return
+  try:
+    im = Image.open(BytesIO(derivativeResponse.content))
+    im.load()
+  except (OSError, SyntaxError) as e:
+    print("unable to decode derivative of " + imageID + " (" + str(e) + "), cropping on the server")
+    clipRegionsOnServer(imageID, regions)
+    return
+
+  widthRatio = float(im.size[0]) / float(regions[0]['fullWidth'])
+  heightRatio = float(im.size[1]) / float(regions[0]['fullHeight'])
+
+  for region in regions:
+    xywh = region['xywh']
+    cropBox = (int(xywh[0] * widthRatio), int(xywh[1] * heightRatio),
+               int((xywh[0] + xywh[2]) * widthRatio), int((xywh[1] + xywh[3]) * heightRatio))
+    croppedImage = im.crop(cropBox)
+    if (croppedImage.mode not in ('RGB', 'L', 'CMYK')):
+      croppedImage = croppedImage.convert('RGB')
+
+    croppedPath = croppedImagePath(imageID, region)
+    print("saving locally cropped image " + os.path.basename(croppedPath))
+    croppedImage.save(croppedPath, 'jpeg', quality=95)
+
+# The canvases are clipped concurrently by the download thread pool
+def clipAllRegions(annotations):
+  with ThreadPoolExecutor(max_workers=downloadWorkers) as pool:
+    futures = {}
+    for imageID in annotations:
+      regions = annotations.regions(imageID)
+      if (useLocalCropping(len(regions))):
+        futures[imageID] = pool.submit(clipRegionsLocally, imageID, regions)
+      else:
+        futures[imageID] = pool.submit(clipRegionsOnServer, imageID, regions)
+    # A canvas that can't be clipped is skipped, rather than losing the rest
+    for imageID in futures:
+      try:
+        futures[imageID].result()
+      except Exception as e:
+        print("unable to clip regions of " + imageID + ":", repr(e))
 
 # Map original tags onto a smaller domain
 def reduceTags(tagList):
@@ -150,11 +392,19 @@ def normalizeTag(tag):
 #jsonFile = open(jsonPath, 'r')
 #annotData = json.load(jsonFile)
 
+# Keys: imageID. Values: resized image URL, for every annotated image
+imageURLs = {}
+
 for annotationURL in annotationURLs:
   print("Fetching annotations from",annotationURL)
-  annotData = getURL(annotationURL).json()
+  if (streamAnnotations):
+    annotationStream = openURL(annotationURL, revalidate=revalidateDocuments)
+    annotResources = iiif_stream.iterResources(annotationStream)
+  else:
+    annotationStream = None
+    annotResources = getURL(annotationURL, revalidate=revalidateDocuments).json()['resources']
 
-  for r in annotData['resources']:
+  for r in annotResources:
     rID = r['@id']
     rType = r['@type']
     if (rType != 'oa:Annotation'):
@@ -173,10 +423,9 @@ for annotationURL in annotationURLs:
       continue
 
     # Download the full source manifest if we haven't seen it before
-    if (srcManifest not in maniMappings):
-      manifestData = getURL(srcManifest).json()
-      newMappings = processManifest(manifestData)
-      maniMappings[srcManifest] = newMappings
+    if (srcManifest not in loadedManifests):
+      loadManifest(srcManifest)
+      loadedManifests.add(srcManifest)
 
     tags = []
     for ann in r['resource']:
@@ -194,120 +443,166 @@ for annotationURL in annotationURLs:
     # Often it doesn't resolve to anything -- it's typically just a canvas (?) ID
     canvasID = region['full']
     imageID = canvasID.split('/')[-1].replace('.json','').replace('.tif','').replace('.png','').replace('.jpg','') + ".jpg"
-  
-    if imageID not in imageAnnotations:
-      imageAnnotations[imageID] = []
+
+    canvasImage = canvasIndex.lookup(srcManifest, canvasID)
+    if (canvasImage is None):
+      print("Annotation target not found in its manifest, skipping:", canvasID)
+      continue
 
     # http://marinus.library.ucla.edu/loris/kabuki/ucla_bib1987273_no005_rs_001.tif/full/full/0/default.jpg
-    fullURL = maniMappings[srcManifest][canvasID]['resource']['@id']
-    fullWidth = maniMappings[srcManifest][canvasID]['resource']['width']
-    fullHeight = maniMappings[srcManifest][canvasID]['resource']['height']
-      
-    if (imageID not in trainingImages):
-      resizedURL = fullURL.replace('full/full','full/!1000,1000')
-      imageResponse = getURL(resizedURL)
-      im = Image.open(BytesIO(imageResponse.content))
-      resizedWidth, resizedHeight = im.size
-    
-      outputPath = os.path.join(imagesFolder, imageID)
-
-      with open(outputPath, 'w') as outputFile:
-        print("saving cropped image " + imageID)
-        im.save(outputFile, 'jpeg')
-      
-      trainingImages[imageID] = (resizedWidth, resizedHeight)
+    fullURL, fullWidth, fullHeight = canvasImage[:3]
 
-    else:
-      resizedWidth, resizedHeight = trainingImages[imageID]
-
-    # Format of cropBox: xmin, ymin, xmax, ymax
-    cropBox = (xywh[0], xywh[1], xywh[0] + xywh[2], xywh[1] + xywh[3])
-
-    widthRatio = float(resizedWidth) / float(fullWidth)
-    heightRatio = float(resizedHeight) / float(fullHeight)
-
-    resizedCropBox = (int(float(cropBox[0]) * widthRatio),
-                      int(float(cropBox[1]) * heightRatio),
-                      int(float(cropBox[2]) * widthRatio),
-                      int(float(cropBox[3]) * heightRatio))
-
-    thisAnnotation = {'tags': tags, 'bbox': resizedCropBox} 
-    imageAnnotations[imageID].append(thisAnnotation)
-
-    # This saves all of the training regions in the 'output/' folder
-    if (clipImages):
-      thisTag = reduceTags(tags)
-      # This is how to format a request for the full-res contents of the bbox
-      croppedURL = fullURL.replace('full/full', xywhString + '/full')
-      # NOTE: The version below resizes the cropped image to 1000 pixels on its
-      # longest side; it does not seem to be possible to resize the entire image 
-      # first and THEN crop it (?) using IIIF
-      #croppedURL = resizedURL.replace('full/!1000,1000', xywhString + '/!1000,1000')
-      croppedResponse = getURL(croppedURL)
-      # We could also grab the full image and crop it (or resize and then crop 
-      # it), but it's better to make the image server do the work
-      #croppedImage = im.crop(cropBox)
-    
-      croppedImage = Image.open(BytesIO(croppedResponse.content))
-      croppedImageID = imageID + '.' + xywhString + '_' + thisTag + '.jpg'
-      #resizedWidth, resizedHeight = croppedImage.size
-    
-      croppedPath = os.path.join(outputFolder, croppedImageID)
-
-      with open(croppedPath, 'w') as croppedFile:
-        print("saving cropped image " + croppedImageID)
-        croppedImage.save(croppedFile, 'jpeg')
+    if (imageID not in imageURLs):
+      imageURLs[imageID] = fullURL.replace('full/full','full/!1000,1000')
+
+    # The bounding boxes are rescaled once the resized images are downloaded
+    imageAnnotations.add(imageID, tags, xywh, fullURL, fullWidth, fullHeight)
+
+  if (annotationStream is not None):
+    annotationStream.close()
+
+# Download all of the annotated images at once
+trainingImages.update(fetchImages(imageURLs))
+
+# Images that are only being harvested aren't added to trainingImages
+for imageID in imageURLs:
+  harvestImages.pop(imageID, None)
+if (len(harvestImages) > 0):
+  fetchImages(harvestImages, "harvesting")
+
+imageAnnotations.rescale(trainingImages)
+
+# This saves all of the training regions in the 'output/' folder
+if (clipImages):
+  clipAllRegions(imageAnnotations)
 
 # Generate the output files
+xmlJobs = []
+# Keys: imageID. Values: XML file path and annotation hash, for the journal
+xmlPaths = {}
+xmlHashes = {}
+# One JSON line per image, for the annotation index
+indexLines = []
 for imageID in imageAnnotations:
   resizedWidth, resizedHeight = trainingImages[imageID]
   xmlID = imageID.replace('.jpg', '').replace('.png', '').replace('.tif', '')
-  print("writing XML annotation file " + xmlID)
-  root = etree.Element("annotation")
-  folder = etree.SubElement(root, "folder")
-  folder.text = projectName
-  fn = etree.SubElement(root, "filename")
-  fn.text = xmlID + '.jpg'
-  sz = etree.SubElement(root, "size")
-  wd = etree.SubElement(sz, "width")
-  wd.text = str(resizedWidth)
-  ht = etree.SubElement(sz, "height")
-  ht.text = str(resizedHeight)
-  dp = etree.SubElement(sz, "depth")
-  dp.text = "3" # No alpha channel, watch out for grayscale
-  seg = etree.SubElement(root, "segmented")
-  seg.text = "0"
+  xmlPath = os.path.join(xmlsFolder, xmlID + '.xml')
+  xmlPaths[imageID] = xmlPath
+
+  objects = []
   for anno in imageAnnotations[imageID]:
     for tag in anno["tags"]:
       tag = normalizeTag(tag)
       allTags.add(tag)
-      obj = etree.SubElement(root, "object")
-      name = etree.SubElement(obj, "name") # This is the tag
-      name.text = tag
-      bbox = etree.SubElement(obj, "bndbox")
-      xmi = etree.SubElement(bbox, "xmin")
-      xmi.text = str(anno['bbox'][0])
-      ymi = etree.SubElement(bbox, "ymin")
-      ymi.text = str(anno['bbox'][1])
-      xma = etree.SubElement(bbox, "xmax")
-      xma.text = str(anno['bbox'][2])
-      yma = etree.SubElement(bbox, "ymax")
-      yma.text = str(anno['bbox'][3])
-  
-  xmlPath = os.path.join(xmlsFolder, xmlID + '.xml')
-  with open(xmlPath, 'wb') as xmlFile:
-    et = etree.ElementTree(root)
-    et.write(xmlFile, pretty_print=True)
+      objects.append((tag, anno['bbox']))
+
+  if (writeAnnotationIndex):
+    indexLines.append(json.dumps({'id': xmlID, 'filename': xmlID + '.jpg', 'width': resizedWidth, 'height': resizedHeight,
+                                  'objects': [{'name': name, 'bbox': list(bbox)} for name, bbox in objects]},
+                                 separators=(',', ':')) + "\n")
+
+  if (not writeVOCXML):
+    continue
+
+  if (state is not None):
+    annotationHash = conversion_state.hashAnnotations(trainingImages[imageID], imageAnnotations[imageID])
+    if (not state.outputsChanged(imageID, annotationHash)):
+      continue
+    xmlHashes[imageID] = annotationHash
+
+  print("writing XML annotation file " + xmlID)
+  xmlJobs.append((imageID, (xmlPath, projectName, xmlID + '.jpg', resizedWidth, resizedHeight, objects)))
+
+for writtenImageIDs in voc_xml.writeAnnotationXMLs(xmlJobs, xmlWorkers, xmlChunkSize):
+  if (state is not None):
+    for imageID in writtenImageIDs:
+      state.recordOutputs(imageID, xmlHashes[imageID], [xmlPaths[imageID]])
+
+if (state is not None):
+  # Remove the XML files of images that no longer have any annotations
+  for stalePath in state.dropOutputs(imageAnnotations):
+    if (os.path.isfile(stalePath)):
+      print("removing outdated annotation file " + stalePath)
+      os.remove(stalePath)
 
 trainingListFile = os.path.join(annotationsFolder, 'trainval.txt')
-with open(trainingListFile, 'w') as trainingList:
-  for imageID in trainingImages:
-    baseID = imageID.replace('.png', '').replace('.jpg', '').replace('.tif', '')
-    trainingList.write(baseID + "\n")
+trainingList = ""
+for imageID in trainingImages:
+  # Images whose boxes were all dropped get no annotation file
+  if (imageID not in imageAnnotations):
+    continue
+  baseID = imageID.replace('.png', '').replace('.jpg', '').replace('.tif', '')
+  trainingList += baseID + "\n"
+writeIfChanged(trainingListFile, trainingList)
+
+if (writeAnnotationIndex):
+  writeIfChanged(annotationIndexPath, "".join(indexLines))
+elif (os.path.isfile(annotationIndexPath)):
+  # create_tf_record.py reads the index instead of the XML files whenever
+  # it's there, so one left by an earlier run would hide these annotations
+  print("removing outdated annotation index " + annotationIndexPath)
+  os.remove(annotationIndexPath)
+
+# Keep label IDs stable between runs when there's a conversion journal
+if (state is not None):
+  labelOrder = state.labelOrder(allTags)
+  state.save()
+else:
+  labelOrder = allTags
 
 labelMapFile = os.path.join(os.getcwd(), 'label_map.pbtxt')
-with open(labelMapFile, 'w') as labelMap:
-  tagCount = 1
-  for tag in allTags:
-    labelMap.write("item {\n id: " + str(tagCount) + "\n name: '" + tag + "'\n display_name: '" + tag + "'\n}\n")
-    tagCount += 1
+labelMap = ""
+tagCount = 1
+for tag in labelOrder:
+  labelMap += "item {\n id: " + str(tagCount) + "\n name: '" + tag + "'\n display_name: '" + tag + "'\n}\n"
+  tagCount += 1
+writeIfChanged(labelMapFile, labelMap)
+
+# Returns the image's (tag, bbox) objects
+def imageObjects(imageID):
+  objects = []
+  for anno in imageAnnotations[imageID]:
+    for tag in anno["tags"]:
+      objects.append((normalizeTag(tag), tuple(anno['bbox'])))
+  return objects
+
+# Returns the image's tf.Example proto, with the given objects
+def buildTFExample(imageID, objects):
+  resizedWidth, resizedHeight = trainingImages[imageID]
+  baseID = imageID.replace('.png', '').replace('.jpg', '').replace('.tif', '')
+  # The saved image is byte for byte what the server sent (see saveJPEG)
+  with open(os.path.join(imagesFolder, imageID), 'rb') as imageFile:
+    encodedImage = imageFile.read()
+  return create_tf_record.build_tf_example(baseID + '.jpg', encodedImage, resizedWidth, resizedHeight, objects, labelMapDict)
+
+if (writeTFRecords):
+  # Only needed for this output
+  import create_tf_record
+
+  labelMapDict = {}
+  for labelID, tag in enumerate(labelOrder):
+    labelMapDict[tag] = labelID + 1
+
+  # Same examples, in the same order, as create_tf_record.py would read from
+  # trainval.txt, so the train/val split comes out the same
+  exampleIDs = {}
+  exampleAnnotations = {}
+  imageKeys = {}
+  for imageID in trainingImages:
+    if (imageID in imageAnnotations):
+      baseID = imageID.replace('.png', '').replace('.jpg', '').replace('.tif', '')
+      exampleIDs[baseID] = imageID
+      exampleAnnotations[baseID] = {'object': imageObjects(imageID)}
+      imageKeys[baseID] = create_tf_record.image_key(os.path.join(imagesFolder, imageID))
+
+  # Collapse duplicate images the way create_tf_record.py does, so that no
+  # image is written twice or ends up in both sets
+  examples, mergedAnnotations, duplicates = create_tf_record.dedupe_examples(list(exampleIDs), exampleAnnotations, imageKeys)
+  for baseID in sorted(duplicates):
+    print("merged duplicate images of " + baseID + ": " + ", ".join(duplicates[baseID]))
+  trainExamples, valExamples = create_tf_record.split_examples(examples)
+
+  for split, splitExamples in [('train', trainExamples), ('val', valExamples)]:
+    recordPath = os.path.join(recordsFolder, projectName + '_' + split + '.record')
+    print("writing", len(splitExamples), "examples to " + recordPath)
+    create_tf_record.write_tf_record(recordPath, (buildTFExample(exampleIDs[baseID], mergedAnnotations[baseID]['object']) for baseID in splitExamples))
@@ -0,0 +1,137 @@
+#!/usr/bin/python # Expects Python 3
+from array import array
+
+import numpy as np
+
+# Columnar store for the annotations read by AnnotationConverter. Instead of
+# one dictionary per annotation, the annotations are kept in flat arrays:
+# the image each one belongs to, its full-sized xywh coordinates and its
+# tags (interned as integer IDs, stored as one flat list plus offsets).
+# Per-image data (the full-sized image URL and dimensions) is kept once per
+# image.
+#
+# Once the resized image sizes are known, rescale() converts all of the
+# boxes to the resized coordinates, clamps them to the image bounds and
+# drops any that end up empty, in one vectorized pass. Images left without
+# any boxes are dropped as well.
+#
+# After rescaling, the store can be used like the old imageAnnotations dict:
+# iterating it gives the imageIDs that have annotations, in the order they
+# were first seen, and store[imageID] builds that image's list of
+# {'tags', 'bbox'} dicts on demand.
+
+class AnnotationStore(object):
+
+  def __init__(self):
+    # Per image
+    self.imageIDs = []
+    self.imageIndex = {}
+    self.fullURLs = []
+    self.fullSizes = array('q')
+
+    # Per annotation
+    self.images = array('q')
+    self.xywh = array('q')
+    self.tagOffsets = array('q', [0])
+
+    # Interned tags
+    self.tagIDs = array('q')
+    self.tagNames = []
+    self.tagIndex = {}
+
+    # Filled in by rescale()
+    self.bboxes = None
+    self.kept = None
+    self.imageStarts = None
+    self.imageOrder = None
+    self.emptyImages = set()
+
+  def __len__(self):
+    return len(self.imageIDs) - len(self.emptyImages)
+
+  def __iter__(self):
+    return (imageID for imageID in self.imageIDs if imageID not in self.emptyImages)
+
+  def __contains__(self, imageID):
+    return ((imageID in self.imageIndex) and (imageID not in self.emptyImages))
+
+  def internTag(self, tag):
+    if (tag not in self.tagIndex):
+      self.tagIndex[tag] = len(self.tagNames)
+      self.tagNames.append(tag)
+    return self.tagIndex[tag]
+
+  def add(self, imageID, tags, xywh, fullURL, fullWidth, fullHeight):
+    if (imageID not in self.imageIndex):
+      self.imageIndex[imageID] = len(self.imageIDs)
+      self.imageIDs.append(imageID)
+      self.fullURLs.append(fullURL)
+      self.fullSizes.extend((fullWidth, fullHeight))
+    self.images.append(self.imageIndex[imageID])
+    self.xywh.extend(xywh)
+    for tag in tags:
+      self.tagIDs.append(self.internTag(tag))
+    self.tagOffsets.append(len(self.tagIDs))
+
+  # imageSizes maps imageID to the (width, height) of the resized image
+  def rescale(self, imageSizes):
+    images = np.frombuffer(self.images, dtype=np.int64)
+    xywh = np.frombuffer(self.xywh, dtype=np.int64).reshape(-1, 4)
+    fullSizes = np.frombuffer(self.fullSizes, dtype=np.int64).reshape(-1, 2).astype(np.float64)
+    resizedSizes = np.array([imageSizes[imageID] for imageID in self.imageIDs], dtype=np.int64).reshape(-1, 2)
+
+    # Same arithmetic as float(resized) / float(full) * float(coordinate),
+    # truncated like int()
+    ratios = resizedSizes.astype(np.float64) / fullSizes
+    # Format of cropBox: xmin, ymin, xmax, ymax
+    cropBoxes = np.concatenate([xywh[:, 0:2], xywh[:, 0:2] + xywh[:, 2:4]], axis=1).astype(np.float64)
+    bboxes = np.trunc(cropBoxes * np.tile(ratios[images], 2)).astype(np.int64)
+
+    limits = np.tile(resizedSizes[images], 2)
+    np.clip(bboxes, 0, limits, out=bboxes)
+    self.kept = (bboxes[:, 2] > bboxes[:, 0]) & (bboxes[:, 3] > bboxes[:, 1])
+    self.bboxes = bboxes
+
+    # Group the annotations by image, keeping their original order
+    self.imageOrder = np.argsort(images, kind='stable')
+    self.imageStarts = np.searchsorted(images[self.imageOrder], np.arange(len(self.imageIDs) + 1))
+
+    dropped = int(np.count_nonzero(~self.kept))
+    if (dropped > 0):
+      print("dropped", dropped, "annotations with empty bounding boxes")
+
+    keptCounts = np.bincount(images[self.kept], minlength=len(self.imageIDs))
+    self.emptyImages = set(self.imageIDs[i] for i in np.flatnonzero(keptCounts == 0))
+    if (len(self.emptyImages) > 0):
+      print("dropped", len(self.emptyImages), "images left without any bounding boxes")
+
+  def tags(self, annotationIndex):
+    start = self.tagOffsets[annotationIndex]
+    end = self.tagOffsets[annotationIndex + 1]
+    return [self.tagNames[tagID] for tagID in self.tagIDs[start:end]]
+
+  # Indices of an image's annotations, in the order they were added
+  def annotationIndices(self, imageID):
+    imageIndex = self.imageIndex[imageID]
+    return self.imageOrder[self.imageStarts[imageIndex]:self.imageStarts[imageIndex + 1]]
+
+  def __getitem__(self, imageID):
+    annotations = []
+    for i in self.annotationIndices(imageID):
+      if (self.kept[i]):
+        annotations.append({'tags': self.tags(i), 'bbox': tuple(self.bboxes[i].tolist())})
+    return annotations
+
+  # Returns the full-sized regions of an image's annotations (including any
+  # dropped by rescale()), for clipping
+  def regions(self, imageID):
+    imageIndex = self.imageIndex[imageID]
+    fullWidth, fullHeight = self.fullSizes[2 * imageIndex:2 * imageIndex + 2]
+    regions = []
+    for i in self.annotationIndices(imageID):
+      xywh = list(self.xywh[4 * i:4 * i + 4])
+      regions.append({'tags': self.tags(i), 'xywh': xywh,
+                      'xywhString': ','.join(map(str, xywh)),
+                      'fullURL': self.fullURLs[imageIndex],
+                      'fullWidth': fullWidth, 'fullHeight': fullHeight})
+    return regions
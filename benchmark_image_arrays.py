@@ -0,0 +1,102 @@
+#!/usr/bin/python # Expects Python 3
+import argparse
+from io import BytesIO
+import time
+
+import numpy as np
+from PIL import Image
+
+import face_batching
+import image_arrays
+
+# Measures the per-image cost of the face annotators' decode path, before
+# and after image_arrays.py: decoding the image file, turning it into a
+# uint8 array, and letterboxing it into a batch.
+#
+# Example usage:
+#   python3 benchmark_image_arrays.py page1.jpg page2.jpg
+# or, without any images, with a synthetic 1000px JPEG:
+#   python3 benchmark_image_arrays.py
+
+# The old conversion, from before image_arrays.py
+def getdataToArray(image):
+  (im_width, im_height) = image.size
+  return np.array(image.getdata()).reshape(
+      (im_height, im_width, 3)).astype(np.uint8)
+
+def oldDecode(data):
+  return Image.open(BytesIO(data)).convert('RGB')
+
+def syntheticJPEG(width, height):
+  # Smooth gradients with some noise, so that the JPEG isn't trivially small
+  y, x = np.mgrid[0:height, 0:width]
+  pixels = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+  pixels = pixels + np.random.RandomState(0).randint(0, 32, pixels.shape)
+  out = BytesIO()
+  Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(out, 'jpeg', quality=90)
+  return out.getvalue()
+
+# Returns the fastest of repeats runs of fn over the items, in ms per item
+def timePerItem(fn, items, repeats):
+  best = None
+  for _ in range(repeats):
+    start = time.perf_counter()
+    for item in items:
+      fn(item)
+    seconds = time.perf_counter() - start
+    if ((best is None) or (seconds < best)):
+      best = seconds
+  return best * 1000 / len(items)
+
+def main():
+  parser = argparse.ArgumentParser(description="Times the face annotators' image decode path")
+  parser.add_argument('images', nargs='*', help='image files to time with (default: a synthetic one)')
+  parser.add_argument('--size', type=int, default=1000, help='side of the synthetic image')
+  parser.add_argument('--repeats', type=int, default=3, help='runs of each measurement; the fastest is kept')
+  parser.add_argument('--batch_size', type=int, default=16, help='images per letterboxed batch')
+  parser.add_argument('--bucket_step', type=int, default=200, help='letterbox bucket step')
+  args = parser.parse_args()
+
+  if (len(args.images) > 0):
+    files = []
+    for path in args.images:
+      with open(path, 'rb') as imageFile:
+        files.append(imageFile.read())
+  else:
+    files = [syntheticJPEG(args.size, int(args.size * .75))]
+
+  images = [image_arrays.decodeImage(data) for data in files]
+  arrays = [image_arrays.imageToArray(image) for image in images]
+
+  # Check that the conversions agree before timing them
+  for image, array in zip(images, arrays):
+    assert np.array_equal(getdataToArray(image), array)
+
+  results = []
+  results.append(('decode, old', timePerItem(oldDecode, files, args.repeats)))
+  results.append(('decode, new', timePerItem(image_arrays.decodeImage, files, args.repeats)))
+  results.append(('to array, getdata', timePerItem(getdataToArray, images, args.repeats)))
+  results.append(('to array, tobytes', timePerItem(image_arrays.imageToArray, images, args.repeats)))
+
+  # Letterboxing full batches, with new batch arrays each time or reused ones
+  entries = [(arrays[i % len(arrays)], {}) for i in range(args.batch_size)]
+  batcher = face_batching.LetterboxBatcher(args.batch_size, args.bucket_step)
+  shapes = [batcher.bucketShape(array.shape[0], array.shape[1]) for array in arrays]
+  shape = (max(height for height, _ in shapes), max(width for _, width in shapes))
+  pool = image_arrays.ArrayPool()
+
+  def letterboxPooled(entries):
+    images, _ = face_batching.letterboxBatch(entries, shape, pool)
+    pool.give(images)
+
+  letterboxNew = lambda entries: face_batching.letterboxBatch(entries, shape)
+  results.append(('letterbox, new arrays', timePerItem(letterboxNew, [entries], args.repeats) / args.batch_size))
+  results.append(('letterbox, pooled', timePerItem(letterboxPooled, [entries], args.repeats) / args.batch_size))
+
+  print(len(files), "images,", "sizes", ', '.join(str(image.size[0]) + 'x' + str(image.size[1]) for image in images))
+  print('%-24s %12s' % ('step', 'ms/image'))
+  for name, ms in results:
+    print('%-24s %12.3f' % (name, ms))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,131 @@
+"""Compares TFRecord compression options on a record file.
+
+For each compression type, the records of an existing (uncompressed) record
+file, such as one written by create_tf_record.py, are written to a
+temporary file and read back. The file size and the write and read
+throughput are reported, to help choose a compression type for the storage
+the records are trained from.
+
+Throughput is measured against the uncompressed record bytes. Reads go
+through the page cache, so they show decompression cost rather than
+storage speed: scale the read throughput by the compression ratio to
+estimate reads from storage that is the bottleneck.
+
+The records are held in memory while they are written, so only the first
+--max_mb of a large record file are used (the whole file with
+--max_mb=0).
+
+Example usage:
+    python3 benchmark_tf_record.py --record=edo_illustrations_train.record
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import tfrecord_lite
+
+
+def read_sample(path, max_bytes=None):
+  """Returns the first records of path, up to max_bytes of them if given.
+
+  Records are read until the next one would go over max_bytes, so at most
+  max_bytes are held in memory (but always at least one record).
+  """
+  records = []
+  total_bytes = 0
+  for record in tfrecord_lite.tf_record_iterator(path):
+    if max_bytes and records and total_bytes + len(record) > max_bytes:
+      break
+    records.append(record)
+    total_bytes += len(record)
+  return records
+
+
+def time_write(path, records, compression_type):
+  """Writes records to path and returns the seconds it took."""
+  start = time.perf_counter()
+  with tfrecord_lite.TFRecordWriter(path,
+                                    compression_type=compression_type) as writer:
+    for record in records:
+      writer.write(record)
+  return time.perf_counter() - start
+
+
+def time_read(path, compression_type, verify):
+  """Reads every record of path and returns the seconds it took."""
+  start = time.perf_counter()
+  for _ in tfrecord_lite.tf_record_iterator(path, compression_type, verify):
+    pass
+  return time.perf_counter() - start
+
+
+def benchmark(records, compression_types, repeats=3, verify=True,
+              temp_dir=None):
+  """Benchmarks writing and reading records with each compression type.
+
+  Args:
+    records: List of serialized records.
+    compression_types: Compression types to compare ('' for none).
+    repeats: Number of times to write and read each file; the fastest time
+      is kept.
+    verify: Whether to check the record CRCs while reading.
+    temp_dir: Directory for the temporary files.
+
+  Returns:
+    List of (compression type, file size, write seconds, read seconds).
+  """
+  results = []
+  work_dir = tempfile.mkdtemp(dir=temp_dir)
+  try:
+    for compression_type in compression_types:
+      path = os.path.join(work_dir, 'records-%s' % (compression_type or 'none'))
+      write_seconds = min(time_write(path, records, compression_type)
+                          for _ in range(repeats))
+      read_seconds = min(time_read(path, compression_type, verify)
+                         for _ in range(repeats))
+      results.append((compression_type, os.path.getsize(path), write_seconds,
+                       read_seconds))
+      os.remove(path)
+  finally:
+    shutil.rmtree(work_dir)
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--record', required=True,
+                      help='Uncompressed TFRecord file to benchmark with.')
+  parser.add_argument('--compression_types', default=',GZIP,ZLIB',
+                      help='Comma-separated compression types to compare '
+                      '(an empty one means uncompressed).')
+  parser.add_argument('--max_mb', type=float, default=256,
+                      help='Megabytes of records to benchmark with, from the '
+                      'start of the file (0 for all of them).')
+  parser.add_argument('--repeats', type=int, default=3,
+                      help='Runs of each measurement; the fastest is kept.')
+  parser.add_argument('--no_verify', action='store_true',
+                      help="Don't check record CRCs while reading.")
+  parser.add_argument('--temp_dir', default=None,
+                      help='Where to write the temporary files (put it on the '
+                      'storage being compared).')
+  args = parser.parse_args()
+
+  records = read_sample(args.record, int(args.max_mb * 1e6))
+  raw_bytes = sum(len(record) + 16 for record in records)
+  compression_types = args.compression_types.split(',')
+  print('%d records, %.1f MB uncompressed' % (len(records), raw_bytes / 1e6))
+  print('%-6s %12s %7s %12s %12s' % ('type', 'size', 'ratio', 'write MB/s',
+                                     'read MB/s'))
+  for compression_type, size, write_seconds, read_seconds in benchmark(
+      records, compression_types, args.repeats, not args.no_verify,
+      args.temp_dir):
+    print('%-6s %12d %7.3f %12.1f %12.1f' % (
+        compression_type or 'none', size, float(size) / raw_bytes,
+        raw_bytes / 1e6 / write_seconds, raw_bytes / 1e6 / read_seconds))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,46 @@
+#!/usr/bin/python # Expects Python 3
+import sqlite3
+
+# Persistent index of the canvases in IIIF manifests, kept in SQLite so that
+# a manifest only has to be parsed again when its contents change. For each
+# (manifest, canvas) it stores just what the scripts need: the full-sized
+# image URL, the full image dimensions and the derived imageID. Each manifest
+# also records the SHA-256 of the manifest document it was indexed from.
+
+class CanvasIndex(object):
+
+  def __init__(self, dbPath):
+    self.db = sqlite3.connect(dbPath)
+    self.db.execute('CREATE TABLE IF NOT EXISTS manifests (url TEXT PRIMARY KEY, digest TEXT)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS canvases (manifest TEXT, canvas_id TEXT, image_url TEXT, width INTEGER, height INTEGER, image_id TEXT, PRIMARY KEY (manifest, canvas_id))')
+    self.db.commit()
+
+  def close(self):
+    self.db.close()
+
+  # Returns the digest of the manifest document the canvases were indexed
+  # from, or None if the manifest hasn't been indexed
+  def manifestDigest(self, manifestURL):
+    row = self.db.execute('SELECT digest FROM manifests WHERE url = ?', (manifestURL,)).fetchone()
+    if (row is None):
+      return None
+    return row[0]
+
+  # Replace the indexed canvases of a manifest. canvases is an iterable of
+  # (canvasID, imageURL, width, height, imageID) tuples; if a canvas has
+  # more than one image, the last one is kept.
+  def updateManifest(self, manifestURL, digest, canvases):
+    with self.db:
+      self.db.execute('DELETE FROM canvases WHERE manifest = ?', (manifestURL,))
+      self.db.executemany('INSERT OR REPLACE INTO canvases VALUES (?, ?, ?, ?, ?, ?)',
+                          ((manifestURL,) + tuple(canvas) for canvas in canvases))
+      self.db.execute('INSERT OR REPLACE INTO manifests VALUES (?, ?)', (manifestURL, digest))
+
+  # Returns (imageURL, width, height, imageID) for a canvas, or None
+  def lookup(self, manifestURL, canvasID):
+    return self.db.execute('SELECT image_url, width, height, image_id FROM canvases WHERE manifest = ? AND canvas_id = ?', (manifestURL, canvasID)).fetchone()
+
+  # Yields (canvasID, imageURL, width, height, imageID) for every canvas in a
+  # manifest, in the order they were indexed
+  def canvases(self, manifestURL):
+    return self.db.execute('SELECT canvas_id, image_url, width, height, image_id FROM canvases WHERE manifest = ? ORDER BY rowid', (manifestURL,))
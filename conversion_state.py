@@ -0,0 +1,122 @@
+#!/usr/bin/python # Expects Python 3
+import hashlib
+import json
+import os
+
+from iiif_cache import atomicWrite
+
+# Persistent journal of what AnnotationConverter has already produced, so a
+# re-run only redoes the work for images whose annotations have changed, and
+# a run that crashed partway through picks up where it left off.
+#
+# For each imageID, the journal keeps:
+#   url -- the resized image URL the saved JPEG came from
+#   size -- the saved JPEG's [width, height]
+#   annotationHash -- hash of everything that goes into the image's outputs
+#   outputs -- paths of the output files produced from those annotations
+#
+# It also keeps every label it has seen, in the order they were first seen,
+# so label IDs in label_map.pbtxt stay stable between runs (labels that are
+# no longer used keep their IDs rather than making the later ones shift).
+
+stateVersion = 1
+
+def hashAnnotations(imageSize, annotations):
+  """Hash of an image's size and its (tags, bbox) annotations, in order"""
+  hasher = hashlib.sha256()
+  hasher.update(json.dumps([list(imageSize), [[anno['tags'], list(anno['bbox'])] for anno in annotations]]).encode('utf-8'))
+  return hasher.hexdigest()
+
+class ConversionState(object):
+
+  def __init__(self, path, saveInterval=100):
+    self.path = path
+    # Number of updates between saves; the journal is also saved at the end
+    # of each stage
+    self.saveInterval = saveInterval
+    self.unsaved = 0
+    self.images = {}
+    self.labels = []
+    if (os.path.isfile(path)):
+      try:
+        with open(path, 'r') as stateFile:
+          state = json.load(stateFile)
+        if (state.get('version') == stateVersion):
+          self.images = state['images']
+          self.labels = state['labels']
+          # Written by earlier versions, but never used
+          for entry in self.images.values():
+            entry.pop('sha256', None)
+            entry.pop('annotationIDs', None)
+        else:
+          print("Ignoring conversion state from an older version:", path)
+      except (OSError, ValueError, KeyError):
+        print("Unable to read conversion state, starting over:", path)
+
+  def save(self):
+    state = {'version': stateVersion, 'images': self.images, 'labels': self.labels}
+    atomicWrite(self.path, json.dumps(state).encode('utf-8'))
+    self.unsaved = 0
+
+  def updated(self):
+    self.unsaved += 1
+    if (self.unsaved >= self.saveInterval):
+      self.save()
+
+  def entry(self, imageID):
+    if (imageID not in self.images):
+      self.images[imageID] = {}
+    return self.images[imageID]
+
+  # Returns the recorded (width, height) of an image if it was already saved
+  # to outputPath from the same URL, otherwise None
+  def savedImageSize(self, imageID, url, outputPath):
+    entry = self.images.get(imageID)
+    if ((entry is None) or (entry.get('url') != url) or ('size' not in entry)):
+      return None
+    if (not os.path.isfile(outputPath)):
+      return None
+    return tuple(entry['size'])
+
+  def recordImage(self, imageID, url, imageSize):
+    entry = self.entry(imageID)
+    entry['url'] = url
+    entry['size'] = list(imageSize)
+    self.updated()
+
+  # True if the outputs for an image need to be (re)generated
+  def outputsChanged(self, imageID, annotationHash):
+    entry = self.images.get(imageID)
+    if ((entry is None) or (entry.get('annotationHash') != annotationHash)):
+      return True
+    for outputPath in entry.get('outputs', []):
+      if (not os.path.isfile(outputPath)):
+        return True
+    return False
+
+  def recordOutputs(self, imageID, annotationHash, outputs):
+    entry = self.entry(imageID)
+    entry['annotationHash'] = annotationHash
+    entry['outputs'] = outputs
+    self.updated()
+
+  # Forget the outputs of images that no longer have any annotations,
+  # returning the paths of those outputs
+  def dropOutputs(self, keepImageIDs):
+    stale = []
+    for imageID in self.images:
+      entry = self.images[imageID]
+      if ((imageID not in keepImageIDs) and ('outputs' in entry)):
+        stale.extend(entry['outputs'])
+        del entry['outputs']
+        entry.pop('annotationHash', None)
+    return stale
+
+  # Returns every label seen so far, in a stable order: previously seen
+  # labels keep their positions (even if they're no longer used), and new
+  # ones are added at the end
+  def labelOrder(self, tags):
+    for tag in sorted(tags):
+      if (tag not in self.labels):
+        self.labels.append(tag)
+    return list(self.labels)
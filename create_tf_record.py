@@ -25,28 +25,29 @@ See: O. M. Parkhi, A. Vedaldi, A. Zisserman, C. V. Jawahar
 Example usage:
     ./create_tf_record --data_dir=/home/user/pet \
         --output_dir=/home/user/pet/output
+
+With --num_shards or --incremental, each TFRecord file is written as shards
+named <file>-NNNNN; point the training input at <file>* to read them all.
 """
 
+import argparse
 import hashlib
 import io
+import json
 import logging
+import mmap
+import multiprocessing
 import os
-import random
 import re
 
 from lxml import etree
 import PIL.Image
-import tensorflow as tf
 
-from utils import dataset_util
-from utils import label_map_util
+from iiif_cache import atomicWrite
+import jpeg_header
+import tfrecord_lite
 
-flags = tf.app.flags
-flags.DEFINE_string('data_dir', '', 'Root directory to raw dataset.')
-flags.DEFINE_string('output_dir', '', 'Path to directory to output TFRecords.')
-flags.DEFINE_string('label_map_path', '',
-                    'Path to label map proto')
-FLAGS = flags.FLAGS
+FLAGS = None
 
 # Sample usage:
 # python3 create_tf_record.py --data_dir=/home/broadwell/tensorflow/iiif-annotation-converter/ --output_dir=. --label_map_path=data/label_map.pbtxt
@@ -65,42 +66,273 @@ def get_class_name_from_filename(file_name):
   return match.groups()[0]
 
 
+def read_examples_list(path):
+  """Read list of training or validation examples.
+
+  The file is assumed to contain a single example per line where the first
+  token in the line is an identifier that allows us to find the image and
+  annotation xml for that example.
+
+  Args:
+    path: absolute path to examples list file.
+
+  Returns:
+    list of example identifiers (strings).
+  """
+  with open(path) as fid:
+    lines = fid.readlines()
+  return [line.strip().split(' ')[0] for line in lines]
+
+
+def recursive_parse_xml_to_dict(xml):
+  """Recursively parses XML contents to python dict.
+
+  We assume that `object` tags are the only ones that can appear
+  multiple times at the same level of a tree.
+
+  Args:
+    xml: xml tree obtained by parsing XML file contents using lxml.etree
+
+  Returns:
+    Python dictionary holding XML contents.
+  """
+  if not len(xml):
+    return {xml.tag: xml.text}
+  result = {}
+  for child in xml:
+    child_result = recursive_parse_xml_to_dict(child)
+    if child.tag != 'object':
+      result[child.tag] = child_result[child.tag]
+    else:
+      if child.tag not in result:
+        result[child.tag] = []
+      result[child.tag].append(child_result[child.tag])
+  return {xml.tag: result}
+
+
+def read_annotation_index(path):
+  """Reads the annotation index written by AnnotationConverter.
+
+  The index is a JSON Lines file with one line per image, holding the same
+  fields as the image's PASCAL VOC XML file, so that all of the annotations
+  can be loaded with one sequential read instead of one XML parse per image.
+
+  Args:
+    path: Path to the annotations.jsonl file.
+
+  Returns:
+    A dictionary mapping example ids to dicts in the same form as
+    recursive_parse_xml_to_dict(xml)['annotation'].
+  """
+  annotation_index = {}
+  with open(path, encoding='utf8') as fid:
+    for line in fid:
+      entry = json.loads(line)
+      annotation_index[entry['id']] = {
+          'filename': entry['filename'],
+          'size': {'width': entry['width'], 'height': entry['height']},
+          'object': [{'name': obj['name'],
+                      'bndbox': dict(zip(('xmin', 'ymin', 'xmax', 'ymax'),
+                                         obj['bbox']))}
+                     for obj in entry['objects']],
+      }
+  return annotation_index
+
+
+_QUOTED = r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*\""""
+_LABEL_MAP_ITEM = re.compile(r"""item\s*\{((?:[^}'"]|%s)*)\}""" % _QUOTED)
+_LABEL_MAP_FIELD = re.compile(r"""(\w+)\s*:\s*(%s|-?\d+)""" % _QUOTED)
+
+
+def read_xml_annotation(annotations_dir, example):
+  """Reads the PASCAL VOC XML file of one example.
+
+  Args:
+    annotations_dir: Directory where annotation files are stored.
+    example: The example id.
+
+  Returns:
+    The annotation dict (see recursive_parse_xml_to_dict), or None if the
+    example has no XML file.
+  """
+  path = os.path.join(annotations_dir, 'xmls', example + '.xml')
+
+  if not os.path.exists(path):
+    logging.warning('Could not find %s, ignoring example.', path)
+    return None
+  with open(path, 'rb') as fid:
+    xml_str = fid.read()
+  xml = etree.fromstring(xml_str)
+  return recursive_parse_xml_to_dict(xml)['annotation']
+
+
+def get_label_map_dict(label_map_path):
+  """Reads a label map and returns a dictionary of label names to id.
+
+  Only the part of the StringIntLabelMap text format that label maps
+  actually use is understood: item { id: ... name: ... display_name: ... }.
+
+  Args:
+    label_map_path: path to label_map.
+
+  Returns:
+    A dictionary mapping label names to id.
+  """
+  with open(label_map_path, encoding='utf8') as fid:
+    label_map = fid.read()
+  label_map_dict = {}
+  for item in _LABEL_MAP_ITEM.finditer(label_map):
+    fields = {}
+    for name, value in _LABEL_MAP_FIELD.findall(item.group(1)):
+      if value[0] in '\'"':
+        value = re.sub(r'\\(.)', r'\1', value[1:-1])
+      fields[name] = value
+    label_map_dict[fields['name']] = int(fields['id'])
+  return label_map_dict
+
+
+def normalize_image(encoded_jpg, max_image_side=0, jpeg_quality=0):
+  """Downscales and/or recompresses a JPEG image.
+
+  Args:
+    encoded_jpg: The JPEG-encoded image (bytes, memoryview or mmap).
+    max_image_side: Longest side to downscale the image to, or 0 to keep
+      its size.
+    jpeg_quality: JPEG quality to recompress the image at, or 0 to only
+      recompress downscaled images (at quality 95).
+
+  Returns:
+    (encoded_jpg, width, height) of the normalized image, or None if the
+    original is better kept: when it doesn't need downscaling, and
+    recompressing it wouldn't make it smaller.
+  """
+  image = PIL.Image.open(io.BytesIO(encoded_jpg))
+  width, height = image.size
+  scale = 1.0
+  if max_image_side and max(width, height) > max_image_side:
+    scale = float(max_image_side) / max(width, height)
+  elif not jpeg_quality:
+    return None
+
+  if scale < 1.0:
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    # Let the JPEG decoder do most of the downscaling
+    image.draft(image.mode, size)
+    image = image.resize(size, PIL.Image.LANCZOS)
+  if image.mode not in ('RGB', 'L'):
+    image = image.convert('RGB')
+  output = io.BytesIO()
+  image.save(output, 'JPEG', quality=jpeg_quality or 95)
+  if scale == 1.0 and output.tell() >= len(encoded_jpg):
+    return None
+  return (output.getvalue(),) + image.size
+
+
 def dict_to_tf_example(data,
                        label_map_dict,
                        image_subdirectory,
-                       ignore_difficult_instances=False):
+                       ignore_difficult_instances=False,
+                       max_image_side=0,
+                       jpeg_quality=0):
   """Convert XML derived dict to tf.Example proto.
 
   Notice that this function normalizes the bounding box coordinates provided
   by the raw data.
 
+  Unless the image is to be downscaled or recompressed, it's never decoded:
+  it's memory-mapped where possible, and only its JPEG markers and frame
+  header are checked, against the size in the XML. The mapped bytes are
+  hashed and serialized without further copies.
+
   Args:
     data: dict holding PASCAL XML fields for a single image (obtained by
-      running dataset_util.recursive_parse_xml_to_dict)
+      running recursive_parse_xml_to_dict)
     label_map_dict: A map from string label names to integers ids.
     image_subdirectory: String specifying subdirectory within the
       Pascal dataset directory holding the actual image data.
     ignore_difficult_instances: Whether to skip difficult instances in the
       dataset  (default: False).
+    max_image_side: If nonzero, images with a longer side are downscaled
+      to it (see normalize_image).
+    jpeg_quality: If nonzero, images are recompressed at this JPEG quality.
 
   Returns:
-    example: The converted tf.Example.
+    example: The serialized tf.Example.
 
   Raises:
-    ValueError: if the image pointed to by data['filename'] is not a valid JPEG
+    ValueError: if the image pointed to by data['filename'] is not a valid JPEG,
+      or its size doesn't match the size in data
   """
   img_path = os.path.join(image_subdirectory, data['filename'])
-  with tf.gfile.GFile(img_path, 'rb') as fid:
-    encoded_jpg= fid.read()
-  encoded_jpg_io = io.BytesIO(encoded_jpg)
-  image = PIL.Image.open(encoded_jpg_io)
-  #print("Image format is " + image.format)
-  if image.format != 'JPEG':
+  with open(img_path, 'rb') as fid:
+    try:
+      encoded_jpg = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+      # Empty files can't be mapped (nor can files on some file systems)
+      encoded_jpg = fid.read()
+  try:
+    return _dict_to_tf_example(data, label_map_dict, encoded_jpg,
+                               max_image_side, jpeg_quality)
+  finally:
+    if isinstance(encoded_jpg, mmap.mmap):
+      encoded_jpg.close()
+
+
+def _dict_to_tf_example(data, label_map_dict, encoded_jpg, max_image_side,
+                        jpeg_quality):
+  image_size = jpeg_header.jpegSize(encoded_jpg)
+  if image_size is None:
     raise ValueError('Image format not JPEG')
-  key = hashlib.sha256(encoded_jpg).hexdigest()
 
   width = int(data['size']['width'])
   height = int(data['size']['height'])
+  if image_size != (width, height):
+    raise ValueError('Image %s is %dx%d, but its annotations are for %dx%d' %
+                     ((data['filename'],) + image_size + (width, height)))
+
+  objects = []
+  # recursive_parse_xml_to_dict leaves 'object' out if there are none
+  for obj in data.get('object', []):
+    #difficult = bool(int(obj['difficult']))
+    #if ignore_difficult_instances and difficult:
+    #  continue
+    #class_name="person"
+    #class_name = get_class_name_from_filename(data['filename'])
+    class_name = str(obj['name'])
+    objects.append((class_name, (obj['bndbox']['xmin'], obj['bndbox']['ymin'],
+                                 obj['bndbox']['xmax'], obj['bndbox']['ymax'])))
+
+  image_size = None
+  if max_image_side or jpeg_quality:
+    normalized = normalize_image(encoded_jpg, max_image_side, jpeg_quality)
+    if normalized is not None:
+      encoded_jpg = normalized[0]
+      image_size = normalized[1:]
+
+  return build_tf_example(data['filename'], encoded_jpg, width, height,
+                          objects, label_map_dict, image_size)
+
+
+def build_tf_example(filename, encoded_jpg, width, height, objects,
+                     label_map_dict, image_size=None):
+  """Build a serialized tf.Example for one image and its bounding boxes.
+
+  Args:
+    filename: The image file name, stored as the filename and source id.
+    encoded_jpg: The JPEG-encoded image (bytes, memoryview or mmap).
+    width: Width of the image in pixels.
+    height: Height of the image in pixels.
+    objects: List of (class name, (xmin, ymin, xmax, ymax)) tuples, with the
+      box coordinates in pixels.
+    label_map_dict: A map from string label names to integers ids.
+    image_size: (width, height) of encoded_jpg, if it was resized from the
+      width and height the boxes are for. The boxes are stored normalized,
+      so they don't change.
+
+  Returns:
+    example: The serialized tf.Example (see tfrecord_lite.serialize_example).
+  """
+  key = hashlib.sha256(encoded_jpg).hexdigest()
 
   xmin = []
   ymin = []
@@ -111,20 +343,13 @@ def dict_to_tf_example(data,
   truncated = []
   poses = []
   difficult_obj = []
-  for obj in data['object']:
-    #difficult = bool(int(obj['difficult']))
-    #if ignore_difficult_instances and difficult:
-    #  continue
-
+  for class_name, bbox in objects:
     difficult_obj.append(0)
 
-    xmin.append(float(obj['bndbox']['xmin']) / width)
-    ymin.append(float(obj['bndbox']['ymin']) / height)
-    xmax.append(float(obj['bndbox']['xmax']) / width)
-    ymax.append(float(obj['bndbox']['ymax']) / height)
-    #class_name="person"
-    #class_name = get_class_name_from_filename(data['filename'])
-    class_name = str(obj['name'])
+    xmin.append(float(bbox[0]) / width)
+    ymin.append(float(bbox[1]) / height)
+    xmax.append(float(bbox[2]) / width)
+    ymax.append(float(bbox[3]) / height)
     classes_text.append(class_name.encode('utf8'))
     classes.append(label_map_dict[class_name])
     #truncated.append(int(obj['truncated']))
@@ -132,92 +357,486 @@ def dict_to_tf_example(data,
     poses.append('None'.encode('utf8'))
     #poses.append(obj['pose'].encode('utf8'))
 
-  example = tf.train.Example(features=tf.train.Features(feature={
-      'image/height': dataset_util.int64_feature(height),
-      'image/width': dataset_util.int64_feature(width),
-      'image/filename': dataset_util.bytes_feature(
-          data['filename'].encode('utf8')),
-      'image/source_id': dataset_util.bytes_feature(
-          data['filename'].encode('utf8')),
-      'image/key/sha256': dataset_util.bytes_feature(key.encode('utf8')),
-      'image/encoded': dataset_util.bytes_feature(encoded_jpg),
-      'image/format': dataset_util.bytes_feature('jpg'.encode('utf8')),
-      'image/object/bbox/xmin': dataset_util.float_list_feature(xmin),
-      'image/object/bbox/xmax': dataset_util.float_list_feature(xmax),
-      'image/object/bbox/ymin': dataset_util.float_list_feature(ymin),
-      'image/object/bbox/ymax': dataset_util.float_list_feature(ymax),
-      'image/object/class/text': dataset_util.bytes_list_feature(classes_text),
-      'image/object/class/label': dataset_util.int64_list_feature(classes),
-      'image/object/difficult': dataset_util.int64_list_feature(difficult_obj),
-      'image/object/truncated': dataset_util.int64_list_feature(truncated),
-      'image/object/view': dataset_util.bytes_list_feature(poses),
-  }))
-  return example
+  if image_size is not None:
+    width, height = image_size
+
+  return tfrecord_lite.serialize_example({
+      'image/height': tfrecord_lite.int64_feature(height),
+      'image/width': tfrecord_lite.int64_feature(width),
+      'image/filename': tfrecord_lite.bytes_feature(
+          filename.encode('utf8')),
+      'image/source_id': tfrecord_lite.bytes_feature(
+          filename.encode('utf8')),
+      'image/key/sha256': tfrecord_lite.bytes_feature(key.encode('utf8')),
+      'image/encoded': tfrecord_lite.bytes_feature(encoded_jpg),
+      'image/format': tfrecord_lite.bytes_feature('jpg'.encode('utf8')),
+      'image/object/bbox/xmin': tfrecord_lite.float_list_feature(xmin),
+      'image/object/bbox/xmax': tfrecord_lite.float_list_feature(xmax),
+      'image/object/bbox/ymin': tfrecord_lite.float_list_feature(ymin),
+      'image/object/bbox/ymax': tfrecord_lite.float_list_feature(ymax),
+      'image/object/class/text': tfrecord_lite.bytes_list_feature(classes_text),
+      'image/object/class/label': tfrecord_lite.int64_list_feature(classes),
+      'image/object/difficult': tfrecord_lite.int64_list_feature(difficult_obj),
+      'image/object/truncated': tfrecord_lite.int64_list_feature(truncated),
+      'image/object/view': tfrecord_lite.bytes_list_feature(poses),
+  })
+
+
+def write_tf_record(output_filename, tf_examples, compression_type=None):
+  """Writes serialized tf.Examples to a TFRecord file and its index.
+
+  Args:
+    output_filename: Path to where output file is saved.
+    tf_examples: Iterable of serialized tf.Examples.
+    compression_type: '' (or None), 'GZIP' or 'ZLIB'.
+  """
+  with tfrecord_lite.TFRecordWriter(output_filename, index=True,
+                                    compression_type=compression_type) as writer:
+    for tf_example in tf_examples:
+      writer.write(tf_example)
+
+
+def image_key(image_path):
+  """Returns the SHA-256 of an image file, as stored in image/key/sha256."""
+  sha256 = hashlib.sha256()
+  with open(image_path, 'rb') as fid:
+    for chunk in iter(lambda: fid.read(1 << 20), b''):
+      sha256.update(chunk)
+  return sha256.hexdigest()
+
+
+def dedupe_examples(examples_list, annotations, image_keys, preferred=()):
+  """Collapses examples whose images are identical.
+
+  Canvases that appear in more than one manifest (or images harvested
+  twice) would otherwise be written more than once, and could end up in
+  both the training and validation sets. The first example with each image
+  is kept, and the objects of the others are merged into it (leaving out
+  any it already has). A preferred example is kept over the others with
+  its image wherever it is in the list.
+
+  Args:
+    examples_list: List of example ids.
+    annotations: A dictionary mapping example ids to annotation dicts (see
+      recursive_parse_xml_to_dict). Examples without one are left out.
+    image_keys: A dictionary mapping example ids to image SHA-256 keys.
+    preferred: Example ids to keep ahead of the others, such as the ones
+      already written by an incremental build.
+
+  Returns:
+    examples: List of the kept example ids, in their original order.
+    merged: A dictionary mapping the kept example ids to their (merged)
+      annotation dicts.
+    duplicates: A dictionary mapping each kept example id that had
+      duplicates to the list of their ids.
+  """
+  examples = []
+  merged = {}
+  duplicates = {}
+  kept_by_key = {}
+  for example in examples_list:
+    if example in preferred and example in annotations:
+      kept_by_key.setdefault(image_keys[example], example)
+  for example in examples_list:
+    if example not in annotations:
+      continue
+    data = annotations[example]
+    key = image_keys[example]
+    kept = kept_by_key.setdefault(key, example)
+    if kept not in merged:
+      kept_data = annotations[kept]
+      merged[kept] = dict(kept_data, object=list(kept_data.get('object', [])))
+    if kept == example:
+      examples.append(example)
+      continue
+    duplicates.setdefault(kept, []).append(example)
+    kept_objects = merged[kept]['object']
+    for obj in data.get('object', []):
+      if obj not in kept_objects:
+        kept_objects.append(obj)
+  return examples, merged, duplicates
+
+
+def example_hash(example):
+  """Returns a stable pseudo-random number in [0, 1) for an example id."""
+  digest = hashlib.sha256(example.encode('utf8')).digest()
+  return int.from_bytes(digest[:8], 'big') / float(1 << 64)
+
+
+def split_examples(examples_list, train_fraction=0.7):
+  """Splits examples into training and validation sets.
+
+  Test images are not included in the downloaded data set, so we perform
+  our own 70/30 split. Each example is assigned by a hash of its id, so
+  adding or removing examples never moves any of the others to the other
+  set. Both sets are ordered by the same hash, as a fixed shuffle.
+
+  Args:
+    examples_list: List of example ids.
+    train_fraction: Expected fraction of the examples used for training.
+
+  Returns:
+    train_examples: List of training example ids.
+    val_examples: List of validation example ids.
+  """
+  hashes = dict((example, example_hash(example)) for example in examples_list)
+  ordered = sorted(hashes, key=hashes.get)
+  return ([example for example in ordered if hashes[example] < train_fraction],
+          [example for example in ordered if hashes[example] >= train_fraction])
 
 
 def create_tf_record(output_filename,
                      label_map_dict,
                      annotations_dir,
                      image_dir,
-                     examples):
+                     examples,
+                     annotation_index=None,
+                     max_image_side=0,
+                     jpeg_quality=0,
+                     compression_type=None):
   """Creates a TFRecord file from examples.
 
+  A sidecar index of the records (see tfrecord_lite.IndexedTFRecordReader)
+  is written next to it.
+
   Args:
     output_filename: Path to where output file is saved.
     label_map_dict: The label map dictionary.
     annotations_dir: Directory where annotation files are stored.
     image_dir: Directory where image files are stored.
     examples: Examples to parse and save to tf record.
+    annotation_index: Optional dictionary of example annotations (see
+      read_annotation_index), used instead of the per-image XML files.
+    max_image_side: If nonzero, images with a longer side are downscaled
+      to it (see normalize_image).
+    jpeg_quality: If nonzero, images are recompressed at this JPEG quality.
+    compression_type: Record compression, '' (or None), 'GZIP' or 'ZLIB'.
+
+  Returns:
+    List of the example ids written (missing examples are skipped).
   """
-  writer = tf.python_io.TFRecordWriter(output_filename)
+  written = []
+  writer = tfrecord_lite.TFRecordWriter(output_filename, index=True,
+                                        compression_type=compression_type)
   for idx, example in enumerate(examples):
     if idx % 100 == 0:
       logging.info('On image %d of %d', idx, len(examples))
-    path = os.path.join(annotations_dir, 'xmls', example + '.xml')
+    if annotation_index is not None:
+      if example not in annotation_index:
+        logging.warning('Could not find %s in the annotation index, '
+                        'ignoring example.', example)
+        continue
+      data = annotation_index[example]
+    else:
+      data = read_xml_annotation(annotations_dir, example)
+      if data is None:
+        continue
+
+    tf_example = dict_to_tf_example(data, label_map_dict, image_dir,
+                                    max_image_side=max_image_side,
+                                    jpeg_quality=jpeg_quality)
+    writer.write(tf_example)
+    written.append(example)
 
-    if not os.path.exists(path):
-      logging.warning('Could not find %s, ignoring example.', path)
-      continue
-    with tf.gfile.GFile(path, 'r') as fid:
-      xml_str = fid.read()
-    xml = etree.fromstring(xml_str)
-    data = dataset_util.recursive_parse_xml_to_dict(xml)['annotation']
+  writer.close()
+  return written
 
-    tf_example = dict_to_tf_example(data, label_map_dict, image_dir)
-    writer.write(tf_example.SerializeToString())
 
-  writer.close()
+def shard_output_path(output_filename, shard_number, num_shards=None):
+  """Returns the path of one shard of a TFRecord file.
+
+  Shards are named output_filename-NNNNN whether a full build writes them or
+  an incremental build appends them, so output_filename* matches every
+  shard of a set. A full build with a single shard (num_shards=1) keeps the
+  unsharded file name.
+  """
+  if num_shards == 1:
+    return output_filename
+  return '%s-%05d' % (output_filename, shard_number)
+
+
+def shard_examples(output_filename,
+                   label_map_dict,
+                   annotations_dir,
+                   image_dir,
+                   examples,
+                   num_shards=1,
+                   annotation_index=None,
+                   first_shard=None,
+                   max_image_side=0,
+                   jpeg_quality=0,
+                   compression_type=None):
+  """Splits the examples for one TFRecord file into shards.
+
+  Each shard holds a contiguous slice of the examples and is written to
+  output_filename-NNNNN (see shard_output_path). Shards appended to an
+  existing set (when first_shard is given) are numbered on from there, and
+  no empty shards are made.
+
+  Args:
+    output_filename: Path to where output files are saved.
+    label_map_dict: The label map dictionary.
+    annotations_dir: Directory where annotation files are stored.
+    image_dir: Directory where image files are stored.
+    examples: Examples to parse and save to tf record.
+    num_shards: Number of shards to write.
+    annotation_index: Optional dictionary of example annotations (see
+      read_annotation_index). Each shard is given just its own examples.
+    first_shard: Number of the first appended shard, or None to write a
+      complete set of shards.
+    max_image_side: Longest image side, passed on to create_tf_record().
+    jpeg_quality: JPEG quality, passed on to create_tf_record().
+    compression_type: Record compression, passed on to create_tf_record().
+
+  Returns:
+    List of create_tf_record() argument tuples, one per shard.
+  """
+  if first_shard is not None:
+    num_shards = min(num_shards, len(examples))
+  shards = []
+  for shard_index in range(num_shards):
+    start = shard_index * len(examples) // num_shards
+    end = (shard_index + 1) * len(examples) // num_shards
+    shard = examples[start:end]
+    shard_index_dict = None
+    if annotation_index is not None:
+      shard_index_dict = {example: annotation_index[example]
+                          for example in shard if example in annotation_index}
+    if first_shard is not None:
+      shard_path = shard_output_path(output_filename, first_shard + shard_index)
+    else:
+      shard_path = shard_output_path(output_filename, shard_index, num_shards)
+    shards.append((shard_path, label_map_dict, annotations_dir, image_dir,
+                   shard, shard_index_dict, max_image_side, jpeg_quality,
+                   compression_type))
+  return shards
+
+
+def _create_tf_record_shard(args):
+  return args[0], create_tf_record(*args)
+
+
+def create_tf_record_shards(shards, num_workers=1):
+  """Writes TFRecord shards, each one in its own worker process.
+
+  Args:
+    shards: List of create_tf_record() argument tuples (see shard_examples).
+    num_workers: Number of worker processes.
+
+  Returns:
+    A dictionary mapping each shard's path to the example ids written to it.
+  """
+  if num_workers <= 1 or len(shards) <= 1:
+    return dict(_create_tf_record_shard(shard) for shard in shards)
+  written = {}
+  with multiprocessing.Pool(min(num_workers, len(shards))) as pool:
+    for shard_path, examples in pool.imap_unordered(_create_tf_record_shard,
+                                                    shards):
+      logging.info('Wrote %s', shard_path)
+      written[shard_path] = examples
+  return written
+
+
+RECORD_STATE_VERSION = 1
+
+
+def read_record_state(state_path):
+  """Reads which examples earlier builds wrote to which shards.
+
+  Args:
+    state_path: Path to the record state file.
+
+  Returns:
+    A dictionary mapping each split ('train' and 'val') to a list of
+    {'path': shard file name, 'compression_type': its compression,
+    'examples': example ids} dicts, in the order the shards were written.
+    Empty if there's no usable state file.
+  """
+  if not os.path.exists(state_path):
+    return {}
+  with open(state_path) as fid:
+    state = json.load(fid)
+  if state.get('version') != RECORD_STATE_VERSION:
+    logging.warning('Ignoring %s, written by a different version.', state_path)
+    return {}
+  return state['splits']
+
+
+def write_record_state(state_path, splits):
+  """Writes the record state (see read_record_state) atomically."""
+  state = {'version': RECORD_STATE_VERSION, 'splits': splits}
+  atomicWrite(os.path.abspath(state_path), json.dumps(state).encode('utf8'))
 
 
 # TODO: Add test for pet/PASCAL main files.
-def main(_):
+def main():
   data_dir = FLAGS.data_dir
   #label_map_dict = {'person': 1}
-  label_map_dict = label_map_util.get_label_map_dict(FLAGS.label_map_path)
+  label_map_dict = get_label_map_dict(FLAGS.label_map_path)
 
   logging.info('Reading from dataset.')
   image_dir = os.path.join(data_dir, 'images')
   annotations_dir = os.path.join(data_dir, 'annotations')
   examples_path = os.path.join(annotations_dir, 'trainval.txt')
-  examples_list = dataset_util.read_examples_list(examples_path)
+  examples_list = read_examples_list(examples_path)
+
+  # Read every image's annotations at once if AnnotationConverter wrote an
+  # index, rather than parsing one XML file per image
+  annotation_index = None
+  annotation_index_path = os.path.join(annotations_dir, 'annotations.jsonl')
+  if os.path.exists(annotation_index_path):
+    logging.info('Reading annotations from %s', annotation_index_path)
+    annotation_index = read_annotation_index(annotation_index_path)
+
+  # An incremental build only appends shards holding the examples that
+  # earlier builds haven't written; a full build replaces all of them
+  state_path = os.path.join(FLAGS.output_dir, 'edo_illustrations_records.json')
+  previous_state = read_record_state(state_path)
+  written_examples = set()
+  if FLAGS.incremental:
+    written_examples = set(example for split_state in previous_state.values()
+                           for shard in split_state
+                           for example in shard['examples'])
+
+  # Collapse duplicate images before the split, so that no image is written
+  # twice or ends up in both sets
+  if not FLAGS.keep_duplicates:
+    if annotation_index is None:
+      annotation_index = {}
+      for example in examples_list:
+        data = read_xml_annotation(annotations_dir, example)
+        if data is not None:
+          annotation_index[example] = data
+    annotated = [example for example in examples_list
+                 if example in annotation_index]
+    image_paths = [os.path.join(image_dir, annotation_index[example]['filename'])
+                   for example in annotated]
+    with multiprocessing.Pool(FLAGS.num_workers or
+                              multiprocessing.cpu_count()) as pool:
+      image_keys = dict(zip(annotated,
+                            pool.map(image_key, image_paths, chunksize=64)))
+    # Examples that are already written stay as they are, so a duplicate
+    # of one can only be dropped if it adds no objects to it
+    examples_list, merged, duplicates = dedupe_examples(
+        examples_list, annotation_index, image_keys, written_examples)
+    for example, example_duplicates in sorted(duplicates.items()):
+      if example not in written_examples:
+        logging.info('Merged duplicate images of %s: %s', example,
+                     ', '.join(example_duplicates))
+        continue
+      new_duplicates = [duplicate for duplicate in example_duplicates
+                        if duplicate not in written_examples]
+      written_objects = annotation_index[example].get('object', [])
+      for duplicate in new_duplicates:
+        for obj in annotation_index[duplicate].get('object', []):
+          if obj not in written_objects:
+            raise ValueError('%s adds objects to the already written example '
+                             '%s; rebuild without --incremental to merge '
+                             'them.' % (duplicate, example))
+      if new_duplicates:
+        logging.info('Skipped duplicate images of the already written %s: %s',
+                     example, ', '.join(new_duplicates))
+    annotation_index = merged
+    logging.info('Collapsed %d duplicate images into %d examples.',
+                 sum(len(dupes) for dupes in duplicates.values()),
+                 len(duplicates))
 
   # Test images are not included in the downloaded data set, so we shall perform
   # our own split.
-  random.seed(42)
-  random.shuffle(examples_list)
-  num_examples = len(examples_list)
-  num_train = int(0.7 * num_examples)
-  train_examples = examples_list[:num_train]
-  val_examples = examples_list[num_train:]
+  train_examples, val_examples = split_examples(examples_list)
   logging.info('%d training and %d validation examples.',
                len(train_examples), len(val_examples))
 
-  train_output_path = os.path.join(FLAGS.output_dir, 'edo_illustrations_train.record')
-  val_output_path = os.path.join(FLAGS.output_dir, 'edo_illustrations_val.record')
-  create_tf_record(train_output_path, label_map_dict, annotations_dir,
-                   image_dir, train_examples)
-  create_tf_record(val_output_path, label_map_dict, annotations_dir,
-                   image_dir, val_examples)
+  record_state = {}
+  shards = []
+  for split, examples in (('train', train_examples), ('val', val_examples)):
+    output_path = os.path.join(FLAGS.output_dir,
+                               'edo_illustrations_%s.record' % split)
+    first_shard = None
+    record_state[split] = []
+    if FLAGS.incremental:
+      record_state[split] = previous_state.get(split, [])
+      first_shard = len(record_state[split])
+      # Shards from before the compression type was recorded are uncompressed
+      for shard in record_state[split]:
+        if shard.get('compression_type', '') != FLAGS.compression_type:
+          raise ValueError('%s was written with compression type %r, not %r; '
+                           'rebuild without --incremental to change it.' %
+                           (shard['path'], shard.get('compression_type', ''),
+                            FLAGS.compression_type))
+      written = set(example for shard in record_state[split]
+                    for example in shard['examples'])
+      removed = len(written.difference(examples))
+      if removed:
+        logging.warning('%d %s examples are no longer listed but stay in '
+                        'their shards; rebuild without --incremental to drop '
+                        'them.', removed, split)
+      examples = [example for example in examples if example not in written]
+      logging.info('Appending %d %s examples.', len(examples), split)
+    split_shards = shard_examples(output_path, label_map_dict,
+                                  annotations_dir, image_dir, examples,
+                                  FLAGS.num_shards, annotation_index,
+                                  first_shard, FLAGS.max_image_side,
+                                  FLAGS.jpeg_quality, FLAGS.compression_type)
+    record_state[split].extend(
+        {'path': os.path.basename(shard[0]),
+         'compression_type': FLAGS.compression_type}
+        for shard in split_shards)
+    shards.extend(split_shards)
+
+  written = create_tf_record_shards(
+      shards, FLAGS.num_workers or multiprocessing.cpu_count())
+  for split_state in record_state.values():
+    for shard in split_state:
+      shard_path = os.path.join(FLAGS.output_dir, shard['path'])
+      if shard_path in written:
+        shard['examples'] = written[shard_path]
+
+  # Remove the shards of earlier builds that this one replaced, and the
+  # indexes that older versions wrote next to the shards (where the shards'
+  # input pattern matches them)
+  kept = set(shard['path'] for split_state in record_state.values()
+             for shard in split_state)
+  for split_state in list(previous_state.values()) + list(record_state.values()):
+    for shard in split_state:
+      shard_path = os.path.join(FLAGS.output_dir, shard['path'])
+      stale = [shard_path + '.index']
+      if shard['path'] not in kept:
+        stale += [shard_path, tfrecord_lite.index_path(shard_path)]
+      for path in stale:
+        if os.path.exists(path):
+          logging.info('Removing %s', path)
+          os.remove(path)
+  write_record_state(state_path, record_state)
 
 if __name__ == '__main__':
-  tf.app.run()
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--data_dir', default='',
+                      help='Root directory to raw dataset.')
+  parser.add_argument('--output_dir', default='',
+                      help='Path to directory to output TFRecords.')
+  parser.add_argument('--label_map_path', default='',
+                      help='Path to label map proto')
+  parser.add_argument('--num_shards', type=int, default=1,
+                      help='Number of shards to split each TFRecord file into.')
+  parser.add_argument('--num_workers', type=int, default=0,
+                      help='Number of worker processes building the shards '
+                      '(0 for one per CPU).')
+  parser.add_argument('--max_image_side', type=int, default=0,
+                      help='Downscale images whose longest side is bigger '
+                      'than this (0 to keep their size).')
+  parser.add_argument('--jpeg_quality', type=int, default=0,
+                      help='Recompress images at this JPEG quality (0 to '
+                      'only recompress downscaled images, at 95).')
+  parser.add_argument('--compression_type', default='',
+                      choices=tfrecord_lite.COMPRESSION_TYPES,
+                      help='Compression of the TFRecord files.')
+  parser.add_argument('--keep_duplicates', action='store_true',
+                      help='Write every example, even when several have the '
+                      'same image.')
+  parser.add_argument('--incremental', action='store_true',
+                      help='Append shards for new examples only, leaving the '
+                      'shards of earlier builds as they are.')
+  FLAGS = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+  main()
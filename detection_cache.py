@@ -0,0 +1,93 @@
+#!/usr/bin/python # Expects Python 3
+import hashlib
+import json
+import os
+import threading
+from importlib.metadata import PackageNotFoundError, version
+
+from iiif_cache import atomicWrite, hashBytes
+
+# Persistent cache of the faces found in each image, so that re-running the
+# face annotators (say, after a change to the annotation or curation output
+# format) only runs face detection, by far their slowest step, on images
+# that are new or have changed.
+#
+# Faces are cached under a key made from the SHA-256 of the image's bytes,
+# the number of times it was upsampled, the detection model, any other
+# settings the caller says change the faces found (such as how batched
+# images are letterboxed), the installed face_recognition and dlib versions
+# and codeVersion. Change any of those and the images are detected again;
+# entries for other settings stay in the file, so switching back and forth
+# doesn't lose them.
+
+stateVersion = 1
+
+# Bump this when a change to the annotators' detection code (such as the
+# letterboxing in face_batching.py) changes the faces it finds
+codeVersion = 1
+
+def libraryVersions():
+  versions = []
+  for package in ['face_recognition', 'dlib']:
+    try:
+      versions.append(package + ' ' + version(package))
+    except PackageNotFoundError:
+      versions.append(package + ' unknown')
+  return versions
+
+# The hash to key an image by: cached responses (see iiif_cache.py) already
+# know theirs
+def imageHash(response):
+  digest = getattr(response, 'digest', None)
+  if (digest is None):
+    digest = hashBytes(response.content)
+  return digest
+
+class DetectionCache(object):
+
+  # settings: a dict of any other settings that change the faces found
+  def __init__(self, path, upsample, model, settings=None, saveInterval=100):
+    self.path = path
+    # Number of new entries between saves; call save() at the end as well
+    self.saveInterval = saveInterval
+    self.unsaved = 0
+    # Detection runs in other threads in some of the annotators' modes
+    self.lock = threading.Lock()
+    self.settings = json.dumps([upsample, model, settings or {}, codeVersion] + libraryVersions(), sort_keys=True)
+    self.faces = {}
+    if (os.path.isfile(path)):
+      try:
+        with open(path, 'r') as cacheFile:
+          state = json.load(cacheFile)
+        if (state.get('version') == stateVersion):
+          self.faces = state['faces']
+        else:
+          print("Ignoring detection cache from an older version:", path)
+      except (OSError, ValueError, KeyError):
+        print("Unable to read detection cache, starting over:", path)
+
+  def key(self, imageHash):
+    return hashlib.sha256((imageHash + self.settings).encode('utf-8')).hexdigest()
+
+  # Returns the cached faces, as (top, right, bottom, left) tuples, or None
+  # if the image hasn't been detected with these settings
+  def get(self, imageHash):
+    with self.lock:
+      faces = self.faces.get(self.key(imageHash))
+    if (faces is None):
+      return None
+    return [tuple(face) for face in faces]
+
+  def put(self, imageHash, faces):
+    with self.lock:
+      self.faces[self.key(imageHash)] = [list(map(int, face)) for face in faces]
+      self.unsaved += 1
+      if (self.unsaved < self.saveInterval):
+        return
+    self.save()
+
+  def save(self):
+    with self.lock:
+      state = {'version': stateVersion, 'faces': self.faces}
+      atomicWrite(self.path, json.dumps(state).encode('utf-8'))
+      self.unsaved = 0
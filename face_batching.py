@@ -0,0 +1,106 @@
+#!/usr/bin/python # Expects Python 3
+import numpy as np
+
+# Groups images into batches for face_recognition's batch_face_locations,
+# which needs every image in a batch to have the same shape. IIIF
+# derivatives such as !1000,1000 come in many slightly different shapes, so
+# binning them by their exact size leaves most batches nearly empty. Instead,
+# each image is letterboxed (centered on a black canvas) into a shape bucket
+# whose sides are its own rounded up to a multiple of bucketStep, so that a
+# handful of buckets cover all of the images.
+#
+# A batch is an (images, metadata) pair: a (count, height, width, 3) uint8
+# array and a list of the images' metadata dicts. Each dict gets 'pad_top'
+# and 'pad_left', the offsets of the image within the batch shape, which
+# unletterbox() uses to map detections back onto the image.
+#
+# With an image_arrays.ArrayPool, the batch arrays are reused: hand each
+# batch back with release() once nothing refers to its images any more.
+
+class LetterboxBatcher(object):
+
+  def __init__(self, batchSize, bucketStep=200, pool=None):
+    self.batchSize = batchSize
+    self.bucketStep = bucketStep
+    self.pool = pool
+    # Keys: (height, width) of a bucket. Values: lists of (image, metadata)
+    self.buckets = {}
+
+  def bucketShape(self, height, width):
+    step = self.bucketStep
+    return (-(-height // step) * step, -(-width // step) * step)
+
+  # Add an image (a height x width x 3 array). Returns a full batch if this
+  # image completes one, otherwise None.
+  def add(self, image, metadata):
+    shape = self.bucketShape(image.shape[0], image.shape[1])
+    bucket = self.buckets.setdefault(shape, [])
+    bucket.append((image, metadata))
+    if (len(bucket) >= self.batchSize):
+      del self.buckets[shape]
+      return letterboxBatch(bucket, shape, self.pool)
+    return None
+
+  # Returns batches of all of the images still waiting. Partly filled
+  # buckets are merged (into the largest of their shapes), so only the last
+  # batch can be smaller than batchSize.
+  def flush(self):
+    waiting = []
+    for shape in sorted(self.buckets):
+      waiting.extend(self.buckets[shape])
+    self.buckets = {}
+    batches = []
+    for start in range(0, len(waiting), self.batchSize):
+      chunk = waiting[start:start + self.batchSize]
+      shapes = [self.bucketShape(image.shape[0], image.shape[1]) for image, _ in chunk]
+      shape = (max(height for height, _ in shapes), max(width for _, width in shapes))
+      batches.append(letterboxBatch(chunk, shape, self.pool))
+    return batches
+
+  # Give a batch's images array back to the pool, if there is one
+  def release(self, images):
+    if (self.pool is not None):
+      self.pool.give(images)
+
+# Center each image of a list of (image, metadata) on a black canvas of the
+# given (height, width). The batch array comes from pool if given, in which
+# case only its padding is cleared, as the images overwrite the rest.
+def letterboxBatch(entries, shape, pool=None):
+  height, width = shape
+  if (pool is None):
+    images = np.zeros((len(entries), height, width, 3), dtype=np.uint8)
+  else:
+    images = pool.take((len(entries), height, width, 3))
+  metadata = []
+  for i, (image, imageMetadata) in enumerate(entries):
+    imageHeight, imageWidth = image.shape[:2]
+    top = (height - imageHeight) // 2
+    left = (width - imageWidth) // 2
+    bottom = top + imageHeight
+    right = left + imageWidth
+    if (pool is not None):
+      images[i, :top] = 0
+      images[i, bottom:] = 0
+      images[i, top:bottom, :left] = 0
+      images[i, top:bottom, right:] = 0
+    images[i, top:bottom, left:right] = image
+    metadata.append(dict(imageMetadata, pad_top=top, pad_left=left))
+  return images, metadata
+
+# Map a face location (top, right, bottom, left) found in a letterboxed
+# image back onto the image (metadata holds its 'width' and 'height'),
+# clipped to its bounds. Returns None if the face lies in the padding.
+def unletterbox(face, metadata):
+  top = min(max(face[0] - metadata['pad_top'], 0), metadata['height'])
+  right = min(max(face[1] - metadata['pad_left'], 0), metadata['width'])
+  bottom = min(max(face[2] - metadata['pad_top'], 0), metadata['height'])
+  left = min(max(face[3] - metadata['pad_left'], 0), metadata['width'])
+  if ((bottom <= top) or (right <= left)):
+    return None
+  return (top, right, bottom, left)
+
+# Returns one image of a batch without its letterbox padding
+def unpaddedImage(images, i, metadata):
+  top = metadata['pad_top']
+  left = metadata['pad_left']
+  return images[i, top:top + metadata['height'], left:left + metadata['width']]
@@ -0,0 +1,193 @@
+#!/usr/bin/python # Expects Python 3
+import queue
+import threading
+
+# A staged pipeline for the face annotators:
+#
+#   jobs -> fetch threads -> detection (the calling thread) -> writer thread
+#
+# fetchWorkers threads call fetch(job) for each job (to get the image info,
+# download the image and decode it) and queue the results for detection,
+# which the calling thread iterates over with decoded(). It hands each
+# job's detections to done(), and the writer thread calls write(job, result)
+# for every job, in the order of the jobs, whatever order they were fetched
+# and detected in. Jobs that fetch() returns None for (failed downloads, or
+# jobs that are only there to be written, such as the start of a manifest)
+# go straight to the writer, with a result of None.
+#
+# The decoded queue holds at most maxDecoded images, and at most maxInFlight
+# jobs can be past the producer but not yet written, which bounds how many
+# decoded images are held in memory whichever stage is the slowest.
+#
+# A detector that holds on to decoded images (to fill its batches) can stall
+# the pipeline: once every in-flight job is either held by it or waiting to be
+# written after one that is, no more images will come until it hands some of
+# them to done(). decoded(stalls=True) yields None when, and only when, that
+# happens, so whether it flushes doesn't depend on how long fetches take.
+#
+# If write() raises, the pipeline is cancelled: no more jobs are started or
+# fetched, the jobs already under way are drained, and the error is raised
+# from decoded() and finish() in the calling thread.
+
+_finished = object()
+_stalled = object()
+
+class Pipeline(object):
+
+  def __init__(self, fetch, write, fetchWorkers=4, maxDecoded=8, maxInFlight=64):
+    self.fetch = fetch
+    self.write = write
+    self.fetchWorkers = fetchWorkers
+    self.jobQueue = queue.Queue(2 * fetchWorkers)
+    self.decodedQueue = queue.Queue(maxDecoded)
+    self.writeQueue = queue.Queue()
+    self.maxInFlight = maxInFlight
+    # The lock guards the counts that stalled() looks at
+    self.lock = threading.Lock()
+    self.slotFreed = threading.Condition(self.lock)
+    self.inFlight = 0
+    self.producerWaiting = False
+    # Jobs handed to the fetch threads that haven't reached decoded() or done()
+    self.fetching = 0
+    # Seqs yielded by decoded() that haven't been handed to done()
+    self.held = set()
+    # The next seq to be written
+    self.nextSeq = 0
+    self.stallSignalled = False
+    self.writeError = None
+    self.writer = None
+
+  def start(self, jobs):
+    threading.Thread(target=self.produce, args=(jobs,), daemon=True).start()
+    for _ in range(self.fetchWorkers):
+      threading.Thread(target=self.fetchLoop, daemon=True).start()
+    self.writer = threading.Thread(target=self.writeLoop, daemon=True)
+    self.writer.start()
+
+  def produce(self, jobs):
+    jobCount = 0
+    try:
+      for job in jobs:
+        with self.lock:
+          while (self.inFlight >= self.maxInFlight):
+            self.producerWaiting = True
+            self.signalIfStalled()
+            self.slotFreed.wait()
+          self.producerWaiting = False
+          if (self.writeError is not None):
+            break
+          self.inFlight += 1
+          self.fetching += 1
+        self.jobQueue.put((jobCount, job))
+        jobCount += 1
+    finally:
+      for _ in range(self.fetchWorkers):
+        self.jobQueue.put(_finished)
+      self.writeQueue.put((_finished, jobCount, None))
+
+  def fetchLoop(self):
+    while True:
+      item = self.jobQueue.get()
+      if (item is _finished):
+        self.decodedQueue.put(_finished)
+        return
+      seq, job = item
+      result = None
+      # Once cancelled, just hand the job to the writer to be drained
+      if (self.writeError is None):
+        try:
+          result = self.fetch(job)
+        except Exception as error:
+          print("error fetching", job, error)
+      if (result is None):
+        with self.lock:
+          self.fetching -= 1
+          self.signalIfStalled()
+        self.done(seq, job, None)
+      else:
+        self.decodedQueue.put((seq, job, result))
+
+  # Yields (seq, job, decoded) for each fetched job, as they're decoded.
+  # With stalls, also yields None whenever no more images can come until
+  # some of the jobs already yielded are handed to done() (so that a batching
+  # detector can flush its partly filled batches). Raises the writer's error
+  # if writing fails.
+  def decoded(self, stalls=False):
+    finishedWorkers = 0
+    while (finishedWorkers < self.fetchWorkers):
+      if (stalls):
+        with self.lock:
+          stalled = self.stalled()
+        if (stalled):
+          self.checkError()
+          yield None
+          continue
+      item = self.decodedQueue.get()
+      self.checkError()
+      if (item is _stalled):
+        # Checked again at the top of the loop
+        with self.lock:
+          self.stallSignalled = False
+        continue
+      if (item is _finished):
+        finishedWorkers += 1
+        continue
+      with self.lock:
+        self.fetching -= 1
+        self.held.add(item[0])
+      yield item
+
+  # Call with the lock held. The pipeline is stalled if the producer is
+  # waiting for an in-flight slot, nothing is being fetched, and the writer
+  # is waiting for a job that decoded() has yielded.
+  def stalled(self):
+    return (self.producerWaiting and (self.fetching == 0) and (self.nextSeq in self.held))
+
+  # Call with the lock held, after changing anything stalled() looks at.
+  # Wakes decoded() up if the pipeline has stalled. Since the pipeline is
+  # empty apart from this marker, the put can't block.
+  def signalIfStalled(self):
+    if (self.stalled() and not self.stallSignalled):
+      self.stallSignalled = True
+      self.decodedQueue.put(_stalled)
+
+  def checkError(self):
+    if (self.writeError is not None):
+      raise self.writeError
+
+  # Hand a job's result on to the writer
+  def done(self, seq, job, result):
+    with self.lock:
+      self.held.discard(seq)
+    self.writeQueue.put((seq, job, result))
+
+  def writeLoop(self):
+    pending = {}
+    nextSeq = 0
+    jobCount = None
+    while ((jobCount is None) or (nextSeq < jobCount)):
+      seq, job, result = self.writeQueue.get()
+      if (seq is _finished):
+        jobCount = job
+        continue
+      pending[seq] = (job, result)
+      while (nextSeq in pending):
+        job, result = pending.pop(nextSeq)
+        # After an error, keep draining (while the other stages wind down)
+        # so that none of them is left blocked on the in-flight limit
+        if (self.writeError is None):
+          try:
+            self.write(job, result)
+          except Exception as error:
+            self.writeError = error
+        nextSeq += 1
+        with self.lock:
+          self.inFlight -= 1
+          self.nextSeq = nextSeq
+          self.slotFreed.notify()
+          self.signalIfStalled()
+
+  # Wait for every job to be written
+  def finish(self):
+    self.writer.join()
+    self.checkError()
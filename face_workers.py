@@ -0,0 +1,121 @@
+#!/usr/bin/python # Expects Python 3
+import multiprocessing
+import queue
+import threading
+
+import face_recognition
+
+# Face detection in a pool of worker processes, so that HOG and CPU CNN
+# detection (which run on one core per image) scale with the number of
+# cores.
+#
+# dlib doesn't cope with being forked once it has loaded its models (or
+# started its threads), so the workers are started with the 'spawn' method:
+# each one is a fresh interpreter that imports this module, and so loads its
+# own copy of face_recognition's models. A spawned worker also imports the
+# script that started it (as __mp_main__), so scripts using the pool need to
+# keep their main code under an "if __name__ == '__main__':" guard.
+#
+# Images go to the workers on a shared queue, as the workers become free,
+# and a collector thread hands each image's faces to handle(context, faces)
+# as they come back, in whatever order the workers finish them. The face
+# annotators' writer (see face_pipeline.py) puts them back in manifest
+# order. If detection fails on an image, faces is None. If handle() raises,
+# the remaining results are drained without it, and the error is raised from
+# submit() and close().
+
+# Runs in each worker process
+def detectFaces(tasks, results, upsample, model):
+  while True:
+    task = tasks.get()
+    if (task is None):
+      return
+    taskID, image = task
+    try:
+      faces = face_recognition.face_locations(image, number_of_times_to_upsample=upsample, model=model)
+    except Exception as error:
+      results.put((taskID, None, repr(error)))
+      continue
+    results.put((taskID, faces, None))
+
+class DetectorPool(object):
+
+  def __init__(self, workers, handle, upsample=1, model='hog', maxQueued=None):
+    context = multiprocessing.get_context('spawn')
+    self.handle = handle
+    # Bounded, so that submit() blocks (and the images back up in the
+    # pipeline's bounded queues) when the workers are all busy
+    self.tasks = context.Queue(maxQueued or 2 * workers)
+    self.results = context.Queue()
+    # Keys: task IDs. Values: the contexts they were submitted with
+    self.pending = {}
+    self.lock = threading.Lock()
+    self.nextID = 0
+    self.error = None
+    self.closing = False
+    self.processes = []
+    for _ in range(workers):
+      process = context.Process(target=detectFaces, args=(self.tasks, self.results, upsample, model), daemon=True)
+      process.start()
+      self.processes.append(process)
+    self.collector = threading.Thread(target=self.collect, daemon=True)
+    self.collector.start()
+
+  # Queue an image (a height x width x 3 uint8 array) for detection. Blocks
+  # while the queue is full.
+  def submit(self, image, context):
+    with self.lock:
+      taskID = self.nextID
+      self.nextID += 1
+      self.pending[taskID] = context
+    while True:
+      self.checkError()
+      try:
+        self.tasks.put((taskID, image), timeout=1)
+        return
+      except queue.Full:
+        pass
+
+  def checkError(self):
+    if (self.error is not None):
+      raise self.error
+
+  def collect(self):
+    while True:
+      try:
+        taskID, faces, error = self.results.get(timeout=1)
+      except queue.Empty:
+        # A worker that died (rather than being told to stop) took its image
+        # with it, so the pool can't finish
+        for process in self.processes:
+          if (process.exitcode not in (None, 0)):
+            self.error = RuntimeError("face detection worker exited with code " + str(process.exitcode))
+            return
+        with self.lock:
+          if (self.closing and (len(self.pending) == 0)):
+            return
+        continue
+      with self.lock:
+        context = self.pending.pop(taskID)
+      if (self.error is not None):
+        continue
+      if (error is not None):
+        print("error detecting faces", error)
+      try:
+        self.handle(context, faces)
+      except Exception as handleError:
+        self.error = handleError
+
+  # Wait for every submitted image to be handled, then stop the workers
+  def close(self):
+    with self.lock:
+      self.closing = True
+    self.collector.join()
+    if (self.error is not None):
+      for process in self.processes:
+        process.terminate()
+      raise self.error
+    for _ in self.processes:
+      self.tasks.put(None)
+    for process in self.processes:
+      process.join()
@@ -0,0 +1,364 @@
+#!/usr/bin/python # Expects Python 3
+import hashlib
+from io import BytesIO
+import json
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+
+# Content-addressed disk cache for the responses fetched by the IIIF scripts
+# (manifests, info.json documents, annotation lists and images).
+#
+# Layout of the cache folder:
+#
+# objects/ab/abcdef... -- raw response bodies, named by the SHA-256 of the bytes,
+#                         so the same image fetched via two URLs is stored once
+# urls/12/123456....json -- one small header record per URL, named by the SHA-256
+#                           of the URL, pointing at the body object
+#
+# The modification time of a header record is bumped whenever it's read, so
+# when the cache grows past its byte budget the least recently used URLs are
+# evicted first (along with any body objects that nothing points to anymore).
+#
+# Cached responses hold their body object open from the moment they're looked
+# up, so that an eviction by another thread can't delete it before it's read
+# (an open file can still be read after it's deleted).
+#
+# Older versions of the scripts pickled whole requests.Response objects into
+# cache/<slugify(url)>; importPickleCache() moves those into the new layout,
+# and moves any it can't read into cache/unimported/.
+
+# Only these response headers are kept in the header records
+keptHeaders = ['Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'Date', 'Expires']
+
+# When the budget is exceeded, evict down to this fraction of it so that
+# eviction doesn't run again on every write
+evictionTarget = .9
+
+class CachedResponse(object):
+  """The parts of requests.Response that the scripts use, read from the cache"""
+
+  def __init__(self, url, content, status_code=200, headers=None, contentPath=None, digest=None, contentFile=None):
+    self.url = url
+    # If content is None, the body is only read from contentFile (or
+    # contentPath) when it's first used, so callers that stream the file
+    # never load it all at once
+    self._content = content
+    self.contentFile = contentFile
+    self.status_code = status_code
+    self.headers = headers or {}
+    # Path to the body object on disk, for callers that want to stream it
+    self.contentPath = contentPath
+    # SHA-256 of the body, for callers that want to tell whether it changed
+    self.digest = digest
+
+  @property
+  def content(self):
+    if (self._content is None):
+      with self.openContent() as objectFile:
+        self._content = objectFile.read()
+    return self._content
+
+  # Returns a binary file object for the body, for callers that stream it
+  def openContent(self):
+    if (self._content is not None):
+      return BytesIO(self._content)
+    if (self.contentFile is not None):
+      objectFile = self.contentFile
+      self.contentFile = None
+      return objectFile
+    return open(self.contentPath, 'rb')
+
+  # Like requests.Response.close(), for responses whose body isn't read
+  def close(self):
+    if (self.contentFile is not None):
+      self.contentFile.close()
+      self.contentFile = None
+
+  @property
+  def ok(self):
+    return (self.status_code < 400)
+
+  @property
+  def text(self):
+    return self.content.decode('utf-8')
+
+  def json(self):
+    return json.loads(self.content)
+
+def keepHeaders(headers):
+  keptValues = {}
+  if (headers is not None):
+    for header in keptHeaders:
+      if (header in headers):
+        keptValues[header] = headers[header]
+  return keptValues
+
+def hashBytes(data):
+  return hashlib.sha256(data).hexdigest()
+
+def shardedPath(folder, digest, suffix=''):
+  return os.path.join(folder, digest[:2], digest + suffix)
+
+# The mode open() gives new files. mkstemp() makes its files readable by
+# their owner only, so files written through it are given this mode instead,
+# to keep caches and outputs shared with other users (as the umask allows).
+# Read once, as reading the umask means briefly changing it.
+def umaskedFileMode():
+  umask = os.umask(0)
+  os.umask(umask)
+  return 0o666 & ~umask
+
+newFileMode = umaskedFileMode()
+
+def atomicWrite(filePath, data):
+  folder = os.path.dirname(filePath)
+  if (not os.path.exists(folder)):
+    os.makedirs(folder, exist_ok=True)
+  fd, tempPath = tempfile.mkstemp(dir=folder, prefix='.tmp-')
+  try:
+    os.chmod(tempPath, newFileMode)
+    with os.fdopen(fd, 'wb') as tempFile:
+      tempFile.write(data)
+    os.replace(tempPath, filePath)
+  except:
+    if (os.path.exists(tempPath)):
+      os.remove(tempPath)
+    raise
+
+class DiskCache(object):
+
+  def __init__(self, path, maxBytes=None):
+    self.path = path
+    self.maxBytes = maxBytes
+    self.objectsFolder = os.path.join(path, 'objects')
+    self.urlsFolder = os.path.join(path, 'urls')
+    for folder in [self.path, self.objectsFolder, self.urlsFolder]:
+      if (not os.path.exists(folder)):
+        os.makedirs(folder, exist_ok=True)
+    self.lock = threading.Lock()
+    # Total size of the body objects, computed on the first write
+    self.totalBytes = None
+
+  def recordPath(self, url):
+    return shardedPath(self.urlsFolder, hashBytes(url.encode('utf-8')), '.json')
+
+  def objectPath(self, digest):
+    return shardedPath(self.objectsFolder, digest)
+
+  def getRecord(self, url):
+    recordPath = self.recordPath(url)
+    try:
+      with open(recordPath, 'r') as recordFile:
+        record = json.load(recordFile)
+    except (OSError, ValueError):
+      return None
+    if (record.get('url') != url):
+      return None
+    try:
+      # Mark as recently used
+      os.utime(recordPath, None)
+    except OSError:
+      pass
+    return record
+
+  def get(self, url):
+    with self.lock:
+      record = self.getRecord(url)
+      if (record is None):
+        return None
+      objectPath = self.objectPath(record['object'])
+      try:
+        objectFile = open(objectPath, 'rb')
+      except FileNotFoundError:
+        return None
+    return CachedResponse(url, None, record['status'], record['headers'], objectPath, record['object'], objectFile)
+
+  def put(self, url, content, status=200, headers=None):
+    digest = hashBytes(content)
+    objectPath = self.objectPath(digest)
+    keptValues = keepHeaders(headers)
+
+    with self.lock:
+      if (not os.path.isfile(objectPath)):
+        atomicWrite(objectPath, content)
+        self.addBytes(len(content))
+      self.storeRecord(url, status, keptValues, digest, len(content))
+
+    return CachedResponse(url, content, status, keptValues, objectPath, digest)
+
+  # Like put(), but the body is written to disk chunk by chunk as it arrives
+  # (e.g. from requests' iter_content()) rather than being held in memory.
+  # The returned response reads the body back from disk only if asked to.
+  def putStream(self, url, chunks, status=200, headers=None):
+    hasher = hashlib.sha256()
+    size = 0
+    fd, tempPath = tempfile.mkstemp(dir=self.objectsFolder, prefix='.tmp-')
+    try:
+      os.chmod(tempPath, newFileMode)
+      with os.fdopen(fd, 'wb') as tempFile:
+        for chunk in chunks:
+          hasher.update(chunk)
+          tempFile.write(chunk)
+          size += len(chunk)
+    except:
+      os.remove(tempPath)
+      raise
+    digest = hasher.hexdigest()
+    objectPath = self.objectPath(digest)
+    keptValues = keepHeaders(headers)
+
+    with self.lock:
+      if (os.path.isfile(objectPath)):
+        os.remove(tempPath)
+      else:
+        os.makedirs(os.path.dirname(objectPath), exist_ok=True)
+        os.replace(tempPath, objectPath)
+        self.addBytes(size)
+      # Before storeRecord(), which may evict it
+      objectFile = open(objectPath, 'rb')
+      self.storeRecord(url, status, keptValues, digest, size)
+
+    return CachedResponse(url, None, status, keptValues, objectPath, digest, objectFile)
+
+  # Called with self.lock held
+  def addBytes(self, size):
+    if (self.totalBytes is None):
+      self.totalBytes = self.measure()
+    else:
+      self.totalBytes += size
+
+  # Called with self.lock held
+  def storeRecord(self, url, status, headers, digest, size):
+    record = {'url': url, 'status': status, 'headers': headers,
+              'object': digest, 'size': size, 'stored': time.time()}
+    atomicWrite(self.recordPath(url), json.dumps(record).encode('utf-8'))
+
+    if ((self.maxBytes is not None) and (self.totalBytes is not None) and (self.totalBytes > self.maxBytes)):
+      self.evict()
+
+  # Update the header record of a cached URL after the server has confirmed
+  # (with a 304 Not Modified) that the cached body is still current
+  def refresh(self, url, headers):
+    with self.lock:
+      record = self.getRecord(url)
+      if (record is None):
+        return
+      for header in keptHeaders:
+        if (header in headers):
+          record['headers'][header] = headers[header]
+      record['stored'] = time.time()
+      atomicWrite(self.recordPath(url), json.dumps(record).encode('utf-8'))
+
+  def measure(self):
+    totalBytes = 0
+    for folder, subfolders, files in os.walk(self.objectsFolder):
+      for fileName in files:
+        if (not fileName.startswith('.tmp-')):
+          totalBytes += os.path.getsize(os.path.join(folder, fileName))
+    return totalBytes
+
+  # Remove the least recently used URLs until the bodies fit in the budget.
+  # Called with self.lock held.
+  def evict(self):
+    records = []
+    objectRefs = {}
+    for folder, subfolders, files in os.walk(self.urlsFolder):
+      for fileName in files:
+        if (fileName.startswith('.tmp-')):
+          continue
+        recordPath = os.path.join(folder, fileName)
+        try:
+          with open(recordPath, 'r') as recordFile:
+            digest = json.load(recordFile)['object']
+          lastUsed = os.path.getmtime(recordPath)
+        except (OSError, ValueError, KeyError):
+          continue
+        records.append((lastUsed, recordPath, digest))
+        objectRefs[digest] = objectRefs.get(digest, 0) + 1
+
+    records.sort()
+    targetBytes = int(self.maxBytes * evictionTarget)
+    for lastUsed, recordPath, digest in records:
+      if (self.totalBytes <= targetBytes):
+        break
+      os.remove(recordPath)
+      objectRefs[digest] -= 1
+      if (objectRefs[digest] == 0):
+        objectPath = self.objectPath(digest)
+        if (os.path.isfile(objectPath)):
+          objectSize = os.path.getsize(objectPath)
+          try:
+            os.remove(objectPath)
+          except OSError as e:
+            # Windows doesn't delete files that are open
+            print("unable to evict " + objectPath + ":", e)
+            continue
+          self.totalBytes -= objectSize
+    print("cache evicted down to", self.totalBytes, "bytes")
+
+  # Import the pickled requests.Response files left in the top level of the
+  # cache folder by older versions of the scripts. The pickle file names are
+  # slugs of the requested URL, which can't be reversed, so the URL is taken
+  # from the response itself (preferring whichever candidate slugifies back
+  # to the file name). Returns the number of responses imported.
+  def importPickleCache(self, pickleFolder=None, removeImported=True):
+    from slugify import slugify
+    if (pickleFolder is None):
+      pickleFolder = self.path
+    imported = 0
+    for fileName in sorted(os.listdir(pickleFolder)):
+      filePath = os.path.join(pickleFolder, fileName)
+      if (not os.path.isfile(filePath)):
+        continue
+      try:
+        with open(filePath, 'rb') as pickleFile:
+          response = pickle.load(pickleFile)
+        candidates = [h.url for h in response.history] + [response.request.url, response.url]
+      except Exception as e:
+        print("unable to import cached file " + fileName + ":", e)
+        # Moved aside, so that it isn't tried again on every run
+        if (removeImported):
+          unimportedFolder = os.path.join(pickleFolder, 'unimported')
+          os.makedirs(unimportedFolder, exist_ok=True)
+          os.replace(filePath, os.path.join(unimportedFolder, fileName))
+        continue
+      url = response.url
+      for candidate in candidates:
+        if (slugify(candidate) == fileName):
+          url = candidate
+          break
+      self.put(url, response.content, response.status_code, response.headers)
+      imported += 1
+      if (removeImported):
+        os.remove(filePath)
+    print("imported", imported, "responses from pickle cache", pickleFolder)
+    return imported
+
+  def hasPickleCache(self, pickleFolder=None):
+    if (pickleFolder is None):
+      pickleFolder = self.path
+    for fileName in os.listdir(pickleFolder):
+      if (os.path.isfile(os.path.join(pickleFolder, fileName))):
+        return True
+    return False
+
+# Usage: python3 iiif_cache.py [cache folder] [max bytes]
+# Migrates an old pickle cache in place and applies the byte budget, if any
+if __name__ == '__main__':
+  cacheFolder = os.path.join(os.getcwd(), 'cache/')
+  maxBytes = None
+  if (len(sys.argv) > 1):
+    cacheFolder = sys.argv[1]
+  if (len(sys.argv) > 2):
+    maxBytes = int(sys.argv[2])
+  cache = DiskCache(cacheFolder, maxBytes)
+  cache.importPickleCache()
+  if (maxBytes is not None):
+    cache.totalBytes = cache.measure()
+    if (cache.totalBytes > maxBytes):
+      with cache.lock:
+        cache.evict()
@@ -1,4 +1,3 @@
-import numpy as np
 import os
 import sys
 import json
@@ -6,13 +5,11 @@ import uuid
 
 import face_recognition
 
-from io import StringIO
-from PIL import Image
-
-from io import BytesIO
-import pickle
-import requests
-from slugify import slugify
+import iiif_cache
+import iiif_http
+import face_pipeline
+import detection_cache
+import image_arrays
 
 from time import sleep
 
@@ -25,11 +22,29 @@ writeAnnotations = True
 
 UPSAMPLE = 2
 
+# Images are downloaded and decoded by fetchWorkers threads while the face
+# detection runs. At most maxDecodedImages decoded images wait for detection,
+# and at most maxImagesInFlight images are between download and being written.
+fetchWorkers = 4
+maxDecodedImages = 8
+maxImagesInFlight = 64
+
+# Set to True to keep the faces found in each image (see detection_cache.py),
+# so that re-runs only detect faces in new or changed images
+detectionCacheEnabled = True
+detectionCachePath = os.path.join(os.getcwd(), 'face_detections.json')
+
 # Set to True to write images of detected faces to a folder
 saveImages = True
 
 cacheEnabled = True
 cachePath = os.path.join(os.getcwd(), 'cache/')
+# Maximum size of the cached response bodies, in bytes. The least recently
+# used responses are evicted beyond this. None means no limit.
+cacheMaxBytes = None
+# Check cached manifests, info.json and annotation lists with the server
+# (a cheap conditional request) instead of trusting the cached copy
+revalidateDocuments = True
 
 targetManifests = []
 
@@ -53,10 +68,9 @@ if (saveImages):
 
 # ## Helper code
 
+# See image_arrays.py: this avoids building a Python object per pixel
 def load_image_into_numpy_array(image):
-  (im_width, im_height) = image.size
-  return np.array(image.getdata()).reshape(
-      (im_height, im_width, 3)).astype(np.uint8)
+  return image_arrays.imageToArray(image)
 
 def run_detection_on_single_image(image):
   faceBoxes = []
@@ -66,25 +80,23 @@ def run_detection_on_single_image(image):
   #  top, right, bottom, left = face_location
   return face_locations     
 
-try:
-  if (not os.path.exists(cachePath)):
-    os.makedirs(cachePath)
-except:
-  print("Unable to create cache folder, will download everything")
-  cacheEnaled = False
-
-def getURL(link, useCache=cacheEnabled):
-  fileSlug = slugify(link)
-  filePath = os.path.join(cachePath, fileSlug)
-  if (useCache and os.path.isfile(filePath)):
-    data = pickle.load(open(filePath, 'rb'))
-    print("fetched from cache: " + link)
-  else:
-    print("fetching " + link)
-    data = requests.get(link, verify=False)
-    if (useCache):
-      pickle.dump(data, open(filePath, 'wb'))
-  return data
+cache = None
+if (cacheEnabled):
+  try:
+    cache = iiif_cache.DiskCache(cachePath, cacheMaxBytes)
+    # Bring in any responses pickled by older versions of this script
+    if (cache.hasPickleCache()):
+      cache.importPickleCache()
+  except:
+    print("Unable to create cache folder, will download everything")
+    cacheEnabled = False
+
+# Set revalidate=True for documents that may have changed on the server
+# since they were cached (manifests, info.json, annotation lists)
+def getURL(link, useCache=cacheEnabled, revalidate=False):
+  if (useCache):
+    return iiif_http.fetchURL(link, cache, revalidate, verify=False)
+  return iiif_http.fetchURL(link, verify=False)
 
 def processManifest(maniData):
   manifestLabel = maniData['label']
@@ -130,238 +142,307 @@ manifestLabels = {}
 for srcManifest in targetManifests:
   if (srcManifest not in maniMappings):
     print("Processing manifest",srcManifest)
-    manifestData = getURL(srcManifest).json()
+    manifestData = getURL(srcManifest, revalidate=revalidateDocuments).json()
     maniLabel, newMappings = processManifest(manifestData)
     manifestLabels[srcManifest] = maniLabel
     maniMappings[srcManifest] = newMappings
 
-for srcManifest in maniMappings:
-  maniLabel = manifestLabels[srcManifest]
-  isFirstBox = True
-  if (writeCuration):
+# The stages of the pipeline (see face_pipeline.py). Each job is a
+# (kind, srcManifest, canvasID, image) tuple; 'start' and 'end' jobs open and
+# close a manifest's range in the curation file, and 'image' jobs are
+# fetched, decoded, run through face detection and written.
+def imageJobs():
+  for srcManifest in maniMappings:
+    yield ('start', srcManifest, None, None)
+    for canvasID in maniMappings[srcManifest]:
+      for image in maniMappings[srcManifest][canvasID]:
+        yield ('image', srcManifest, canvasID, image)
+    yield ('end', srcManifest, None, None)
+
+# Runs in the fetch threads: returns the image's metadata and decoded pixels
+def fetchImage(job):
+  kind, srcManifest, canvasID, image = job
+  if (kind != 'image'):
+    return None
+
+  fullURL = image['resource']['@id']
+  # IIIF presentation always returns a .jpg
+  #imageID = canvasID.split('/')[-1].replace('.json','').replace('.tif','').replace('.png','').replace('.jpg','').replace('.jpeg','') + ".jpg"
+  imageID = image['resource']['service']['@id'].split('/')[-1].replace('.tif','').replace('.png','').replace('.jpg','').replace('.jpeg','') + ".jpg"
+
+  imageInfoURL = image['resource']['service']['@id'] + '/info.json'
 
-    if (not isFirstRange):
-      curationFile.write(', ')
+  try:
+    imageInfo = getURL(imageInfoURL, revalidate=revalidateDocuments).json()
+    fullWidth = imageInfo['width']
+    fullHeight = imageInfo['height']
+  except:
+    # Sometimes this manifest lies, so it's better to get the info directly
+    # from the image server (without actually downloading the full image)
+    print("ERROR getting image info, reading dimensions from manifest")
+    fullWidth = image['resource']['width']
+    fullHeight = image['resource']['height']
+  print("FULL IMAGE WH",fullWidth,fullHeight)
+
+  # SOME manifests (cough, Keio Unversity, cough) don't include the
+  # /full/full/0/default.jpg
+  # after the image filename, so correct this...
+  if (fullURL.find('/full/full/0/default.jpg') == -1):
+    fullURL = image['resource']['service']['@id']
+    if (fullURL.find('/full/full/0/default.jpg') == -1):
+      fullerURL = fullURL + '/full/full/0/default.jpg'
+      print("WARNING: irregular image ID",fullURL,"expanding to",fullerURL)
+      fullURL = fullerURL
+
+  # Files will be cached as byte streams by default
+  resizedURL = fullURL.replace('full/full','full/!1000,1000')
+  try:
+    imageResponse = getURL(resizedURL)
+  except:
+    sleep(1)
+    try:
+      imageResponse = getURL(resizedURL)
+    except:
+      print("error getting image " + resizedURL + ", skipping")
+      sleep(10)
+      return None
+
+  imageHash = detection_cache.imageHash(imageResponse)
+  im = image_arrays.decodeImage(imageResponse.content)
+  resizedWidth, resizedHeight = im.size
+
+  #image = Image.open(image_path).convert('RGB')
+  # the array based representation of the image will be used later in order to prepare the
+  # result image with boxes and labels on it.
+
+  image_np = load_image_into_numpy_array(im)
+
+  # These should be the same as resizedWidth and resizedHeight
+  image_height = image_np.shape[0]
+  image_width = image_np.shape[1]
+
+  # Compute the ratio between resized and full-sized image
+  # Multiple the resized (smaller) size by this factor to get
+  # the desired value for the full-sized image
+  heightRatio = fullHeight / image_height
+  widthRatio = fullWidth / image_width
+
+  imageMetadata = {'id': imageID, 'width': image_width, 'height': image_height, 'height_ratio': heightRatio, 'width_ratio': widthRatio, 'src_manifest': srcManifest, 'canvas_id': canvasID, 'image': im, 'image_hash': imageHash}
+  return imageMetadata, image_np
+
+def writeFaces(imageMetadata, faces):
+
+  global isFirstAnnotation, isFirstBox
+
+  imageID = imageMetadata['id']
+  image_height = imageMetadata['height']
+  image_width = imageMetadata['width']
+  image_area = image_height * image_width
+  widthRatio = imageMetadata['width_ratio']
+  heightRatio = imageMetadata['height_ratio']
+  srcManifest = imageMetadata['src_manifest']
+  canvasID = imageMetadata['canvas_id']
+  im = imageMetadata['image']
+
+  print("image area is",image_area)
+  print("image width is",image_width)
+  print("image height is",image_height)
+
+  for face in faces:
+
+    # PMB Maybe also check whether class label is in a desired subset?
+
+    print("face points are", face) # format: top, right, bottom, left
+                                   # (ymin, xmax, ymax, xmin)
+    face_width = float(face[1]) - float(face[3])
+    face_unit_width = face_width / image_width
+    print("face unit width",face_unit_width)
+    face_height = float(face[2]) - float(face[0])
+    face_unit_height = face_height / image_height
+    print("face unit height",face_unit_height)
+    face_proportion = face_unit_width * face_unit_height
+    print("proportion is",face_proportion)
+
+    #if (face_proportion < min_face_proportion_thresh):
+    #  continue
+
+    if (face_proportion < .01):
+      proportionString = "<.01"
     else:
-      isFirstRange = False
-
-    # This begins a range section
-    curationFile.write('{ "@id": "' + srcManifest + '/range/r1", "@type": "sc:Range", "label": "Objects detected by Python face_recognition package", "members": [')
-
-  for canvasID in maniMappings[srcManifest]:
-    for image in maniMappings[srcManifest][canvasID]: 
-
-      fullURL = image['resource']['@id']
-      # IIIF presentation always returns a .jpg
-      #imageID = canvasID.split('/')[-1].replace('.json','').replace('.tif','').replace('.png','').replace('.jpg','').replace('.jpeg','') + ".jpg"
-      imageID = image['resource']['service']['@id'].split('/')[-1].replace('.tif','').replace('.png','').replace('.jpg','').replace('.jpeg','') + ".jpg"
-
-      imageInfoURL = image['resource']['service']['@id'] + '/info.json'
-
-      try:
-        imageInfo = getURL(imageInfoURL).json()
-        fullWidth = imageInfo['width']
-        fullHeight = imageInfo['height']
-      except:
-        # Sometimes this manifest lies, so it's better to get the info directly
-        # from the image server (without actually downloading the full image)
-        print("ERROR getting image info, reading dimensions from manifest")
-        fullWidth = image['resource']['width']
-        fullHeight = image['resource']['height']
-      print("FULL IMAGE WH",fullWidth,fullHeight)
-
-      # SOME manifests (cough, Keio Unversity, cough) don't include the
-      # /full/full/0/default.jpg
-      # after the image filename, so correct this...
-      if (fullURL.find('/full/full/0/default.jpg') == -1):
-        fullURL = image['resource']['service']['@id']
-        if (fullURL.find('/full/full/0/default.jpg') == -1):
-          fullerURL = fullURL + '/full/full/0/default.jpg'
-          print("WARNING: irregular image ID",fullURL,"expanding to",fullerURL)
-          fullURL = fullerURL
-
-      # Files will be cached as byte streams by default
-      resizedURL = fullURL.replace('full/full','full/!1000,1000')
-      try:
-        imageResponse = getURL(resizedURL)
-      except:
-        sleep(1)
-        try:
-          imageResponse = getURL(resizedURL)
-        except:
-          print("error getting image " + resizedURL + ", skipping")
-          sleep(10)
-          continue
-
-      im = Image.open(BytesIO(imageResponse.content)).convert('RGB')
-      resizedWidth, resizedHeight = im.size
-
-      #image = Image.open(image_path).convert('RGB')
-      # the array based representation of the image will be used later in order to prepare the
-      # result image with boxes and labels on it.
-
-      image_np = load_image_into_numpy_array(im)
-      # Expand dimensions since the model expects images to have shape: [1, None, None, 3]
-      #image_np_expanded = np.expand_dims(image_np, axis=0)
-      # Actual detection.
-      print("running detection on " + imageID)
-
-      faces = run_detection_on_single_image(image_np)
-
-      # If a detected object satisfies certain conditions (size, class, score),
-      # add it to the JSON curation document.
- 
-      # Check model confidence??? 
-
-      # These should be the same as resizedWidth and resizedHeight
-      image_height = image_np.shape[0]
-      image_width = image_np.shape[1]
-      image_area = image_height * image_width
-
-      # Compute the ratio between resized and full-sized image
-      # Multiple the resized (smaller) size by this factor to get
-      # the desired value for the full-sized image
-      heightRatio = fullHeight / image_height
-      widthRatio = fullWidth / image_width
-
-      print("image area is",image_area)
-      print("image width is",image_width)
-      print("image height is",image_height)
-
-      #boxes = output_dict['detection_boxes']
-      #classes = output_dict['detection_classes']
-      #scores = output_dict['detection_scores']
-
-      for face in faces:
-
-        # PMB Maybe also check whether class label is in a desired subset?
-
-        print("face points are", face) # format: top, right, bottom, left
-                                       # (ymin, xmax, ymax, xmin)
-        face_width = float(face[1]) - float(face[3])
-        face_unit_width = face_width / image_width
-        print("face unit width",face_unit_width)
-        face_height = float(face[2]) - float(face[0])
-        face_unit_height = face_height / image_height
-        print("face unit height",face_unit_height)
-        face_proportion = face_unit_width * face_unit_height
-        print("proportion is",face_proportion)
-
-        #if (face_proportion < min_face_proportion_thresh):
-        #  continue
-
-        if (face_proportion < .01):
-          proportionString = "<.01"
-        else:
-          proportionString = str(round(face_proportion,2))
-
-        #face_width = face_unit_width * image_width
-        print("face_width",face_width)
-        #face_height = face_unit_height * image_height
-        print("face_height",face_height)
-
-        # face detection format: top, right, bottom, left
-        #                        (ymax, xmax, ymin, xmin)
-        # But XYWH wants xmin, ymax, width, height
-        face_X = float(face[3])
-        #face_X = float(face[1]) * image_width
-        print("face_X",face_X)
-        face_Y = float(face[0])
-        #face_Y = float(face[0]) * image_height
-        print("face_Y",face_Y)
-
-        xywh = list(map(int, (face_X, face_Y, face_width, face_height)))
-        xywhString = ','.join(list(map(str,xywh)))
-        print("face xywh on resized image is",xywhString)
- 
-        fullXYWH = list(map(int, (face_X * widthRatio, face_Y * heightRatio, face_width * widthRatio, face_height * heightRatio)))
-        fullXYWHstring = ','.join(list(map(str,fullXYWH)))
-        print("face xywh on full-sized image is",fullXYWHstring)
-
-        if (saveImages):
-          #croppedImageID = imageID + '.' + xywhString + '.png'
-          # Use the full XYWH string to help with debugging
-          croppedImageID = imageID + '.' + fullXYWHstring + '.png'
-          # Format of cropBox: xmin, ymin, xmax, ymax
-          cropBox = (xywh[0], xywh[1], xywh[0] + xywh[2], xywh[1] + xywh[3])
-          croppedImage = im.crop(cropBox)
-          croppedPath = os.path.join(outputFolder, croppedImageID).replace('%7C', '_')
-
-          #with open(croppedPath, 'w') as croppedFile:
-          print("saving cropped image " + croppedImageID)
-          croppedImage.save(croppedPath, 'png') 
-
-        if (writeAnnotations):
-          svgUUID = str(uuid.uuid4())
-
-          pathTopLeft = [ str(float(fullXYWH[0])), str(float(fullXYWH[1])) ]
-          pathHalfWidth = str(float(fullXYWH[2]) / 2)
-          pathHalfHeight = str(float(fullXYWH[3]) / 2)
-
-          # SVG paths are formatted
-          # e.g., d="M1557.25466,1770.37267h-492.25466v0h-492.25466v310.32919v310.32919h492.25466h492.25466v-310.32919z"
-          # M startX, startY (top right corner)
-          # h -1/2 X h -1/2 X (draw to left in .5 w increments -- no idea why)
-          # v 1/2 Y v 1/2 Y (draw down in .5 h increments)
-          # h 1/2 X h 1/2 X (draw up in .5 w increments)
-          # v -1/2 Y (draw up .5 h)
-          # z (draw the rest of the way back to M -- WHY DO IT THIS WAY???)
-
-          svgPath = "M" + pathTopLeft[0] + "," + pathTopLeft[1] + 'h' + pathHalfWidth + 'h' + pathHalfWidth + 'v' + pathHalfHeight + 'v' + pathHalfHeight + 'h-' + pathHalfWidth + 'h-' + pathHalfWidth + 'v-' + pathHalfHeight + 'z'
-
-          svgString = "<svg xmlns='http://www.w3.org/2000/svg'>" + '<path xmlns="http://www.w3.org/2000/svg" d="' + svgPath + '" data-paper-data="{&quot;strokeWidth&quot;:1,&quot;rotation&quot;:0,&quot;deleteIcon&quot;:null,&quot;rotationIcon&quot;:null,&quot;group&quot;:null,&quot;editable&quot;:true,&quot;annotation&quot;:null}" id="rectangle_' + svgUUID + '" fill-opacity="0" fill="#00bfff" fill-rule="nonzero" stroke="#00bfff" stroke-width="1" stroke-linecap="butt" stroke-linejoin="miter" stroke-miterlimit="10" stroke-dasharray="" stroke-dashoffset="0" font-family="none" font-weight="none" font-size="none" text-anchor="none" style="mix-blend-mode: normal"/></svg>'
-
-          # Note: DO NOT add #xywh=coords to 'full' -- the annotation import
-          # will fail.
-          boxJSON = {
-            '@type': "oa:Annotation",
-            'motivation': [ "oa:commenting", "oa:tagging" ],
-            "resource": [ { '@id': "_:b2", '@type': "dctypes:Text", 'http://dev.llgc.org.uk/sas/full_text': "", 'format': "text/html", 'chars': "" },
-                          { '@id': "_:b3", '@type': "oa:Tag", 'http://dev.llgc.org.uk/sas/full_text': "face", 'chars': "face" } ],
-            "on": [ { '@id': "_:b0", '@type': "oa:SpecificResource", 
-                      'within': { '@id': srcManifest,
-                                  '@type': "sc:Manifest" },
-                      'selector': { '@id': "_:b1", '@type': "oa:Choice", 'default': { '@id': "_:b4", '@type': "oa:FragmentSelector", 'value': "xywh=" + fullXYWHstring }, 'item': { '@id': "_:b5", '@type': "oa:SvgSelector", 'value': svgString } }, 'full': canvasID} ], 
-            "@context": "http://iiif.io/api/presentation/2/context.json" }
-
-          box_str = json.dumps(boxJSON)
-          if (isFirstAnnotation == True):
-            annoFile.write(box_str + "\n")
-            isFirstAnnotation = False
-          else:
-            annoFile.write("," + box_str + "\n")
-
-        if (writeCuration):
-          boxJSON = {
-            "@id": canvasID + "#xywh=" + fullXYWHstring,
-            "type": "sc:Canvas",
-            "label": imageID,
-            "metadata": [
-              {
-                "label": "tag",
-                "value": "face" 
-              },
-              #{
-              #  "label": "confidence",
-              #  "value": pct_score
-              #},
-              {
-                "label": "proportion",
-                "value": proportionString
-              }
-            ]
+      proportionString = str(round(face_proportion,2))
+
+    #face_width = face_unit_width * image_width
+    print("face_width",face_width)
+    #face_height = face_unit_height * image_height
+    print("face_height",face_height)
+
+    # face detection format: top, right, bottom, left
+    #                        (ymax, xmax, ymin, xmin)
+    # But XYWH wants xmin, ymax, width, height
+    face_X = float(face[3])
+    #face_X = float(face[1]) * image_width
+    print("face_X",face_X)
+    face_Y = float(face[0])
+    #face_Y = float(face[0]) * image_height
+    print("face_Y",face_Y)
+
+    xywh = list(map(int, (face_X, face_Y, face_width, face_height)))
+    xywhString = ','.join(list(map(str,xywh)))
+    print("face xywh on resized image is",xywhString)
+
+    fullXYWH = list(map(int, (face_X * widthRatio, face_Y * heightRatio, face_width * widthRatio, face_height * heightRatio)))
+    fullXYWHstring = ','.join(list(map(str,fullXYWH)))
+    print("face xywh on full-sized image is",fullXYWHstring)
+
+    if (saveImages):
+      #croppedImageID = imageID + '.' + xywhString + '.png'
+      # Use the full XYWH string to help with debugging
+      croppedImageID = imageID + '.' + fullXYWHstring + '.png'
+      # Format of cropBox: xmin, ymin, xmax, ymax
+      cropBox = (xywh[0], xywh[1], xywh[0] + xywh[2], xywh[1] + xywh[3])
+      croppedImage = im.crop(cropBox)
+      croppedPath = os.path.join(outputFolder, croppedImageID).replace('%7C', '_')
+
+      #with open(croppedPath, 'w') as croppedFile:
+      print("saving cropped image " + croppedImageID)
+      croppedImage.save(croppedPath, 'png') 
+
+    if (writeAnnotations):
+      svgUUID = str(uuid.uuid4())
+
+      pathTopLeft = [ str(float(fullXYWH[0])), str(float(fullXYWH[1])) ]
+      pathHalfWidth = str(float(fullXYWH[2]) / 2)
+      pathHalfHeight = str(float(fullXYWH[3]) / 2)
+
+      # SVG paths are formatted
+      # e.g., d="M1557.25466,1770.37267h-492.25466v0h-492.25466v310.32919v310.32919h492.25466h492.25466v-310.32919z"
+      # M startX, startY (top right corner)
+      # h -1/2 X h -1/2 X (draw to left in .5 w increments -- no idea why)
+      # v 1/2 Y v 1/2 Y (draw down in .5 h increments)
+      # h 1/2 X h 1/2 X (draw up in .5 w increments)
+      # v -1/2 Y (draw up .5 h)
+      # z (draw the rest of the way back to M -- WHY DO IT THIS WAY???)
+
+      svgPath = "M" + pathTopLeft[0] + "," + pathTopLeft[1] + 'h' + pathHalfWidth + 'h' + pathHalfWidth + 'v' + pathHalfHeight + 'v' + pathHalfHeight + 'h-' + pathHalfWidth + 'h-' + pathHalfWidth + 'v-' + pathHalfHeight + 'z'
+
+      svgString = "<svg xmlns='http://www.w3.org/2000/svg'>" + '<path xmlns="http://www.w3.org/2000/svg" d="' + svgPath + '" data-paper-data="{&quot;strokeWidth&quot;:1,&quot;rotation&quot;:0,&quot;deleteIcon&quot;:null,&quot;rotationIcon&quot;:null,&quot;group&quot;:null,&quot;editable&quot;:true,&quot;annotation&quot;:null}" id="rectangle_' + svgUUID + '" fill-opacity="0" fill="#00bfff" fill-rule="nonzero" stroke="#00bfff" stroke-width="1" stroke-linecap="butt" stroke-linejoin="miter" stroke-miterlimit="10" stroke-dasharray="" stroke-dashoffset="0" font-family="none" font-weight="none" font-size="none" text-anchor="none" style="mix-blend-mode: normal"/></svg>'
+
+      # Note: DO NOT add #xywh=coords to 'full' -- the annotation import
+      # will fail.
+      boxJSON = {
+        '@type': "oa:Annotation",
+        'motivation': [ "oa:commenting", "oa:tagging" ],
+        "resource": [ { '@id': "_:b2", '@type': "dctypes:Text", 'http://dev.llgc.org.uk/sas/full_text': "", 'format': "text/html", 'chars': "" },
+                      { '@id': "_:b3", '@type': "oa:Tag", 'http://dev.llgc.org.uk/sas/full_text': "face", 'chars': "face" } ],
+        "on": [ { '@id': "_:b0", '@type': "oa:SpecificResource", 
+                  'within': { '@id': srcManifest,
+                              '@type': "sc:Manifest" },
+                  'selector': { '@id': "_:b1", '@type': "oa:Choice", 'default': { '@id': "_:b4", '@type': "oa:FragmentSelector", 'value': "xywh=" + fullXYWHstring }, 'item': { '@id': "_:b5", '@type': "oa:SvgSelector", 'value': svgString } }, 'full': canvasID} ], 
+        "@context": "http://iiif.io/api/presentation/2/context.json" }
+
+      box_str = json.dumps(boxJSON)
+      if (isFirstAnnotation == True):
+        annoFile.write(box_str + "\n")
+        isFirstAnnotation = False
+      else:
+        annoFile.write("," + box_str + "\n")
+
+    if (writeCuration):
+      boxJSON = {
+        "@id": canvasID + "#xywh=" + fullXYWHstring,
+        "type": "sc:Canvas",
+        "label": imageID,
+        "metadata": [
+          {
+            "label": "tag",
+            "value": "face" 
+          },
+          #{
+          #  "label": "confidence",
+          #  "value": pct_score
+          #},
+          {
+            "label": "proportion",
+            "value": proportionString
           }
+        ]
+      }
+
+      box_str = json.dumps(boxJSON)
+      if (isFirstBox == True):
+        curationFile.write(box_str + "\n")
+        isFirstBox = False
+      else:
+        curationFile.write("," + box_str + "\n")
+
+
+# Runs in the writer thread, in the order of the jobs
+def writeResult(job, result):
+
+  global isFirstBox, isFirstRange
+
+  kind, srcManifest, canvasID, image = job
+  if (kind == 'start'):
+    isFirstBox = True
+    if (writeCuration):
+
+      if (not isFirstRange):
+        curationFile.write(', ')
+      else:
+        isFirstRange = False
+
+      # This begins a range section
+      curationFile.write('{ "@id": "' + srcManifest + '/range/r1", "@type": "sc:Range", "label": "Objects detected by Python face_recognition package", "members": [')
+
+  elif (kind == 'end'):
+    if (writeCuration):
+      # This ends a range section
+      curationFile.write('], "within": { "@id": "' + srcManifest  + '", "@type": "sc:Manifest", "label": "' + iiifProject + '" } }')
+
+  elif (result is not None):
+    writeFaces(*result)
+
+# Download and decode images in fetchWorkers threads while the detection runs
+# here, and write the results in another thread
+detections = None
+if (detectionCacheEnabled):
+  detections = detection_cache.DetectionCache(detectionCachePath, UPSAMPLE, "cnn")
+
+pipeline = face_pipeline.Pipeline(fetchImage, writeResult, fetchWorkers, maxDecodedImages, maxImagesInFlight)
+pipeline.start(imageJobs())
+
+for seq, job, (imageMetadata, image_np) in pipeline.decoded():
+  # Expand dimensions since the model expects images to have shape: [1, None, None, 3]
+  #image_np_expanded = np.expand_dims(image_np, axis=0)
+  faces = None
+  if (detections is not None):
+    faces = detections.get(imageMetadata['image_hash'])
+
+  if (faces is not None):
+    print("using cached detections for " + imageMetadata['id'])
+  else:
+    # Actual detection.
+    print("running detection on " + imageMetadata['id'])
+
+    faces = run_detection_on_single_image(image_np)
+    if (detections is not None):
+      detections.put(imageMetadata['image_hash'], faces)
+
+  # If a detected object satisfies certain conditions (size, class, score),
+  # add it to the JSON curation document.
+
+  # Check model confidence???
+
+  #boxes = output_dict['detection_boxes']
+  #classes = output_dict['detection_classes']
+  #scores = output_dict['detection_scores']
+
+  pipeline.done(seq, job, (imageMetadata, faces))
 
-          box_str = json.dumps(boxJSON)
-          if (isFirstBox == True):
-            curationFile.write(box_str + "\n")
-            isFirstBox = False
-          else:
-            curationFile.write("," + box_str + "\n")
+pipeline.finish()
 
-  if (writeCuration):
-    # This ends a range section
-    curationFile.write('], "within": { "@id": "' + srcManifest  + '", "@type": "sc:Manifest", "label": "' + iiifProject + '" } }')
+if (detections is not None):
+  detections.save()
 
 if (writeAnnotations):
   annoFile.write(' ] }')
@@ -0,0 +1,102 @@
+#!/usr/bin/python # Expects Python 3
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# HTTP fetching shared by the IIIF scripts. Requests to each host go through
+# a single keep-alive requests.Session, so repeated manifest, info.json and
+# image requests reuse their connections instead of opening a new one each
+# time.
+#
+# Cached documents that can change on the server (manifests, info.json,
+# annotation lists) can be revalidated with a conditional GET using the ETag
+# and/or Last-Modified headers kept in the cache; an unchanged document then
+# costs a 304 response instead of a full download.
+
+# Maximum number of keep-alive connections kept open to any one host
+connectionsPerHost = 8
+
+# Size of the pieces in which streamed responses are written to the cache
+streamChunkSize = 1024 * 1024
+
+sessions = {}
+sessionsLock = threading.Lock()
+
+def getSession(link):
+  parsed = urlparse(link)
+  hostKey = parsed.scheme + '://' + parsed.netloc
+  with sessionsLock:
+    if (hostKey not in sessions):
+      session = requests.Session()
+      adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connectionsPerHost)
+      session.mount(hostKey, adapter)
+      sessions[hostKey] = session
+    return sessions[hostKey]
+
+def conditionalHeaders(cached):
+  headers = {}
+  if ('ETag' in cached.headers):
+    headers['If-None-Match'] = cached.headers['ETag']
+  if ('Last-Modified' in cached.headers):
+    headers['If-Modified-Since'] = cached.headers['Last-Modified']
+  return headers
+
+# Fetch a URL, using the DiskCache (see iiif_cache.py) if one is given.
+# With revalidate=True, a cached copy is checked against the server with a
+# conditional GET before it's used; cached copies with no validators are
+# simply re-downloaded. If the server can't be reached, the cached copy is
+# used anyway.
+#
+# With stream=True, a downloaded body is written straight into the cache
+# without being held in memory (see openURL() below).
+def fetchURL(link, cache=None, revalidate=False, verify=True, stream=False):
+  cached = None
+  if (cache is not None):
+    cached = cache.get(link)
+
+  if ((cached is not None) and (not revalidate)):
+    print("fetched from cache: " + link)
+    return cached
+
+  headers = {}
+  if (cached is not None):
+    headers = conditionalHeaders(cached)
+
+  if (len(headers) > 0):
+    print("revalidating " + link)
+  else:
+    print("fetching " + link)
+
+  try:
+    response = getSession(link).get(link, headers=headers, verify=verify, stream=stream)
+  except requests.exceptions.RequestException:
+    if (cached is None):
+      raise
+    print("unable to revalidate, using cached copy of " + link)
+    return cached
+
+  if ((response.status_code == 304) and (cached is not None)):
+    print("not modified: " + link)
+    cache.refresh(link, response.headers)
+    return cached
+
+  # Don't keep server errors around in the cache
+  if ((cache is not None) and response.ok):
+    if (stream):
+      return cache.putStream(link, response.iter_content(streamChunkSize), response.status_code, response.headers)
+    return cache.put(link, response.content, response.status_code, response.headers)
+  return response
+
+# Returns a binary file object for the body of a URL, for parsing documents
+# too large to comfortably hold in memory (see iiif_stream.py). The body is
+# read from the cache file if there is one, otherwise from the network.
+def openURL(link, cache=None, revalidate=False, verify=True):
+  response = fetchURL(link, cache, revalidate, verify, stream=True)
+  # Cached responses (see iiif_cache.py)
+  if (hasattr(response, 'openContent')):
+    return response.openContent()
+  response.raise_for_status()
+  response.raw.decode_content = True
+  return response.raw
@@ -0,0 +1,110 @@
+#!/usr/bin/python # Expects Python 3
+import codecs
+import json
+
+# Incremental parsing of very large IIIF documents, e.g. the AnnotationList
+# that a SimpleAnnotationServer's getAllAnnotations endpoint returns. Rather
+# than loading the whole document with json.load(), the items of one of its
+# top-level arrays ("resources" by default) are decoded and yielded one at a
+# time, so only a single item (plus one read-sized chunk of the input) is held
+# in memory at once. Other top-level values are skipped.
+
+readSize = 64 * 1024
+
+decoder = json.JSONDecoder()
+whitespace = ' \t\n\r'
+# Characters that can follow a complete value
+delimiters = whitespace + ',]}:'
+
+class JSONStream(object):
+  """Text buffer over a binary file object, refilled as it's consumed"""
+
+  def __init__(self, fileObj):
+    self.fileObj = fileObj
+    self.textDecoder = codecs.getincrementaldecoder('utf-8')()
+    self.buffer = ''
+    self.pos = 0
+    self.eof = False
+
+  def fill(self):
+    if (self.eof):
+      return False
+    data = self.fileObj.read(readSize)
+    if (not data):
+      self.buffer = self.buffer[self.pos:] + self.textDecoder.decode(b'', final=True)
+      self.eof = True
+    else:
+      self.buffer = self.buffer[self.pos:] + self.textDecoder.decode(data)
+    self.pos = 0
+    return True
+
+  # Returns the next non-whitespace character without consuming it, or None
+  # at the end of the input
+  def peek(self):
+    while True:
+      while ((self.pos < len(self.buffer)) and (self.buffer[self.pos] in whitespace)):
+        self.pos += 1
+      if (self.pos < len(self.buffer)):
+        # Skip a UTF-8 byte order mark at the start of the document
+        if (self.buffer[self.pos] == '\ufeff'):
+          self.pos += 1
+          continue
+        return self.buffer[self.pos]
+      if (not self.fill()):
+        return None
+
+  def expect(self, char):
+    found = self.peek()
+    if (found != char):
+      raise ValueError("Expected '" + char + "' in JSON stream, found " + repr(found))
+    self.pos += 1
+
+  # Decode one complete JSON value, reading more input as needed
+  def value(self):
+    self.peek()
+    while True:
+      try:
+        result, end = decoder.raw_decode(self.buffer, self.pos)
+        # A number that ends at the end of the buffer, or before something
+        # other than a delimiter, may continue in the next chunk (a chunk
+        # ending in "-2." decodes as -2)
+        if (((end < len(self.buffer)) and (self.buffer[end] in delimiters)) or self.eof):
+          self.pos = end
+          return result
+      except json.JSONDecodeError:
+        if (self.eof):
+          raise
+      self.fill()
+
+def iterArrayItems(fileObj, key='resources'):
+  """Yield the items of the array stored under key in a top-level JSON object"""
+  stream = JSONStream(fileObj)
+  stream.expect('{')
+  if (stream.peek() == '}'):
+    return
+  while True:
+    thisKey = stream.value()
+    stream.expect(':')
+    if (thisKey == key):
+      stream.expect('[')
+      if (stream.peek() == ']'):
+        stream.pos += 1
+      else:
+        while True:
+          yield stream.value()
+          if (stream.peek() == ','):
+            stream.pos += 1
+          else:
+            stream.expect(']')
+            break
+    else:
+      stream.value()
+
+    if (stream.peek() == ','):
+      stream.pos += 1
+    else:
+      stream.expect('}')
+      return
+
+def iterResources(fileObj):
+  return iterArrayItems(fileObj, 'resources')
@@ -0,0 +1,65 @@
+#!/usr/bin/python # Expects Python 3
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# Turning decoded images into the uint8 arrays that face detection takes.
+#
+# Going through image.getdata() builds a Python tuple for every pixel (and
+# np.array() then makes an int64 array of them, which has to be cast back to
+# uint8), so for a 1000px derivative it costs millions of Python objects per
+# canvas. image.tobytes() instead packs the decoder's pixel buffer straight
+# into one bytes object, which np.frombuffer() wraps without copying.
+#
+# Arrays made this way share memory with that bytes object, so they are
+# read-only. Nothing in the annotators writes to an image's pixels (detection
+# and cropping only read them, and the batches are built by copying), so
+# that is fine; pass out= to get a writable array instead.
+
+# Decode an image file's bytes, as RGB. Unlike .convert('RGB'), this doesn't
+# copy images that are already RGB, which most JPEGs decode to. The pixels
+# are decoded right away (rather than when first used), so that it happens
+# in the fetch threads.
+def decodeImage(data):
+  image = Image.open(BytesIO(data))
+  image.load()
+  if (image.mode != 'RGB'):
+    image = image.convert('RGB')
+  return image
+
+# Returns a (height, width, 3) uint8 array of an RGB image. With out, a
+# writable uint8 array of that shape (see ArrayPool), the pixels are copied
+# into it and it is returned.
+def imageToArray(image, out=None):
+  if (image.mode != 'RGB'):
+    image = image.convert('RGB')
+  width, height = image.size
+  pixels = np.frombuffer(image.tobytes(), dtype=np.uint8).reshape((height, width, 3))
+  if (out is None):
+    return pixels
+  out[...] = pixels
+  return out
+
+# Keeps uint8 arrays that are no longer needed so they can be handed out
+# again for the next array of the same shape, rather than allocating (and
+# page faulting in) a new batch sized array each time. Arrays come back
+# holding whatever was last written to them. Not thread safe.
+class ArrayPool(object):
+
+  def __init__(self, keepPerShape=2):
+    self.keepPerShape = keepPerShape
+    # Keys: array shapes. Values: lists of free arrays of that shape
+    self.free = {}
+
+  def take(self, shape):
+    shape = tuple(shape)
+    arrays = self.free.get(shape)
+    if (arrays):
+      return arrays.pop()
+    return np.empty(shape, dtype=np.uint8)
+
+  def give(self, array):
+    arrays = self.free.setdefault(array.shape, [])
+    if (len(arrays) < self.keepPerShape):
+      arrays.append(array)
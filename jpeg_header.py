@@ -0,0 +1,61 @@
+#!/usr/bin/python # Expects Python 3
+
+# Reads the dimensions of a JPEG from its frame header (the SOF segment)
+# without decoding any image data. IIIF image servers already send JPEGs,
+# so when all that's needed is the size of an image, there's no reason to
+# decode it with PIL (and re-encoding it would lose quality).
+
+# Start-of-frame markers; 0xC4 (DHT), 0xC8 (JPG) and 0xCC (DAC) share the
+# range but aren't frame headers
+sofMarkers = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+# Markers that have no length field
+standaloneMarkers = set(range(0xD0, 0xD8)) | set([0x01])
+
+def isJPEG(data):
+  return (len(data) >= 3) and (data[0] == 0xFF) and (data[1] == 0xD8) and (data[2] == 0xFF)
+
+def readJPEGHeader(data):
+  """Returns (width, height, components) from the JPEG frame header of data
+  (bytes, bytearray, memoryview or mmap), or None if data isn't a JPEG or the
+  header can't be found"""
+  if (not isJPEG(data)):
+    return None
+  dataLength = len(data)
+  i = 2
+  while (i < dataLength):
+    if (data[i] != 0xFF):
+      return None
+    # Any number of 0xFF fill bytes can precede a marker
+    while ((i < dataLength) and (data[i] == 0xFF)):
+      i += 1
+    if (i >= dataLength):
+      return None
+    marker = data[i]
+    i += 1
+    if (marker in standaloneMarkers):
+      continue
+    # End of image or start of scan data, without a frame header first
+    if ((marker == 0xD9) or (marker == 0xDA)):
+      return None
+    if (i + 2 > dataLength):
+      return None
+    segmentLength = (data[i] << 8) | data[i + 1]
+    if (marker in sofMarkers):
+      if (i + 8 > dataLength):
+        return None
+      height = (data[i + 3] << 8) | data[i + 4]
+      width = (data[i + 5] << 8) | data[i + 6]
+      components = data[i + 7]
+      if ((width == 0) or (height == 0)):
+        return None
+      return (width, height, components)
+    i += segmentLength
+  return None
+
+def jpegSize(data):
+  """Returns (width, height) of a JPEG, or None (see readJPEGHeader)"""
+  header = readJPEGHeader(data)
+  if (header is None):
+    return None
+  return header[:2]
@@ -0,0 +1,62 @@
+"""Tests for annotation_store.py's rescaling and lookups."""
+
+import unittest
+
+import annotation_store
+
+
+def _store(annotations, fullSizes):
+  store = annotation_store.AnnotationStore()
+  for imageID, tags, xywh in annotations:
+    fullWidth, fullHeight = fullSizes[imageID]
+    store.add(imageID, tags, xywh, 'http://example.org/' + imageID + '/full/full/0/default.jpg', fullWidth, fullHeight)
+  return store
+
+
+class AnnotationStoreTest(unittest.TestCase):
+
+  def test_rescale_matches_per_box_arithmetic(self):
+    fullSizes = {'a.jpg': (3000, 2000), 'b.jpg': (1234, 4321)}
+    resizedSizes = {'a.jpg': (1000, 667), 'b.jpg': (286, 1000)}
+    annotations = [
+      ('a.jpg', ['figure'], (100, 200, 300, 400)),
+      ('b.jpg', ['tree', 'animal'], (17, 33, 501, 999)),
+      ('a.jpg', ['samurai'], (2999, 1999, 1, 1)),
+    ]
+    store = _store(annotations, fullSizes)
+    store.rescale(resizedSizes)
+    for imageID, tags, xywh in annotations:
+      widthRatio = float(resizedSizes[imageID][0]) / float(fullSizes[imageID][0])
+      heightRatio = float(resizedSizes[imageID][1]) / float(fullSizes[imageID][1])
+      bbox = (int(float(xywh[0]) * widthRatio), int(float(xywh[1]) * heightRatio),
+              int(float(xywh[0] + xywh[2]) * widthRatio), int(float(xywh[1] + xywh[3]) * heightRatio))
+      self.assertIn({'tags': tags, 'bbox': bbox}, store[imageID])
+    self.assertEqual(list(store), ['a.jpg', 'b.jpg'])
+
+  def test_boxes_are_clamped_and_empty_ones_dropped(self):
+    store = _store([
+      ('a.jpg', ['figure'], (900, 900, 300, 300)),
+      ('a.jpg', ['tree'], (1100, 10, 50, 50)),
+    ], {'a.jpg': (1000, 1000)})
+    store.rescale({'a.jpg': (1000, 1000)})
+    self.assertEqual(store['a.jpg'], [{'tags': ['figure'], 'bbox': (900, 900, 1000, 1000)}])
+    # Clipping still gets every region
+    self.assertEqual([region['xywh'] for region in store.regions('a.jpg')], [[900, 900, 300, 300], [1100, 10, 50, 50]])
+
+  def test_images_without_boxes_are_dropped(self):
+    store = _store([
+      ('a.jpg', ['figure'], (10, 10, 20, 20)),
+      ('b.jpg', ['tree'], (1100, 10, 50, 50)),
+      ('b.jpg', ['tree'], (10, 1100, 50, 50)),
+      ('c.jpg', ['animal'], (10, 10, 20, 20)),
+    ], {'a.jpg': (1000, 1000), 'b.jpg': (1000, 1000), 'c.jpg': (1000, 1000)})
+    self.assertIn('b.jpg', store)
+    store.rescale({'a.jpg': (1000, 1000), 'b.jpg': (1000, 1000), 'c.jpg': (1000, 1000)})
+    self.assertEqual(list(store), ['a.jpg', 'c.jpg'])
+    self.assertEqual(len(store), 2)
+    self.assertNotIn('b.jpg', store)
+    self.assertEqual(store['b.jpg'], [])
+
+
+if __name__ == '__main__':
+  unittest.main()
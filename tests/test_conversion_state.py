@@ -0,0 +1,57 @@
+"""Tests for conversion_state.py's journal."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import conversion_state
+
+
+class ConversionStateTest(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.path = os.path.join(self.folder, 'conversion_state.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def test_label_ids_stay_put_when_a_label_goes(self):
+    state = conversion_state.ConversionState(self.path)
+    self.assertEqual(state.labelOrder({'tree', 'figure', 'animal'}), ['animal', 'figure', 'tree'])
+    state.save()
+    state = conversion_state.ConversionState(self.path)
+    self.assertEqual(state.labelOrder({'tree', 'samurai'}), ['animal', 'figure', 'tree', 'samurai'])
+
+  def test_outputs_are_redone_when_annotations_change(self):
+    outputPath = os.path.join(self.folder, 'a.xml')
+    with open(outputPath, 'w') as outputFile:
+      outputFile.write('<annotation/>')
+    annotations = [{'tags': ['figure'], 'bbox': (1, 2, 3, 4)}]
+    annotationHash = conversion_state.hashAnnotations((100, 100), annotations)
+    state = conversion_state.ConversionState(self.path)
+    state.recordImage('a.jpg', 'http://example.org/a', (100, 100))
+    state.recordOutputs('a.jpg', annotationHash, [outputPath])
+    state.save()
+
+    state = conversion_state.ConversionState(self.path)
+    self.assertEqual(state.savedImageSize('a.jpg', 'http://example.org/a', outputPath), (100, 100))
+    self.assertIsNone(state.savedImageSize('a.jpg', 'http://example.org/b', outputPath))
+    self.assertFalse(state.outputsChanged('a.jpg', annotationHash))
+    annotations[0]['bbox'] = (1, 2, 3, 5)
+    self.assertTrue(state.outputsChanged('a.jpg', conversion_state.hashAnnotations((100, 100), annotations)))
+    self.assertEqual(state.dropOutputs([]), [outputPath])
+    self.assertTrue(state.outputsChanged('a.jpg', annotationHash))
+
+  def test_unused_fields_of_older_journals_are_dropped(self):
+    with open(self.path, 'w') as stateFile:
+      json.dump({'version': conversion_state.stateVersion, 'labels': [],
+                 'images': {'a.jpg': {'url': 'http://example.org/a', 'size': [1, 1], 'sha256': 'ab', 'annotationIDs': ['x']}}}, stateFile)
+    state = conversion_state.ConversionState(self.path)
+    self.assertEqual(state.images, {'a.jpg': {'url': 'http://example.org/a', 'size': [1, 1]}})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,247 @@
+"""Tests for create_tf_record.py's duplicate handling and incremental builds."""
+
+import argparse
+import glob
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import PIL.Image
+
+import create_tf_record
+import tfrecord_lite
+import voc_xml
+
+
+def _jpeg(color):
+  out = io.BytesIO()
+  PIL.Image.new('RGB', (32, 24), color).save(out, 'jpeg')
+  return out.getvalue()
+
+
+class DedupeExamplesTest(unittest.TestCase):
+
+  def test_merges_objects_into_first_example(self):
+    annotations = {'a': {'object': [1, 2]}, 'b': {'object': [2, 3]},
+                   'c': {'object': [4]}}
+    keys = {'a': 'k1', 'b': 'k1', 'c': 'k2'}
+    examples, merged, duplicates = create_tf_record.dedupe_examples(
+        ['a', 'b', 'c'], annotations, keys)
+    self.assertEqual(examples, ['a', 'c'])
+    self.assertEqual(merged['a']['object'], [1, 2, 3])
+    self.assertEqual(duplicates, {'a': ['b']})
+    # The input annotations are left alone
+    self.assertEqual(annotations['a']['object'], [1, 2])
+
+  def test_preferred_example_is_kept_wherever_it_is(self):
+    annotations = {'a': {'object': [1]}, 'b': {'object': [2]}}
+    keys = {'a': 'k1', 'b': 'k1'}
+    examples, merged, duplicates = create_tf_record.dedupe_examples(
+        ['a', 'b'], annotations, keys, preferred={'b'})
+    self.assertEqual(examples, ['b'])
+    self.assertEqual(merged['b']['object'], [2, 1])
+    self.assertEqual(duplicates, {'b': ['a']})
+
+
+class SplitExamplesTest(unittest.TestCase):
+
+  def test_split_is_stable_when_examples_are_added(self):
+    examples = ['image_%d' % i for i in range(200)]
+    train, val = create_tf_record.split_examples(examples)
+    self.assertEqual(sorted(train + val), sorted(examples))
+    more_train, more_val = create_tf_record.split_examples(
+        examples + ['new_%d' % i for i in range(50)])
+    self.assertEqual([e for e in more_train if e in examples], train)
+    self.assertEqual([e for e in more_val if e in examples], val)
+
+
+class ShardOutputPathTest(unittest.TestCase):
+
+  def test_full_and_appended_shards_are_named_alike(self):
+    self.assertEqual(create_tf_record.shard_output_path('a.record', 0, 1),
+                     'a.record')
+    self.assertEqual(create_tf_record.shard_output_path('a.record', 1, 3),
+                     'a.record-00001')
+    self.assertEqual(create_tf_record.shard_output_path('a.record', 3),
+                     'a.record-00003')
+
+
+class BuildTest(unittest.TestCase):
+  """Runs main() on a small data set, as the command line would."""
+
+  def setUp(self):
+    self.data_dir = tempfile.mkdtemp()
+    self.output_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.data_dir, 'images'))
+    os.makedirs(os.path.join(self.data_dir, 'annotations'))
+    self.label_map_path = os.path.join(self.data_dir, 'label_map.pbtxt')
+    with open(self.label_map_path, 'w') as fid:
+      fid.write("item {\n id: 1\n name: 'face'\n}\n"
+                "item {\n id: 2\n name: 'hand'\n}\n")
+    self.annotations = {}
+
+  def tearDown(self):
+    shutil.rmtree(self.data_dir)
+    shutil.rmtree(self.output_dir)
+
+  def add_image(self, example, encoded_jpg, objects):
+    with open(os.path.join(self.data_dir, 'images', example + '.jpg'),
+              'wb') as fid:
+      fid.write(encoded_jpg)
+    self.annotations[example] = objects
+
+  def write_examples(self, examples):
+    annotations_dir = os.path.join(self.data_dir, 'annotations')
+    with open(os.path.join(annotations_dir, 'trainval.txt'), 'w') as fid:
+      fid.write(''.join(example + '\n' for example in examples))
+    with open(os.path.join(annotations_dir, 'annotations.jsonl'), 'w') as fid:
+      for example in examples:
+        fid.write(json.dumps({
+            'id': example, 'filename': example + '.jpg', 'width': 32,
+            'height': 24,
+            'objects': [{'name': name, 'bbox': [1, 1, 10, 10]}
+                        for name in self.annotations[example]]}) + '\n')
+
+  def build(self, incremental=False, num_shards=1, compression_type='',
+            keep_duplicates=False):
+    create_tf_record.FLAGS = argparse.Namespace(
+        data_dir=self.data_dir, output_dir=self.output_dir,
+        label_map_path=self.label_map_path, num_shards=num_shards,
+        num_workers=1,
+        max_image_side=0, jpeg_quality=0,
+        compression_type=compression_type,
+        keep_duplicates=keep_duplicates, incremental=incremental)
+    create_tf_record.main()
+
+  def written(self):
+    """Returns {filename: [class names]} of every record, checking that no
+    image was written twice."""
+    state = create_tf_record.read_record_state(
+        os.path.join(self.output_dir, 'edo_illustrations_records.json'))
+    records = {}
+    for split_state in state.values():
+      for shard in split_state:
+        for record in tfrecord_lite.tf_record_iterator(
+            os.path.join(self.output_dir, shard['path'])):
+          features = tfrecord_lite.parse_example(
+              record, ['image/filename', 'image/object/class/text'])
+          filename = features['image/filename'][1][0].decode('utf8')
+          self.assertNotIn(filename, records)
+          records[filename] = sorted(
+              name.decode('utf8')
+              for name in features['image/object/class/text'][1])
+    return records
+
+  def test_xml_without_objects(self):
+    self.add_image('img1', _jpeg('red'), [])
+    self.add_image('img2', _jpeg('blue'), ['face'])
+    annotations_dir = os.path.join(self.data_dir, 'annotations')
+    os.makedirs(os.path.join(annotations_dir, 'xmls'))
+    with open(os.path.join(annotations_dir, 'trainval.txt'), 'w') as fid:
+      fid.write('img1\nimg2\n')
+    for example in ('img1', 'img2'):
+      voc_xml.writeAnnotationXML(
+          os.path.join(annotations_dir, 'xmls', example + '.xml'), 'test',
+          example + '.jpg', 32, 24,
+          [(name, (1, 1, 10, 10)) for name in self.annotations[example]])
+    for keep_duplicates in (True, False):
+      self.build(keep_duplicates=keep_duplicates)
+      self.assertEqual(self.written(), {'img1.jpg': [], 'img2.jpg': ['face']})
+
+  def test_full_build_merges_duplicates(self):
+    self.add_image('img1', _jpeg('red'), ['face'])
+    self.add_image('img2', _jpeg('blue'), ['face'])
+    self.add_image('img3', _jpeg('red'), ['hand'])
+    self.write_examples(['img1', 'img2', 'img3'])
+    self.build()
+    self.assertEqual(self.written(), {'img1.jpg': ['face', 'hand'],
+                                      'img2.jpg': ['face']})
+
+  def test_record_state_gets_the_umask_mode(self):
+    self.add_image('img1', _jpeg('red'), ['face'])
+    self.write_examples(['img1'])
+    self.build()
+    umask = os.umask(0)
+    os.umask(umask)
+    mode = os.stat(os.path.join(self.output_dir,
+                                'edo_illustrations_records.json')).st_mode
+    self.assertEqual(mode & 0o777, 0o666 & ~umask)
+
+  def test_incremental_build_appends_new_examples(self):
+    self.add_image('img1', _jpeg('red'), ['face'])
+    self.write_examples(['img1'])
+    self.build()
+    self.add_image('img2', _jpeg('blue'), ['hand'])
+    self.write_examples(['img1', 'img2'])
+    self.build(incremental=True)
+    self.assertEqual(self.written(), {'img1.jpg': ['face'],
+                                      'img2.jpg': ['hand']})
+
+  def test_record_pattern_matches_only_records(self):
+    colors = ['red', 'green', 'blue', 'white', 'black', 'yellow']
+    for i, color in enumerate(colors[:4]):
+      self.add_image('img%d' % i, _jpeg(color), ['face'])
+    self.write_examples(['img%d' % i for i in range(4)])
+    self.build(num_shards=2)
+    for i, color in enumerate(colors):
+      self.add_image('img%d' % i, _jpeg(color), ['face'])
+    self.write_examples(['img%d' % i for i in range(6)])
+    self.build(incremental=True, num_shards=2)
+
+    filenames = []
+    for split in ('train', 'val'):
+      pattern = os.path.join(self.output_dir,
+                             'edo_illustrations_%s.record*' % split)
+      for path in glob.glob(pattern):
+        for record in tfrecord_lite.tf_record_iterator(path):
+          filenames.extend(tfrecord_lite.parse_example(
+              record, ['image/filename'])['image/filename'][1])
+    self.assertEqual(sorted(filenames),
+                     [b'img%d.jpg' % i for i in range(6)])
+
+  def test_incremental_build_skips_duplicate_of_written_example(self):
+    self.add_image('img1', _jpeg('red'), ['face'])
+    self.write_examples(['img1'])
+    self.build()
+    # Listed first, so that it would be the kept example in a full build
+    self.add_image('img0', _jpeg('red'), ['face'])
+    self.write_examples(['img0', 'img1'])
+    self.build(incremental=True)
+    self.assertEqual(self.written(), {'img1.jpg': ['face']})
+
+  def test_incremental_build_refuses_to_lose_duplicate_objects(self):
+    self.add_image('img1', _jpeg('red'), ['face'])
+    self.write_examples(['img1'])
+    self.build()
+    self.add_image('img4', _jpeg('red'), ['hand'])
+    self.write_examples(['img1', 'img4'])
+    with self.assertRaises(ValueError):
+      self.build(incremental=True)
+    # A full build merges them
+    self.build()
+    self.assertEqual(self.written(), {'img1.jpg': ['face', 'hand']})
+
+  def test_incremental_build_refuses_another_compression_type(self):
+    self.add_image('img1', _jpeg('red'), ['face'])
+    self.write_examples(['img1'])
+    self.build()
+    self.add_image('img2', _jpeg('blue'), ['hand'])
+    self.write_examples(['img1', 'img2'])
+    with self.assertRaises(ValueError):
+      self.build(incremental=True, compression_type='GZIP')
+    self.build(incremental=True)
+    self.assertEqual(self.written(), {'img1.jpg': ['face'],
+                                      'img2.jpg': ['hand']})
+
+  def test_failed_record_state_write_leaves_no_temp_file(self):
+    state_path = os.path.join(self.output_dir, 'edo_illustrations_records.json')
+    with self.assertRaises(TypeError):
+      create_tf_record.write_record_state(state_path, {'train': [object()]})
+    self.assertEqual(os.listdir(self.output_dir), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
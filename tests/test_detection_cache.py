@@ -0,0 +1,46 @@
+"""Tests for detection_cache.py."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import detection_cache
+
+
+class DetectionCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.path = os.path.join(self.folder, 'face_detections.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def test_faces_persist(self):
+    cache = detection_cache.DetectionCache(self.path, 2, 'cnn')
+    cache.put('abc', [(1, 20, 30, 4)])
+    cache.save()
+    cache = detection_cache.DetectionCache(self.path, 2, 'cnn')
+    self.assertEqual(cache.get('abc'), [(1, 20, 30, 4)])
+    self.assertIsNone(cache.get('def'))
+
+  def test_settings_are_part_of_the_key(self):
+    cache = detection_cache.DetectionCache(self.path, 2, 'cnn batched',
+                                           {'bucket_step': 200})
+    cache.put('abc', [])
+    cache.save()
+    for upsample, model, settings in [(1, 'cnn batched', {'bucket_step': 200}),
+                                      (2, 'hog', {'bucket_step': 200}),
+                                      (2, 'cnn batched', {'bucket_step': 100}),
+                                      (2, 'cnn batched', None)]:
+      other = detection_cache.DetectionCache(self.path, upsample, model,
+                                             settings)
+      self.assertIsNone(other.get('abc'))
+    same = detection_cache.DetectionCache(self.path, 2, 'cnn batched',
+                                          {'bucket_step': 200})
+    self.assertEqual(same.get('abc'), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
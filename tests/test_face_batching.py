@@ -0,0 +1,153 @@
+"""Tests for face_batching.py's letterboxing and its mapping back to images."""
+
+import unittest
+
+import numpy as np
+
+import face_batching
+import image_arrays
+
+
+def _image(height, width, seed):
+  # Values from 1 up, so that no pixel looks like padding
+  rng = np.random.RandomState(seed)
+  return rng.randint(1, 256, size=(height, width, 3)).astype(np.uint8)
+
+
+def _metadata(image, name):
+  return {'name': name, 'height': image.shape[0], 'width': image.shape[1]}
+
+
+class LetterboxTest(unittest.TestCase):
+
+  # Odd sizes, so that the padding can't be split evenly, all in the
+  # (400, 600) bucket
+  SIZES = [(333, 517), (399, 401), (201, 599)]
+
+  def checkBatch(self, images, metadata, originals, shape):
+    self.assertEqual(images.shape, (len(originals),) + shape + (3,))
+    for i, (original, imageMetadata) in enumerate(zip(originals, metadata)):
+      top = imageMetadata['pad_top']
+      left = imageMetadata['pad_left']
+      self.assertEqual(top, (shape[0] - original.shape[0]) // 2)
+      self.assertEqual(left, (shape[1] - original.shape[1]) // 2)
+      np.testing.assert_array_equal(
+        face_batching.unpaddedImage(images, i, imageMetadata), original)
+      # Everything else is black
+      padding = images[i].copy()
+      padding[top:top + original.shape[0], left:left + original.shape[1]] = 0
+      self.assertFalse(padding.any())
+
+  def test_bucket_shape(self):
+    batcher = face_batching.LetterboxBatcher(4, bucketStep=200)
+    self.assertEqual(batcher.bucketShape(333, 517), (400, 600))
+    self.assertEqual(batcher.bucketShape(400, 600), (400, 600))
+    self.assertEqual(batcher.bucketShape(401, 1), (600, 200))
+
+  def test_images_round_trip(self):
+    originals = [_image(333, 517, 0), _image(301, 599, 1)]
+    batcher = face_batching.LetterboxBatcher(2, bucketStep=200)
+    self.assertIsNone(batcher.add(originals[0], _metadata(originals[0], 'a')))
+    images, metadata = batcher.add(originals[1], _metadata(originals[1], 'b'))
+    self.assertEqual([m['name'] for m in metadata], ['a', 'b'])
+    self.checkBatch(images, metadata, originals, (400, 600))
+
+  def test_pooled_arrays_are_cleared(self):
+    pool = image_arrays.ArrayPool()
+    batcher = face_batching.LetterboxBatcher(2, bucketStep=200, pool=pool)
+    # Fill the pool with a batch of bright images, then reuse its array for
+    # smaller ones
+    bright = [np.full((400, 600, 3), 255, dtype=np.uint8)] * 2
+    batcher.add(bright[0], _metadata(bright[0], 'a'))
+    images, _ = batcher.add(bright[1], _metadata(bright[1], 'b'))
+    batcher.release(images)
+    originals = [_image(333, 517, 2), _image(201, 401, 3)]
+    batcher.add(originals[0], _metadata(originals[0], 'c'))
+    reused, metadata = batcher.add(originals[1], _metadata(originals[1], 'd'))
+    self.assertIs(reused, images)
+    self.checkBatch(reused, metadata, originals, (400, 600))
+
+  def test_boxes_round_trip(self):
+    batcher = face_batching.LetterboxBatcher(len(self.SIZES), bucketStep=200)
+    originals = [_image(height, width, seed)
+                 for seed, (height, width) in enumerate(self.SIZES)]
+    for i, original in enumerate(originals[:-1]):
+      self.assertIsNone(batcher.add(original, _metadata(original, i)))
+    images, metadata = batcher.add(originals[-1],
+                                   _metadata(originals[-1], len(originals) - 1))
+    self.checkBatch(images, metadata, originals, (400, 600))
+    for original, imageMetadata in zip(originals, metadata):
+      height, width = original.shape[:2]
+      top = imageMetadata['pad_top']
+      left = imageMetadata['pad_left']
+      # (top, right, bottom, left) in the image, including ones touching its
+      # edges
+      for box in [(10, 50, 40, 3), (0, width, height, 0),
+                  (height - 7, width - 1, height, width - 9)]:
+        found = (box[0] + top, box[1] + left, box[2] + top, box[3] + left)
+        self.assertEqual(face_batching.unletterbox(found, imageMetadata), box)
+      # Detections reaching into the padding are clipped to the image
+      found = (top - 5, left + 20, top + 10, left - 5)
+      self.assertEqual(face_batching.unletterbox(found, imageMetadata),
+                       (0, 20, 10, 0))
+      found = (top + height - 4, left + width + 6, top + height + 3,
+               left + width - 2)
+      self.assertEqual(face_batching.unletterbox(found, imageMetadata),
+                       (height - 4, width, height, width - 2))
+      # Ones entirely in the padding are dropped
+      if (top > 0):
+        self.assertIsNone(face_batching.unletterbox(
+          (0, left + 10, top, left), imageMetadata))
+      if (left > 0):
+        self.assertIsNone(face_batching.unletterbox(
+          (top, left, top + 10, 0), imageMetadata))
+
+
+class FlushTest(unittest.TestCase):
+
+  def test_nothing_waiting(self):
+    batcher = face_batching.LetterboxBatcher(3)
+    self.assertEqual(batcher.flush(), [])
+
+  def test_partial_buckets_are_merged(self):
+    batcher = face_batching.LetterboxBatcher(4, bucketStep=200)
+    originals = [_image(333, 517, 0), _image(599, 201, 1), _image(350, 550, 2),
+                 _image(199, 199, 3), _image(401, 399, 4)]
+    for i, original in enumerate(originals):
+      self.assertIsNone(batcher.add(original, _metadata(original, i)))
+    batches = batcher.flush()
+    self.assertEqual(batcher.buckets, {})
+    self.assertEqual(batcher.flush(), [])
+    # Buckets in shape order: (200, 200), (400, 600) and (600, 400)
+    self.assertEqual([[m['name'] for m in metadata] for _, metadata in batches],
+                     [[3, 0, 2, 1], [4]])
+    # Each batch takes the largest of its images' bucket shapes
+    images, metadata = batches[0]
+    self.assertEqual(images.shape, (4, 600, 600, 3))
+    for i, imageMetadata in enumerate(metadata):
+      np.testing.assert_array_equal(
+        face_batching.unpaddedImage(images, i, imageMetadata),
+        originals[imageMetadata['name']])
+    images, metadata = batches[1]
+    self.assertEqual(images.shape, (1, 600, 400, 3))
+    for i, imageMetadata in enumerate(metadata):
+      np.testing.assert_array_equal(
+        face_batching.unpaddedImage(images, i, imageMetadata),
+        originals[imageMetadata['name']])
+
+  def test_only_partial_buckets_are_flushed(self):
+    batcher = face_batching.LetterboxBatcher(2, bucketStep=200)
+    originals = [_image(333, 517, 0), _image(599, 201, 1), _image(301, 401, 2)]
+    self.assertIsNone(batcher.add(originals[0], _metadata(originals[0], 0)))
+    self.assertIsNone(batcher.add(originals[1], _metadata(originals[1], 1)))
+    images, metadata = batcher.add(originals[2], _metadata(originals[2], 2))
+    self.assertEqual([m['name'] for m in metadata], [0, 2])
+    batches = batcher.flush()
+    self.assertEqual(len(batches), 1)
+    images, metadata = batches[0]
+    self.assertEqual(images.shape, (1, 600, 400, 3))
+    self.assertEqual(metadata[0]['name'], 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,158 @@
+"""Tests for face_pipeline.py's staged fetch/detect/write pipeline."""
+
+import random
+import threading
+import time
+import unittest
+
+import face_pipeline
+
+
+def _run_in_thread(target, timeout=30):
+  """Runs target in a thread, failing if it doesn't finish in time. Returns
+  the exception it raised, if any."""
+  raised = []
+
+  def run():
+    try:
+      target()
+    except Exception as error:
+      raised.append(error)
+
+  thread = threading.Thread(target=run, daemon=True)
+  thread.start()
+  thread.join(timeout)
+  if thread.is_alive():
+    raise AssertionError('pipeline hung')
+  return raised[0] if raised else None
+
+
+class PipelineTest(unittest.TestCase):
+
+  def test_results_are_written_in_job_order(self):
+    rng = random.Random(0)
+    delays = [rng.uniform(0, 0.005) for _ in range(100)]
+
+    def fetch(job):
+      time.sleep(delays[job])
+      # Every fifth job fails to fetch, and goes straight to the writer
+      return None if job % 5 == 0 else job * 10
+
+    written = []
+    pipeline = face_pipeline.Pipeline(
+        fetch, lambda job, result: written.append((job, result)),
+        fetchWorkers=4, maxDecoded=3, maxInFlight=8)
+
+    def run():
+      pipeline.start(iter(range(100)))
+      # Finish the detections out of order, a few at a time
+      held = []
+      for seq, job, result in pipeline.decoded():
+        held.append((seq, job, result + 1))
+        if len(held) == 3:
+          for item in reversed(held):
+            pipeline.done(*item)
+          held = []
+      for item in held:
+        pipeline.done(*item)
+      pipeline.finish()
+
+    self.assertIsNone(_run_in_thread(run))
+    self.assertEqual(written, [(job, None if job % 5 == 0 else job * 10 + 1)
+                               for job in range(100)])
+
+  def test_slow_fetches_dont_stall(self):
+    pipeline = face_pipeline.Pipeline(
+        lambda job: time.sleep(0.2) or job, lambda job, result: None,
+        fetchWorkers=1)
+    items = []
+
+    def run():
+      pipeline.start(iter([1]))
+      for item in pipeline.decoded(stalls=True):
+        items.append(item)
+        if item is not None:
+          pipeline.done(*item)
+      pipeline.finish()
+
+    self.assertIsNone(_run_in_thread(run))
+    self.assertEqual(items, [(0, 1, 1)])
+
+  def test_stalls_only_when_everything_in_flight_is_held(self):
+    rng = random.Random(0)
+    delays = [rng.uniform(0, 0.005) for _ in range(50)]
+    written = []
+    pipeline = face_pipeline.Pipeline(
+        lambda job: time.sleep(delays[job]) or job,
+        lambda job, result: written.append(job),
+        fetchWorkers=4, maxDecoded=2, maxInFlight=6)
+    heldAtStalls = []
+
+    def run():
+      pipeline.start(iter(range(50)))
+      # Hold on to every image until the pipeline stalls, like a batching
+      # detector whose batches never fill up
+      held = []
+      for item in pipeline.decoded(stalls=True):
+        if item is None:
+          heldAtStalls.append(len(held))
+          for item in held:
+            pipeline.done(*item)
+          held = []
+        else:
+          held.append(item)
+      for item in held:
+        pipeline.done(*item)
+      pipeline.finish()
+
+    self.assertIsNone(_run_in_thread(run))
+    self.assertEqual(heldAtStalls, [6] * 8)
+    self.assertEqual(written, list(range(50)))
+
+  def test_stalls_behind_jobs_that_skip_detection(self):
+    # Only the first job has an image; the rest go straight to the writer,
+    # and fill up the in-flight slots behind it
+    pipeline = face_pipeline.Pipeline(
+        lambda job: job if job == 0 else None, lambda job, result: None,
+        fetchWorkers=2, maxInFlight=4)
+    items = []
+
+    def run():
+      pipeline.start(iter(range(20)))
+      for item in pipeline.decoded(stalls=True):
+        items.append(item)
+        if item is None:
+          pipeline.done(*items[0])
+      pipeline.finish()
+
+    self.assertIsNone(_run_in_thread(run))
+    self.assertEqual(items, [(0, 0, 0), None])
+
+  def test_write_error_cancels_the_pipeline(self):
+    fetched = []
+
+    def fetch(job):
+      fetched.append(job)
+      return job
+
+    def write(job, result):
+      if job == 3:
+        raise IOError('disk full')
+
+    pipeline = face_pipeline.Pipeline(fetch, write, fetchWorkers=2,
+                                      maxDecoded=2, maxInFlight=4)
+
+    def run():
+      pipeline.start(iter(range(10000)))
+      for item in pipeline.decoded():
+        pipeline.done(*item)
+      pipeline.finish()
+
+    error = _run_in_thread(run)
+    self.assertIsInstance(error, IOError)
+    # Only the jobs already under way were fetched
+    self.assertLess(len(fetched), 100)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,65 @@
+"""Tests for iiif_cache.py's disk cache."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import iiif_cache
+
+
+class DiskCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.cache = iiif_cache.DiskCache(os.path.join(self.folder, 'cache'))
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def test_put_and_get(self):
+    self.cache.put('http://example.org/a', b'body', 200, {'ETag': '"1"'})
+    response = self.cache.get('http://example.org/a')
+    self.assertEqual(response.content, b'body')
+    self.assertEqual(response.digest, iiif_cache.hashBytes(b'body'))
+    self.assertIsNone(self.cache.get('http://example.org/b'))
+
+  def test_streamed_put(self):
+    response = self.cache.putStream('http://example.org/a', [b'bo', b'dy'])
+    self.assertEqual(response.content, b'body')
+    self.assertEqual(self.cache.get('http://example.org/a').content, b'body')
+
+  def test_files_get_the_umask_mode(self):
+    # Files written through mkstemp() would otherwise be owner-only
+    path = os.path.join(self.folder, 'state.json')
+    iiif_cache.atomicWrite(path, b'{}')
+    response = self.cache.putStream('http://example.org/a', [b'body'])
+    response.close()
+    for written in (path, response.contentPath):
+      self.assertEqual(os.stat(written).st_mode & 0o777,
+                       iiif_cache.newFileMode)
+    self.assertEqual(iiif_cache.newFileMode, iiif_cache.umaskedFileMode())
+
+  def test_response_survives_eviction(self):
+    cache = iiif_cache.DiskCache(os.path.join(self.folder, 'small'), 100)
+    cache.put('http://example.org/a', b'a' * 60)
+    response = cache.get('http://example.org/a')
+    streamed = cache.putStream('http://example.org/b', [b'b' * 90])
+    # Evicting a made room for b, and b alone is over the budget as well
+    self.assertIsNone(cache.get('http://example.org/a'))
+    self.assertFalse(os.path.exists(response.contentPath))
+    self.assertEqual(response.content, b'a' * 60)
+    with streamed.openContent() as streamedFile:
+      self.assertEqual(streamedFile.read(), b'b' * 90)
+
+  def test_unreadable_pickles_are_moved_aside(self):
+    with open(os.path.join(self.cache.path, 'not-a-pickle'), 'wb') as pickleFile:
+      pickleFile.write(b'garbage')
+    self.assertTrue(self.cache.hasPickleCache())
+    self.assertEqual(self.cache.importPickleCache(), 0)
+    self.assertFalse(self.cache.hasPickleCache())
+    self.assertTrue(os.path.isfile(os.path.join(self.cache.path, 'unimported', 'not-a-pickle')))
+
+
+if __name__ == '__main__':
+  unittest.main()
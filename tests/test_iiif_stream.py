@@ -0,0 +1,87 @@
+"""Tests for iiif_stream.py's incremental JSON parsing."""
+
+import io
+import json
+import random
+import unittest
+
+import iiif_stream
+
+# Read sizes to parse every document with, so that the chunk boundaries fall
+# everywhere: inside numbers, strings, literals and multi-byte characters
+READ_SIZES = [1, 2, 3, 5, 7, 16, 64 * 1024]
+
+
+def _random_value(rng, depth=0):
+  kind = rng.randrange(7 if depth < 3 else 4)
+  if kind == 0:
+    return rng.choice([0, -2, 12, 5e10, -2.5e10, 0.1, 12.75, 1.5e3, -0.0001,
+                       123456789012345678])
+  if kind == 1:
+    return rng.choice(['', 'face', 'café', '歌舞伎',
+                       'quote " and \\\\ backslash', 'line\nbreak'])
+  if kind == 2:
+    return rng.choice([True, False, None])
+  if kind == 3:
+    return rng.uniform(-1e6, 1e6)
+  if kind == 4:
+    return [_random_value(rng, depth + 1) for _ in range(rng.randrange(4))]
+  return {'k%d' % i: _random_value(rng, depth + 1)
+          for i in range(rng.randrange(4))}
+
+
+class IterArrayItemsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.read_size = iiif_stream.readSize
+
+  def tearDown(self):
+    iiif_stream.readSize = self.read_size
+
+  def items(self, text, read_size, key='resources'):
+    iiif_stream.readSize = read_size
+    return list(iiif_stream.iterArrayItems(
+        io.BytesIO(text.encode('utf-8')), key))
+
+  def test_numbers_split_across_chunks(self):
+    text = '{"total": 1.5e3, "resources":[-2.5e10, 0.1, 12.75], "n": -2.0}'
+    for read_size in READ_SIZES:
+      self.assertEqual(self.items(text, read_size), [-2.5e10, 0.1, 12.75])
+
+  def test_other_values_are_skipped(self):
+    text = ('\ufeff{ "@id": "x", "within": {"a": [1, {"b": null}]},\n'
+            '  "resources" : [ {"@id": "a1"} , {"@id": "a2"} ] ,'
+            ' "other": [true, false] }')
+    for read_size in READ_SIZES:
+      self.assertEqual(self.items(text, read_size),
+                       [{'@id': 'a1'}, {'@id': 'a2'}])
+
+  def test_empty_and_missing_arrays(self):
+    for read_size in READ_SIZES:
+      self.assertEqual(self.items('{"resources": []}', read_size), [])
+      self.assertEqual(self.items('{}', read_size), [])
+      self.assertEqual(self.items('{"other": 1}', read_size), [])
+
+  def test_malformed_document_raises(self):
+    for read_size in READ_SIZES:
+      with self.assertRaises(ValueError):
+        self.items('{"resources": [1, 2', read_size)
+      with self.assertRaises(ValueError):
+        self.items('{"resources": [1.2.3]}', read_size)
+
+  def test_random_documents(self):
+    rng = random.Random(0)
+    for _ in range(200):
+      document = {'k%d' % i: _random_value(rng) for i in range(rng.randrange(3))}
+      document['resources'] = [_random_value(rng)
+                               for _ in range(rng.randrange(5))]
+      document['total'] = _random_value(rng)
+      text = json.dumps(document, ensure_ascii=rng.random() < 0.5,
+                        indent=rng.choice([None, 1]))
+      for read_size in rng.sample(READ_SIZES, 3):
+        self.assertEqual(self.items(text, read_size), document['resources'],
+                         'read size %d: %s' % (read_size, text))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+"""Tests for jpeg_header.py's frame header parsing."""
+
+from io import BytesIO
+import struct
+import unittest
+
+from PIL import Image
+
+import jpeg_header
+
+
+def encodeImage(size, mode='RGB', format='jpeg', **options):
+  out = BytesIO()
+  Image.new(mode, size, 'red' if (mode == 'RGB') else 128).save(out, format, **options)
+  return out.getvalue()
+
+def segment(marker, payload):
+  return bytes([0xFF, marker]) + struct.pack('>H', len(payload) + 2) + payload
+
+
+class JPEGHeaderTest(unittest.TestCase):
+
+  def test_baseline(self):
+    data = encodeImage((37, 23))
+    self.assertEqual(jpeg_header.readJPEGHeader(data), (37, 23, 3))
+    self.assertEqual(jpeg_header.jpegSize(data), (37, 23))
+
+  def test_progressive(self):
+    data = encodeImage((300, 1001), progressive=True)
+    # SOF2 rather than SOF0
+    self.assertIn(b'\xff\xc2', data)
+    self.assertNotIn(b'\xff\xc0', data)
+    self.assertEqual(jpeg_header.readJPEGHeader(data), (300, 1001, 3))
+
+  def test_grayscale(self):
+    self.assertEqual(jpeg_header.readJPEGHeader(encodeImage((5, 7), 'L')), (5, 7, 1))
+
+  def test_leading_segments(self):
+    data = encodeImage((640, 480))
+    # An APP1 segment whose payload looks like a frame header, a comment and
+    # fill bytes before the next marker, all before the real frame header
+    fake = b'\xff\xc0\x00\x11\x08\x00\x01\x00\x01\x03'
+    extra = segment(0xE1, b'Exif\x00\x00' + fake) + segment(0xFE, b'a comment') + b'\xff\xff'
+    data = data[:2] + extra + data[2:]
+    self.assertEqual(jpeg_header.readJPEGHeader(data), (640, 480, 3))
+    self.assertEqual(jpeg_header.readJPEGHeader(memoryview(data)), (640, 480, 3))
+    self.assertEqual(jpeg_header.readJPEGHeader(bytearray(data)), (640, 480, 3))
+
+  def test_truncated(self):
+    data = encodeImage((64, 48))
+    sofEnd = data.index(b'\xff\xc0') + 2 + 8
+    for end in range(sofEnd):
+      self.assertIsNone(jpeg_header.readJPEGHeader(data[:end]), end)
+    self.assertEqual(jpeg_header.readJPEGHeader(data[:sofEnd]), (64, 48, 3))
+
+  def test_not_a_jpeg(self):
+    for data in [b'', b'\xff\xd8', b'GIF89a', encodeImage((8, 8), format='png'),
+                 # Start of scan before any frame header
+                 b'\xff\xd8' + segment(0xDA, b'\x00' * 10),
+                 # A segment that doesn't start with a marker
+                 b'\xff\xd8' + segment(0xE0, b'JFIF\x00') + b'\x00\x00',
+                 # Zero-sized frame
+                 b'\xff\xd8' + segment(0xC0, b'\x08\x00\x00\x00\x10\x03')]:
+      self.assertIsNone(jpeg_header.readJPEGHeader(data), data[:16])
+      self.assertIsNone(jpeg_header.jpegSize(data))
+
+
+if __name__ == '__main__':
+  unittest.main()
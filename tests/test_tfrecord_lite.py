@@ -0,0 +1,236 @@
+"""Tests for tfrecord_lite.py's record framing, Example encoding and index."""
+
+import json
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+
+import tfrecord_lite
+
+
+# Written by tf.io.TFRecordWriter and tf.train.Example.SerializeToString()
+_GOLDEN_RECORD = b'\x03\x00\x00\x00\x00\x00\x00\x00\xb0\x99I\x0eabcnW\xf1!'
+_GOLDEN_EXAMPLE = (
+    b'\n\x8c\x01\n\x1e\n\x0eimage/filename\x12\x0c\n\n\n\x08img1.jpg\n\x15'
+    b'\n\x0cimage/height\x12\x05\x1a\x03\n\x01\x18\n&\n\x16image/object/bbox/'
+    b'xmin\x12\x0c\x12\n\n\x08\x00\x00\x80>\x00\x00\x00?\n+\n\x18image/object/'
+    b'class/label\x12\x0f\x1a\r\n\x0b\x01\xfe\xff\xff\xff\xff\xff\xff\xff\xff'
+    b'\x01')
+
+
+def _delimited(field_number, payload):
+  """Straightforward protobuf length-delimited field, to check against."""
+  return (tfrecord_lite._varint((field_number << 3) | 2) +
+          tfrecord_lite._varint(len(payload)) + payload)
+
+
+def _example(key, filename):
+  return tfrecord_lite.serialize_example({
+      'image/key/sha256': tfrecord_lite.bytes_feature(key.encode('utf8')),
+      'image/filename': tfrecord_lite.bytes_feature(filename.encode('utf8')),
+  })
+
+
+class Crc32cTest(unittest.TestCase):
+
+  # From RFC 3720, appendix B.4, and the usual check value
+  VECTORS = [
+      (b'', 0),
+      (b'123456789', 0xE3069283),
+      (b'\x00' * 32, 0x8A9136AA),
+      (b'\xff' * 32, 0x62A8AB43),
+      (bytes(range(32)), 0x46DD794E),
+  ]
+
+  def test_known_values(self):
+    for data, crc in self.VECTORS:
+      self.assertEqual(tfrecord_lite.crc32c(data), crc)
+
+  def test_python_fallback_matches(self):
+    for data, crc in self.VECTORS:
+      self.assertEqual(tfrecord_lite._crc32c_python(data), crc)
+    # Lengths around the eight byte steps
+    data = bytes(range(256)) * 3
+    for length in range(0, 40):
+      self.assertEqual(tfrecord_lite._crc32c_python(data[:length]),
+                       tfrecord_lite.crc32c(data[:length]))
+    self.assertEqual(tfrecord_lite._crc32c_python(memoryview(data)),
+                     tfrecord_lite.crc32c(data))
+
+
+class FramingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.temp_dir, 'test.record')
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def test_encode_record_matches_tensorflow(self):
+    header, footer = tfrecord_lite.encode_record(b'abc')
+    self.assertEqual(header + b'abc' + footer, _GOLDEN_RECORD)
+
+  def test_round_trip(self):
+    records = [b'', b'abc', os.urandom(100000)]
+    for compression_type in tfrecord_lite.COMPRESSION_TYPES:
+      with tfrecord_lite.TFRecordWriter(
+          self.path, compression_type=compression_type) as writer:
+        for record in records:
+          writer.write(record)
+      self.assertEqual(
+          list(tfrecord_lite.tf_record_iterator(self.path, compression_type)),
+          records)
+
+  def test_uncompressed_file_is_plain_framing(self):
+    with tfrecord_lite.TFRecordWriter(self.path) as writer:
+      writer.write(b'abc')
+    with open(self.path, 'rb') as fid:
+      self.assertEqual(fid.read(), _GOLDEN_RECORD)
+
+  def test_corrupt_record_is_rejected(self):
+    corrupt = bytearray(_GOLDEN_RECORD)
+    corrupt[13] ^= 1
+    with open(self.path, 'wb') as fid:
+      fid.write(corrupt)
+    with self.assertRaises(ValueError):
+      list(tfrecord_lite.tf_record_iterator(self.path))
+    self.assertEqual(
+        list(tfrecord_lite.tf_record_iterator(self.path, verify=False)),
+        [b'acc'])
+
+  def test_truncated_record_is_rejected(self):
+    for end in (5, 14, len(_GOLDEN_RECORD) - 1):
+      with open(self.path, 'wb') as fid:
+        fid.write(_GOLDEN_RECORD + _GOLDEN_RECORD[:end])
+      with self.assertRaises(ValueError):
+        list(tfrecord_lite.tf_record_iterator(self.path))
+
+
+class ExampleTest(unittest.TestCase):
+
+  FEATURES = {
+      'image/height': tfrecord_lite.int64_feature(24),
+      'image/filename': tfrecord_lite.bytes_feature(b'img1.jpg'),
+      'image/object/bbox/xmin': tfrecord_lite.float_list_feature([0.25, 0.5]),
+      'image/object/class/label': tfrecord_lite.int64_list_feature([1, -2]),
+  }
+
+  def test_serialize_matches_tensorflow(self):
+    self.assertEqual(tfrecord_lite.serialize_example(self.FEATURES),
+                     _GOLDEN_EXAMPLE)
+
+  def test_serialize_is_independent_of_key_order(self):
+    reversed_features = dict(reversed(list(self.FEATURES.items())))
+    self.assertEqual(tfrecord_lite.serialize_example(reversed_features),
+                     _GOLDEN_EXAMPLE)
+
+  def test_parse(self):
+    self.assertEqual(tfrecord_lite.parse_example(_GOLDEN_EXAMPLE),
+                     self.FEATURES)
+
+  def test_parse_selected_names(self):
+    self.assertEqual(
+        tfrecord_lite.parse_example(_GOLDEN_EXAMPLE, ['image/filename']),
+        {'image/filename': self.FEATURES['image/filename']})
+
+  def test_large_values_match_nested_encoding(self):
+    # Lengths on either side of where the length varints get longer
+    for length in (127, 128, 16383, 16384, 2097152):
+      value = os.urandom(length)
+      expected = _delimited(1, _delimited(1, _delimited(
+          1, b'image/encoded') + _delimited(2, _delimited(
+              1, _delimited(1, value)))))
+      self.assertEqual(tfrecord_lite.serialize_example(
+          {'image/encoded': tfrecord_lite.bytes_feature(value)}), expected)
+      self.assertEqual(tfrecord_lite.serialize_example(
+          {'image/encoded': tfrecord_lite.bytes_feature(memoryview(value))}),
+                       expected)
+
+  def test_image_is_copied_once(self):
+    value = os.urandom(4 * 1024 * 1024)
+    tracemalloc.start()
+    try:
+      example = tfrecord_lite.serialize_example({
+          'image/encoded': tfrecord_lite.bytes_feature(value),
+          'image/height': tfrecord_lite.int64_feature(24),
+      })
+      _, peak = tracemalloc.get_traced_memory()
+    finally:
+      tracemalloc.stop()
+    self.assertLess(peak, len(example) + 64 * 1024)
+
+  def test_empty_lists(self):
+    features = {
+        'a': tfrecord_lite.bytes_list_feature([]),
+        'b': tfrecord_lite.float_list_feature([]),
+        'c': tfrecord_lite.int64_list_feature([]),
+    }
+    self.assertEqual(
+        tfrecord_lite.parse_example(tfrecord_lite.serialize_example(features)),
+        features)
+
+
+class IndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.temp_dir, 'test.record')
+    self.records = [_example('key%d' % i, 'img%d.jpg' % i) for i in range(5)]
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def write(self, compression_type=''):
+    with tfrecord_lite.TFRecordWriter(
+        self.path, index=True, compression_type=compression_type) as writer:
+      for record in self.records:
+        writer.write(record)
+
+  def test_index_entries(self):
+    self.write()
+    index_path = tfrecord_lite.index_path(self.path)
+    self.assertEqual(os.path.dirname(index_path),
+                     os.path.join(self.temp_dir, 'index'))
+    compression_type, entries = tfrecord_lite.read_index_with_header(
+        index_path)
+    self.assertEqual(compression_type, '')
+    self.assertEqual([entry['sha256'] for entry in entries],
+                     ['key%d' % i for i in range(5)])
+    self.assertEqual([entry['filename'] for entry in entries],
+                     ['img%d.jpg' % i for i in range(5)])
+    self.assertEqual(tfrecord_lite.read_index(index_path), entries)
+
+  def test_random_access(self):
+    for compression_type in ('', 'GZIP'):
+      self.write(compression_type)
+      with tfrecord_lite.IndexedTFRecordReader(self.path) as reader:
+        self.assertEqual(len(reader), 5)
+        self.assertEqual(reader.read(3), self.records[3])
+        self.assertEqual(reader.get('key1'), self.records[1])
+        self.assertIn('key4', reader)
+        self.assertNotIn('key5', reader)
+        with self.assertRaises(KeyError):
+          reader.get('key5')
+
+  def test_compression_type_mismatch_is_rejected(self):
+    self.write('GZIP')
+    with self.assertRaises(ValueError):
+      tfrecord_lite.IndexedTFRecordReader(self.path, compression_type='')
+
+  def test_index_without_header(self):
+    self.write()
+    index_path = tfrecord_lite.index_path(self.path)
+    with open(index_path) as fid:
+      lines = fid.readlines()
+    self.assertIn('compression_type', json.loads(lines[0]))
+    with open(index_path, 'w') as fid:
+      fid.writelines(lines[1:])
+    with tfrecord_lite.IndexedTFRecordReader(self.path) as reader:
+      self.assertEqual(reader.get('key2'), self.records[2])
+
+
+if __name__ == '__main__':
+  unittest.main()
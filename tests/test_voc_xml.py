@@ -0,0 +1,105 @@
+"""Tests for voc_xml.py's streamed annotation XML writer."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lxml import etree
+
+import voc_xml
+
+
+# The tree built and written by AnnotationConverter.py before voc_xml.py
+def _oldAnnotationXML(xmlPath, folderName, fileName, width, height, objects):
+  root = etree.Element("annotation")
+  folder = etree.SubElement(root, "folder")
+  folder.text = folderName
+  fn = etree.SubElement(root, "filename")
+  fn.text = fileName
+  sz = etree.SubElement(root, "size")
+  wd = etree.SubElement(sz, "width")
+  wd.text = str(width)
+  ht = etree.SubElement(sz, "height")
+  ht.text = str(height)
+  dp = etree.SubElement(sz, "depth")
+  dp.text = "3"
+  seg = etree.SubElement(root, "segmented")
+  seg.text = "0"
+  for tag, box in objects:
+    obj = etree.SubElement(root, "object")
+    name = etree.SubElement(obj, "name")
+    name.text = tag
+    bbox = etree.SubElement(obj, "bndbox")
+    xmi = etree.SubElement(bbox, "xmin")
+    xmi.text = str(box[0])
+    ymi = etree.SubElement(bbox, "ymin")
+    ymi.text = str(box[1])
+    xma = etree.SubElement(bbox, "xmax")
+    xma.text = str(box[2])
+    yma = etree.SubElement(bbox, "ymax")
+    yma.text = str(box[3])
+  with open(xmlPath, 'wb') as xmlFile:
+    et = etree.ElementTree(root)
+    et.write(xmlFile, pretty_print=True)
+
+
+# (folderName, fileName, width, height, objects)
+FIXTURE = [
+  ('kabuki', 'kabuki_000.jpg', 1000, 667, [('face', (10, 20, 110, 140))]),
+  ('kabuki', 'kabuki_001.jpg', 563, 1000, []),
+  ('kabuki', 'kabuki_002.jpg', 1000, 1000,
+   [('face', (0, 0, 1000, 1000)), ('man', (5, 6, 7, 8)),
+    ('woman', (300, 400, 350, 460))]),
+  # Tags and names that need escaping, or aren't ASCII
+  ('gokan & co', 'gokan<1>.jpg', 800, 600,
+   [('"fish" & <chips>', (1, 2, 3, 4)), ('女性', (40, 50, 60, 70))]),
+]
+
+
+class WriteAnnotationXMLTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempDir)
+
+  def jobs(self, count):
+    jobs = []
+    for i in range(count):
+      args = FIXTURE[i % len(FIXTURE)]
+      xmlPath = os.path.join(self.tempDir, 'new_%03d.xml' % i)
+      jobs.append(('image_%03d' % i, (xmlPath,) + args))
+    return jobs
+
+  def assertMatchesOldWriter(self, jobs):
+    for _, args in jobs:
+      oldPath = args[0].replace('new_', 'old_')
+      _oldAnnotationXML(oldPath, *args[1:])
+      with open(args[0], 'rb') as newFile, open(oldPath, 'rb') as oldFile:
+        self.assertEqual(newFile.read(), oldFile.read())
+
+  def test_matches_old_writer(self):
+    jobs = self.jobs(len(FIXTURE))
+    for _, args in jobs:
+      voc_xml.writeAnnotationXML(*args)
+    self.assertMatchesOldWriter(jobs)
+
+  def test_in_process(self):
+    jobs = self.jobs(10)
+    written = list(voc_xml.writeAnnotationXMLs(jobs, workers=1, chunkSize=3))
+    self.assertEqual(written, [[key for key, _ in jobs[i:i + 3]]
+                               for i in range(0, 10, 3)])
+    self.assertMatchesOldWriter(jobs)
+
+  def test_pooled(self):
+    jobs = self.jobs(10)
+    written = list(voc_xml.writeAnnotationXMLs(jobs, workers=2, chunkSize=3))
+    self.assertEqual(written, [[key for key, _ in jobs[i:i + 3]]
+                               for i in range(0, 10, 3)])
+    self.assertMatchesOldWriter(jobs)
+
+
+if __name__ == '__main__':
+  unittest.main()
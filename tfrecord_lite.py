@@ -0,0 +1,550 @@
+"""TFRecord writing without TensorFlow.
+
+A TFRecord file is a sequence of records, each framed as
+
+  uint64 length
+  uint32 masked CRC32C of the length
+  byte   data[length]
+  uint32 masked CRC32C of the data
+
+(all little-endian), and the object detection records hold serialized
+tf.train.Example protocol buffers. Both are simple enough to produce
+directly, which lets create_tf_record.py run without importing TensorFlow.
+
+Examples are serialized with their features sorted by key, which is
+byte-for-byte what TensorFlow produces with deterministic serialization
+(SerializeToString(deterministic=True)); the default TensorFlow
+serialization doesn't guarantee any particular order of the feature map.
+
+Each record file can also get a sidecar index of the byte offset, length,
+image key and file name of its records, which IndexedTFRecordReader uses to
+fetch any one example with a single seek instead of scanning the file. The
+indexes go in an index/ subdirectory, so that a pattern matching the record
+files (such as <record>* for a set of shards) doesn't match them too.
+
+Records can be GZIP or ZLIB compressed, like with TensorFlow's
+TFRecordCompressionType: the whole file is then one compressed stream.
+
+CRC32C is computed by the crc32c or google-crc32c packages when one of them
+is installed, and otherwise by a (much slower) pure-Python fallback.
+"""
+
+import gzip
+import json
+import os
+import struct
+import zlib
+
+try:
+  from crc32c import crc32c as _crc32c
+except ImportError:
+  try:
+    from google_crc32c import value as _crc32c
+  except ImportError:
+    _crc32c = None
+
+# Reflected Castagnoli polynomial
+_CRC32C_POLY = 0x82F63B78
+
+
+def _make_crc_tables():
+  """Tables for table-driven CRC32C, eight bytes at a time."""
+  tables = [[0] * 256 for _ in range(8)]
+  for i in range(256):
+    crc = i
+    for _ in range(8):
+      crc = (crc >> 1) ^ (_CRC32C_POLY if crc & 1 else 0)
+    tables[0][i] = crc
+  for i in range(256):
+    crc = tables[0][i]
+    for t in range(1, 8):
+      crc = tables[0][crc & 0xFF] ^ (crc >> 8)
+      tables[t][i] = crc
+  return tables
+
+
+_crc_tables = None
+
+
+def _crc32c_python(data):
+  """CRC32C of data, processing eight bytes per step (slicing-by-8)."""
+  global _crc_tables
+  if _crc_tables is None:
+    _crc_tables = _make_crc_tables()
+  t0, t1, t2, t3, t4, t5, t6, t7 = _crc_tables
+  data = memoryview(data).cast('B')
+  crc = 0xFFFFFFFF
+  end = len(data) - len(data) % 8
+  for (word,) in struct.iter_unpack('<Q', data[:end]):
+    word ^= crc
+    crc = (t7[word & 0xFF] ^ t6[(word >> 8) & 0xFF] ^
+           t5[(word >> 16) & 0xFF] ^ t4[(word >> 24) & 0xFF] ^
+           t3[(word >> 32) & 0xFF] ^ t2[(word >> 40) & 0xFF] ^
+           t1[(word >> 48) & 0xFF] ^ t0[word >> 56])
+  for byte in data[end:]:
+    crc = t0[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+  return crc ^ 0xFFFFFFFF
+
+
+def crc32c(data):
+  """Returns the CRC32C checksum of data (bytes-like)."""
+  if _crc32c is not None:
+    return _crc32c(data)
+  return _crc32c_python(data)
+
+
+def masked_crc32c(data):
+  """Returns the masked CRC32C that TFRecord files store."""
+  crc = crc32c(data)
+  return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def encode_record(data):
+  """Returns the framing that goes before and after one record's data."""
+  length = struct.pack('<Q', len(data))
+  header = length + struct.pack('<I', masked_crc32c(length))
+  footer = struct.pack('<I', masked_crc32c(data))
+  return header, footer
+
+
+_HEADER_SIZE = 12
+_FOOTER_SIZE = 4
+
+COMPRESSION_TYPES = ('', 'GZIP', 'ZLIB')
+# TensorFlow's default compression level (Z_DEFAULT_COMPRESSION)
+_COMPRESSION_LEVEL = 6
+
+
+class _ZlibWriter(object):
+  """Writes a file as one zlib stream."""
+
+  def __init__(self, path):
+    self._file = open(path, 'wb')
+    self._compressor = zlib.compressobj(_COMPRESSION_LEVEL)
+
+  def write(self, data):
+    self._file.write(self._compressor.compress(data))
+
+  def flush(self):
+    self._file.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+    self._file.flush()
+
+  def close(self):
+    self._file.write(self._compressor.flush())
+    self._file.close()
+
+
+class _ZlibReader(object):
+  """Reads a file written as one zlib stream."""
+
+  def __init__(self, path):
+    self._file = open(path, 'rb')
+    self._decompressor = zlib.decompressobj()
+    self._buffer = bytearray()
+
+  def read(self, size):
+    while len(self._buffer) < size and not self._decompressor.eof:
+      chunk = self._file.read(1 << 16)
+      if not chunk:
+        break
+      self._buffer += self._decompressor.decompress(chunk)
+    data = bytes(self._buffer[:size])
+    del self._buffer[:size]
+    return data
+
+  def close(self):
+    self._file.close()
+
+
+def _open_record_file(path, mode, compression_type):
+  if not compression_type:
+    return open(path, mode + 'b')
+  if compression_type == 'GZIP':
+    # mtime=0 keeps the output the same from one build to the next
+    return gzip.GzipFile(path, mode + 'b', compresslevel=_COMPRESSION_LEVEL,
+                         mtime=0)
+  if compression_type == 'ZLIB':
+    return _ZlibWriter(path) if mode == 'w' else _ZlibReader(path)
+  raise ValueError('Unknown TFRecord compression type %r' % compression_type)
+
+
+def index_path(record_path):
+  """Returns the path of the sidecar index of a TFRecord file."""
+  directory, name = os.path.split(record_path)
+  return os.path.join(directory, 'index', name + '.index')
+
+
+class TFRecordWriter(object):
+  """Drop-in for tf.python_io.TFRecordWriter.
+
+  compression_type is '' (or None), 'GZIP' or 'ZLIB'.
+
+  With index=True, a sidecar index (see index_path) is written as well.
+  Its first JSON line holds the file's compression type, and it then has
+  one JSON line per record holding its byte offset and length and the
+  image/key/sha256 and image/filename of the tf.train.Example it holds. The
+  offsets are positions in the uncompressed stream.
+  """
+
+  def __init__(self, path, index=False, compression_type=None):
+    self._file = _open_record_file(path, 'w', compression_type)
+    self._offset = 0
+    self._index = None
+    if index:
+      os.makedirs(os.path.dirname(index_path(path)), exist_ok=True)
+      self._index = open(index_path(path), 'w')
+      self._index.write(json.dumps({'compression_type':
+                                    compression_type or ''}) + '\n')
+
+  def write(self, record):
+    header, footer = encode_record(record)
+    self._file.write(header)
+    self._file.write(record)
+    self._file.write(footer)
+    if self._index is not None:
+      features = parse_example(record, ('image/key/sha256', 'image/filename'))
+      entry = {'offset': self._offset, 'length': len(record)}
+      for name, field in (('sha256', 'image/key/sha256'),
+                          ('filename', 'image/filename')):
+        values = features.get(field, (None, []))[1]
+        entry[name] = values[0].decode('utf8') if values else None
+      self._index.write(json.dumps(entry, separators=(',', ':')) + '\n')
+    self._offset += len(header) + len(record) + len(footer)
+
+  def flush(self):
+    self._file.flush()
+    if self._index is not None:
+      self._index.flush()
+
+  def close(self):
+    self._file.close()
+    if self._index is not None:
+      self._index.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+# Minimal tf.train.Example encoding. Features are built with the helpers
+# below (named after the ones in object_detection's dataset_util) and
+# serialized with serialize_example().
+
+_BYTES_LIST = 1
+_FLOAT_LIST = 2
+_INT64_LIST = 3
+
+
+def _varint(value):
+  if value < 0:
+    value += 1 << 64
+  out = bytearray()
+  while value > 0x7F:
+    out.append((value & 0x7F) | 0x80)
+    value >>= 7
+  out.append(value)
+  return bytes(out)
+
+
+def _wrap(field_number, pieces, size):
+  """Makes pieces of the given total size a length-delimited field.
+
+  Messages are built as lists of pieces (small headers, and the values
+  themselves) rather than bytes, so that nesting them doesn't copy them.
+  """
+  header = _varint((field_number << 3) | 2) + _varint(size)
+  return [header] + pieces, len(header) + size
+
+
+def int64_feature(value):
+  return (_INT64_LIST, [value])
+
+
+def int64_list_feature(value):
+  return (_INT64_LIST, list(value))
+
+
+def bytes_feature(value):
+  return (_BYTES_LIST, [value])
+
+
+def bytes_list_feature(value):
+  return (_BYTES_LIST, list(value))
+
+
+def float_list_feature(value):
+  return (_FLOAT_LIST, list(value))
+
+
+def _encode_feature(feature):
+  """Returns the pieces of a Feature message (see _wrap), and their size."""
+  kind, values = feature
+  pieces = []
+  size = 0
+  if kind == _BYTES_LIST:
+    # Values can be any bytes-like object, such as an mmap of an image file
+    for value in values:
+      value_pieces, value_size = _wrap(1, [value], len(value))
+      pieces += value_pieces
+      size += value_size
+  elif values:
+    if kind == _FLOAT_LIST:
+      packed = struct.pack('<%df' % len(values), *values)
+    else:
+      packed = b''.join(_varint(int(value)) for value in values)
+    pieces, size = _wrap(1, [packed], len(packed))
+  return _wrap(kind, pieces, size)
+
+
+def serialize_example(features):
+  """Serializes a dict of feature name to feature as a tf.train.Example.
+
+  Returns:
+    The serialized example, as a bytearray. The sizes of all of the nested
+    messages are worked out first, so that each value (such as the encoded
+    image) is copied only once, straight into it.
+  """
+  entries = []
+  entries_size = 0
+  for key in sorted(features):
+    name = key.encode('utf8')
+    name_pieces, name_size = _wrap(1, [name], len(name))
+    feature_pieces, feature_size = _wrap(2, *_encode_feature(features[key]))
+    entry_pieces, entry_size = _wrap(1, name_pieces + feature_pieces,
+                                     name_size + feature_size)
+    entries += entry_pieces
+    entries_size += entry_size
+  # Example.features (field 1) holds Features.feature (field 1) map entries
+  pieces, size = _wrap(1, entries, entries_size)
+  out = bytearray(size)
+  pos = 0
+  # Assigning to a slice of the bytearray itself would copy each piece first
+  with memoryview(out) as view:
+    for piece in pieces:
+      view[pos:pos + len(piece)] = piece
+      pos += len(piece)
+  return out
+
+
+def _read_varint(data, pos):
+  result = 0
+  shift = 0
+  while True:
+    byte = data[pos]
+    pos += 1
+    result |= (byte & 0x7F) << shift
+    if not byte & 0x80:
+      return result, pos
+    shift += 7
+
+
+def _iter_fields(data):
+  """Yields (field number, wire type, value) for each field of a message.
+
+  Length-delimited values are memoryview slices of data, so skipping over
+  a field (such as the encoded image) doesn't copy it.
+  """
+  data = memoryview(data)
+  pos = 0
+  while pos < len(data):
+    tag, pos = _read_varint(data, pos)
+    wire_type = tag & 7
+    if wire_type == 0:
+      value, pos = _read_varint(data, pos)
+    elif wire_type == 1:
+      value = data[pos:pos + 8]
+      pos += 8
+    elif wire_type == 2:
+      length, pos = _read_varint(data, pos)
+      value = data[pos:pos + length]
+      pos += length
+    elif wire_type == 5:
+      value = data[pos:pos + 4]
+      pos += 4
+    else:
+      raise ValueError('Unsupported protobuf wire type %d' % wire_type)
+    yield tag >> 3, wire_type, value
+
+
+def _decode_feature(data):
+  kind = None
+  values = []
+  for kind, _, value_list in _iter_fields(data):
+    values = []
+    for _, wire_type, value in _iter_fields(value_list):
+      if kind == _BYTES_LIST:
+        values.append(bytes(value))
+      elif kind == _FLOAT_LIST:
+        values.extend(struct.unpack('<%df' % (len(value) // 4), value))
+      elif wire_type == 2:
+        pos = 0
+        while pos < len(value):
+          item, pos = _read_varint(value, pos)
+          values.append(item - (1 << 64) if item >> 63 else item)
+      else:
+        values.append(value - (1 << 64) if value >> 63 else value)
+  return (kind, values)
+
+
+def parse_example(data, names=None):
+  """Parses a serialized tf.train.Example.
+
+  Args:
+    data: The serialized example (any bytes-like object).
+    names: Optional collection of feature names to decode; the others are
+      skipped without being copied.
+
+  Returns:
+    A dict of feature name to feature, in the form the feature helpers
+    above build.
+  """
+  features = {}
+  for field, _, message in _iter_fields(data):
+    if field != 1:
+      continue
+    for field, _, entry in _iter_fields(message):
+      if field != 1:
+        continue
+      name = None
+      feature = None
+      for field, _, value in _iter_fields(entry):
+        if field == 1:
+          name = bytes(value).decode('utf8')
+        elif field == 2:
+          feature = value
+      if names is None or name in names:
+        features[name] = _decode_feature(feature or b'')
+  return features
+
+
+def read_index_with_header(path):
+  """Reads a sidecar index (see TFRecordWriter).
+
+  Returns:
+    The compression type of the record file (None for indexes written
+    before it was recorded) and the list of record entries.
+  """
+  compression_type = None
+  entries = []
+  with open(path) as fid:
+    for line in fid:
+      entry = json.loads(line)
+      if 'offset' in entry:
+        entries.append(entry)
+      else:
+        compression_type = entry['compression_type']
+  return compression_type, entries
+
+
+def read_index(path):
+  """Returns the record entries of a sidecar index (see TFRecordWriter)."""
+  return read_index_with_header(path)[1]
+
+
+def _check_record(header, data, footer, description):
+  if (masked_crc32c(header[:8]) != struct.unpack('<I', header[8:])[0] or
+      masked_crc32c(data) != struct.unpack('<I', footer)[0]):
+    raise ValueError('Corrupt record %s' % description)
+
+
+def tf_record_iterator(path, compression_type=None, verify=True):
+  """Yields the records of a TFRecord file in order, like
+  tf.python_io.tf_record_iterator.
+
+  Args:
+    path: Path to the TFRecord file.
+    compression_type: '' (or None), 'GZIP' or 'ZLIB'.
+    verify: Whether to check the CRCs of each record.
+
+  Raises:
+    ValueError: if a record is truncated or corrupt.
+  """
+  fid = _open_record_file(path, 'r', compression_type)
+  try:
+    offset = 0
+    while True:
+      header = fid.read(_HEADER_SIZE)
+      if not header:
+        return
+      description = 'at offset %d of %s' % (offset, path)
+      if len(header) != _HEADER_SIZE:
+        raise ValueError('Truncated record %s' % description)
+      length = struct.unpack('<Q', header[:8])[0]
+      data = fid.read(length)
+      footer = fid.read(_FOOTER_SIZE)
+      if len(data) != length or len(footer) != _FOOTER_SIZE:
+        raise ValueError('Truncated record %s' % description)
+      if verify:
+        _check_record(header, data, footer, description)
+      offset += _HEADER_SIZE + length + _FOOTER_SIZE
+      yield data
+  finally:
+    fid.close()
+
+
+class IndexedTFRecordReader(object):
+  """Random access to the records of a TFRecord file with a sidecar index.
+
+  Any record can be fetched by its position in the file or by the SHA-256
+  key of its image, with one seek and one read. GZIP files can be read too,
+  but seeking in them means decompressing up to the record; ZLIB files
+  can't be read at random.
+
+  The compression type is taken from the index unless it's given (it has
+  to be given for indexes that predate it being recorded there), and one
+  that doesn't match the index is an error.
+  """
+
+  def __init__(self, path, verify=True, compression_type=None):
+    indexed_type, self.entries = read_index_with_header(index_path(path))
+    if compression_type is None:
+      compression_type = indexed_type or ''
+    elif indexed_type is not None and compression_type != indexed_type:
+      raise ValueError('%s is indexed as %r compressed, not %r' %
+                       (path, indexed_type, compression_type))
+    if compression_type == 'ZLIB':
+      raise ValueError('ZLIB compressed TFRecord files can only be read '
+                       'sequentially')
+    self._positions = {}
+    for position, entry in enumerate(self.entries):
+      self._positions.setdefault(entry['sha256'], position)
+    self._verify = verify
+    self._file = _open_record_file(path, 'r', compression_type)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, key):
+    return key in self._positions
+
+  def read(self, position):
+    """Returns the serialized record at a position in the file."""
+    entry = self.entries[position]
+    self._file.seek(entry['offset'])
+    frame = self._file.read(_HEADER_SIZE + entry['length'] + _FOOTER_SIZE)
+    if len(frame) != _HEADER_SIZE + entry['length'] + _FOOTER_SIZE:
+      raise ValueError('Truncated record at offset %d' % entry['offset'])
+    data = frame[_HEADER_SIZE:-_FOOTER_SIZE]
+    if self._verify:
+      _check_record(frame[:_HEADER_SIZE], data, frame[-_FOOTER_SIZE:],
+                    'at offset %d' % entry['offset'])
+    return data
+
+  def get(self, key):
+    """Returns the serialized record whose image has a SHA-256 key.
+
+    Raises:
+      KeyError: if no record has that key.
+    """
+    return self.read(self._positions[key])
+
+  def close(self):
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
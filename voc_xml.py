@@ -0,0 +1,71 @@
+#!/usr/bin/python # Expects Python 3
+import multiprocessing
+
+from lxml import etree
+
+# Writes PASCAL VOC annotation XML files with lxml's incremental writer
+# (etree.xmlfile), streaming each element straight to the file rather than
+# building a tree for every image first. The output is byte for byte what
+# etree.ElementTree(root).write(xmlFile, pretty_print=True) produces for the
+# same annotation tree, including its two-space indentation.
+#
+# Large batches of files are spread across a pool of worker processes.
+
+def writeLeaf(xf, tag, text, indent):
+  xf.write(indent)
+  with xf.element(tag):
+    xf.write(text)
+
+# objects is a list of (name, (xmin, ymin, xmax, ymax)) tuples
+def writeAnnotationXML(xmlPath, folderName, fileName, width, height, objects):
+  with open(xmlPath, 'wb') as xmlFile:
+    with etree.xmlfile(xmlFile) as xf:
+      with xf.element('annotation'):
+        writeLeaf(xf, 'folder', folderName, '\n  ')
+        writeLeaf(xf, 'filename', fileName, '\n  ')
+        xf.write('\n  ')
+        with xf.element('size'):
+          writeLeaf(xf, 'width', str(width), '\n    ')
+          writeLeaf(xf, 'height', str(height), '\n    ')
+          writeLeaf(xf, 'depth', '3', '\n    ') # No alpha channel, watch out for grayscale
+          xf.write('\n  ')
+        writeLeaf(xf, 'segmented', '0', '\n  ')
+        for name, bbox in objects:
+          xf.write('\n  ')
+          with xf.element('object'):
+            writeLeaf(xf, 'name', name, '\n    ')
+            xf.write('\n    ')
+            with xf.element('bndbox'):
+              writeLeaf(xf, 'xmin', str(bbox[0]), '\n      ')
+              writeLeaf(xf, 'ymin', str(bbox[1]), '\n      ')
+              writeLeaf(xf, 'xmax', str(bbox[2]), '\n      ')
+              writeLeaf(xf, 'ymax', str(bbox[3]), '\n      ')
+              xf.write('\n    ')
+            xf.write('\n  ')
+        xf.write('\n')
+    xmlFile.write(b'\n')
+
+# Each job is a tuple of writeAnnotationXML's arguments. Returns the image
+# keys of the jobs, once they've all been written.
+def writeAnnotationXMLChunk(jobs):
+  written = []
+  for imageKey, args in jobs:
+    writeAnnotationXML(*args)
+    written.append(imageKey)
+  return written
+
+# Write a list of (imageKey, args) jobs, chunkSize jobs at a time, in up to
+# workers processes. Yields each chunk's image keys as it's finished.
+#
+# The worker processes are forked, since the scripts that call this run
+# everything at the top level and can't be re-imported by spawned workers;
+# where fork isn't available the files are written in this process.
+def writeAnnotationXMLs(jobs, workers=None, chunkSize=500):
+  chunks = [jobs[i:i + chunkSize] for i in range(0, len(jobs), chunkSize)]
+  if ((len(chunks) <= 1) or (workers == 1) or ('fork' not in multiprocessing.get_all_start_methods())):
+    for chunk in chunks:
+      yield writeAnnotationXMLChunk(chunk)
+    return
+  with multiprocessing.get_context('fork').Pool(workers) as pool:
+    for written in pool.imap(writeAnnotationXMLChunk, chunks):
+      yield written